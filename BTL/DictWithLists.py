@@ -18,6 +18,10 @@
 # OrderedDict:
 #  just like a dict, but d.keys() is in insertion order
 #
+# RandomDict:
+#  just like a dict, but random_key() and popitem() pick uniformly at random
+#  in constant time
+#
 # OrderedDictWithLists:
 #  a combination of the two concepts that keeps lists at key locations in
 #  insertion order
@@ -25,6 +29,7 @@
 # by Greg Hazel
 # with code from David Benjamin and contributers
 
+import random
 from BTL.Lists import QList
 from BTL.obsoletepythonsupport import set
 
@@ -229,6 +234,65 @@ class OrderedDictWithLists(DictWithLists, OrderedDict):
         return iter(self._keys)
 
 
+class RandomDict(dict):
+    # keys are also kept in a list, with each key's position in the list, so
+    # one can be picked by index and removed by swapping in the last one.
+
+    def __init__(self, d = None):
+        dict.__init__(self)
+        self._keys = []
+        self._pos = {}
+        if d:
+            self.update(d)
+
+    def __setitem__(self, key, item):
+        if key not in self._pos:
+            self._pos[key] = len(self._keys)
+            self._keys.append(key)
+        dict.__setitem__(self, key, item)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        i = self._pos.pop(key)
+        last = self._keys.pop()
+        if i < len(self._keys):
+            self._keys[i] = last
+            self._pos[last] = i
+
+    def clear(self):
+        dict.clear(self)
+        self._keys = []
+        self._pos = {}
+
+    def copy(self):
+        return RandomDict(self)
+
+    def pop(self, key, *args):
+        if key not in self and args:
+            return args[0]
+        val = self[key]
+        del self[key]
+        return val
+
+    def random_key(self):
+        if not self._keys:
+            raise KeyError('dictionary is empty')
+        return self._keys[random.randrange(len(self._keys))]
+
+    def popitem(self):
+        key = self.random_key()
+        return (key, self.pop(key))
+
+    def setdefault(self, key, failobj = None):
+        if key not in self:
+            self[key] = failobj
+        return self[key]
+
+    def update(self, dict):
+        for (key,val) in dict.items():
+            self.__setitem__(key,val)
+
+
 if __name__=='__main__':
     
     d = DictWithLists()
@@ -299,4 +363,14 @@ if __name__=='__main__':
     d.push(4, 4)
     d.push(4, 2)
     d.push(4, 1)    
-    assert d.poprow(4) == QList([3,4,2,1])
\ No newline at end of file
+    assert d.poprow(4) == QList([3,4,2,1])
+    rd = RandomDict()
+    for i in xrange(50):
+        rd[make_str(i)] = i
+    for i in xrange(0, 50, 2):
+        del rd[make_str(i)]
+    assert sorted(rd.keys()) == sorted([make_str(i) for i in xrange(1, 50, 2)])
+    while rd:
+        k = rd.random_key()
+        assert rd.pop(k) == int(k[:-len("extra")])
+    assert not rd._keys and not rd._pos
@@ -10,7 +10,9 @@
 
 # Written by Bram Cohen, Uoti Urpala, and John Hoffman
 
+import re
 from array import array
+from binascii import hexlify, unhexlify
 
 #counts = [chr(sum([(i >> j) & 1 for j in xrange(8)])) for i in xrange(256)]
 counts = []
@@ -21,6 +23,62 @@ for i in xrange(256):
     counts.append(chr(t))
 counts = ''.join(counts)
 
+# bit offsets (msb first) which are set in each byte value
+set_bits = [tuple([j for j in xrange(8) if i & (128 >> j)])
+            for i in xrange(256)]
+
+_nonzero = re.compile('[^\x00]')
+
+
+## bulk operations
+##
+## These work a whole bitstring at a time by converting to python longs,
+## so "what does this peer have that I need" is a handful of C loops instead
+## of one python-level test per piece. They take the tostring() form, so
+## they work with cBitfield too.
+############################################################################
+def _tolong(s):
+    if not s:
+        return 0L
+    return long(hexlify(s), 16)
+
+def _fromlong(n, nbytes):
+    if nbytes == 0:
+        return ''
+    return unhexlify('%0*x' % (nbytes * 2, n))
+
+def bits_and(a, b):
+    return _fromlong(_tolong(a) & _tolong(b), len(a))
+
+def bits_or(a, b):
+    return _fromlong(_tolong(a) | _tolong(b), len(a))
+
+def bits_andnot(a, b):
+    """bits set in a but not in b"""
+    return _fromlong(_tolong(a) & ~_tolong(b), len(a))
+
+_count_chars = [(chr(i), i) for i in xrange(1, 9)]
+
+def popcount(s):
+    # each byte to its number of set bits, then count each of those
+    t = s.translate(counts)
+    return sum([t.count(c) * i for c, i in _count_chars])
+
+def iter_set(s):
+    """yields the index of every set bit, in order"""
+    for m in _nonzero.finditer(s):
+        base = m.start() << 3
+        for j in set_bits[ord(m.group())]:
+            yield base + j
+
+def first_set(s):
+    """returns the index of the first set bit, or None"""
+    m = _nonzero.search(s)
+    if m is None:
+        return None
+    return (m.start() << 3) + set_bits[ord(m.group())][0]
+############################################################################
+
 class Bitfield:
 
     def __init__(self, length, bitstring=None):
@@ -79,6 +137,30 @@ class Bitfield:
         else:
             return self.bits.tostring()
 
+    def count(self):
+        return self.length - self.numfalse
+
+    def __and__(self, other):
+        return Bitfield(self.length,
+                        bits_and(self.tostring(), other.tostring()))
+
+    def __or__(self, other):
+        return Bitfield(self.length,
+                        bits_or(self.tostring(), other.tostring()))
+
+    def andnot(self, other):
+        return Bitfield(self.length,
+                        bits_andnot(self.tostring(), other.tostring()))
+
+    def iter_set(self):
+        if self.bits is None:
+            return iter(xrange(self.length))
+        return iter_set(self.bits.tostring())
+
+    def first_in(self, mask):
+        """returns the first index set in both self and mask, or None"""
+        return first_set(bits_and(self.tostring(), mask.tostring()))
+
     def __getstate__(self):
         d = {}
         d['length'] = self.length
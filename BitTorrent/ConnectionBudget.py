@@ -0,0 +1,142 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A process-wide limit on peer connections, shared out among the running
+# torrents of a MultiTorrent.
+#
+# Every torrent gets a small floor so it can find peers at all, and the rest
+# goes by demand: peers interested in either direction, upload rate, and for
+# a seed, how many of its peers are leechers. Torrents which end up with more
+# connections than their allocation have their idle ones closed.
+
+from __future__ import division
+
+import logging
+
+# connections every running torrent gets, budget permitting
+MIN_ALLOCATION = 2
+# upload rate (B/s) which counts as much as one interested peer
+RATE_UNIT = 4096
+
+
+def allocate(budget, demands, cap):
+    """Splits budget slots among demands ({key: demand > 0}) in proportion,
+       at most cap each. Returns {key: slots}."""
+    if not demands:
+        return {}
+    floor = min(MIN_ALLOCATION, budget // len(demands), cap)
+    alloc = dict.fromkeys(demands, floor)
+    left = budget - floor * len(demands)
+    active = [k for k in demands if floor < cap]
+    while left > 0 and active:
+        total = sum([demands[k] for k in active])
+        given = 0
+        remaining = []
+        for k in active:
+            share = min(int(left * demands[k] / total), cap - alloc[k])
+            alloc[k] += share
+            given += share
+            if alloc[k] < cap:
+                remaining.append(k)
+        if given == 0:
+            # rounding left less than one slot each, the rest go to the
+            # neediest
+            remaining.sort(key=lambda k: -demands[k])
+            for k in remaining[:left]:
+                alloc[k] += 1
+                given += 1
+            remaining = [k for k in remaining if alloc[k] < cap]
+        left -= given
+        active = remaining
+    return alloc
+
+
+class ConnectionBudget(object):
+
+    def __init__(self, config, schedule, get_torrents):
+        """@param get_torrents: returns the running Torrents."""
+        self.config = config
+        self.schedule = schedule
+        self.get_torrents = get_torrents
+        self.allocations = {}
+        self.evicted = 0
+        self.shutting_down = False
+        self.logger = logging.getLogger("core.ConnectionBudget")
+        schedule(self.config['connection_budget_interval'], self._rebalance_loop)
+
+    def shutdown(self):
+        self.shutting_down = True
+
+    def _rebalance_loop(self):
+        if self.shutting_down:
+            return
+        self.schedule(self.config['connection_budget_interval'],
+                      self._rebalance_loop)
+        self.rebalance()
+
+    def _cap(self):
+        return max(self.config['max_initiate'], self.config['max_allow_in'])
+
+    def _demand(self, torrent, usage):
+        d = 1 + usage['interested'] + usage['uprate'] / RATE_UNIT
+        if torrent.finflag.isSet():
+            # connected seeds are no use to a seed
+            peers = usage['seeds'] + usage['leechers']
+            d *= (usage['leechers'] + 1) / (peers + 1)
+        return d
+
+    def rebalance(self):
+        budget = self.config['max_connections']
+        torrents = self.get_torrents()
+        if not budget:
+            if self.allocations:
+                for t in torrents:
+                    t.set_connection_limit(None)
+                self.allocations = {}
+            return
+
+        usage = {}
+        demands = {}
+        for t in torrents:
+            u = t.get_connection_usage()
+            if u is None:
+                continue
+            usage[t.infohash] = t
+            demands[t.infohash] = self._demand(t, u)
+
+        self.allocations = allocate(budget, demands, self._cap())
+        for infohash, t in usage.iteritems():
+            n = t.set_connection_limit(self.allocations[infohash])
+            if n:
+                self.evicted += n
+                t.logger.debug("evicted %d idle connections, allocation %d",
+                               n, self.allocations[infohash])
+
+    def torrent_started(self, torrent):
+        """Gives a newly started torrent its share of what's left until the
+           next rebalance."""
+        budget = self.config['max_connections']
+        if not budget:
+            return
+        running = set([t.infohash for t in self.get_torrents()])
+        running.add(torrent.infohash)
+        used = 0
+        for infohash, n in self.allocations.iteritems():
+            if infohash in running and infohash != torrent.infohash:
+                used += n
+        n = min(budget - used, budget // len(running), self._cap())
+        self.allocations[torrent.infohash] = max(0, n)
+        torrent.set_connection_limit(self.allocations[torrent.infohash])
+
+    def get_allocation(self, infohash):
+        return self.allocations.get(infohash)
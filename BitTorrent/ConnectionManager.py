@@ -26,10 +26,9 @@ from BitTorrent.Connector import Connector
 from BitTorrent.HTTPConnector import HTTPConnector
 from BitTorrent.LocalDiscovery import LocalDiscovery
 from BitTorrent.InternetWatcher import InternetSubscriber
-from BTL.DictWithLists import DictWithInts, OrderedDict
+from BTL.DictWithLists import DictWithInts, RandomDict
 from BTL.platform import bttime
 from BTL.rand_tools import iter_rand_pos
-import random
 import logging
 import urlparse
 
@@ -200,19 +199,35 @@ class ConnectionManager(InternetSubscriber):
         # we do a lot of itterating and few mutations, so use a list
         self.complete_connectors = [] # set()
 
-        # use a dict for a little semi-randomness        
-        self.spares = {} # OrderedDict()
-        self.cached_peers = OrderedDict()
+        # spares come back out in random order, and a random cached peer
+        # can be picked without building a list of them all
+        self.spares = RandomDict()
+        self.cached_peers = RandomDict()
+        # cached peers which aren't complete, the first to be evicted
+        self.cached_incomplete = set()
         self.cache_limit = 300
+        # share of the MultiTorrent's connection budget, None if unlimited
+        self.connection_limit = None
 
+        # complete connectors
         self.connector_ips = DictWithInts()
         self.connector_ids = DictWithInts()
 
+        # all of self.connectors, for admission checks. incoming connectors
+        # are indexed by id as soon as their handshake gives it
+        self.transport_ips = DictWithInts()
+        self.transport_ids = DictWithInts()
+        self._indexed_ids = {}
+
         self.banned = set()
 
         self._ka_task = self.add_task(config['keepalive_interval'],
                                       self.send_keepalives)
         self._pex_task = None
+        # verified pieces not yet announced, see hashcheck_succeeded
+        self._pending_haves = []
+        self._have_task = None
+        self.have_stats = {'sent': 0, 'suppressed': 0, 'writes': 0}
         if not self.private:
             self._pex_task = self.add_task(config['pex_interval'],
                                            self.send_pex)
@@ -224,21 +239,25 @@ class ConnectionManager(InternetSubscriber):
             self.close_connections()
         del self.context
         self.cached_peers.clear()
+        self.cached_incomplete.clear()
         if self._ka_task.active():
             self._ka_task.cancel()
         if self._pex_task and self._pex_task.active():
             self._pex_task.cancel()
+        if self._have_task and self._have_task.active():
+            self._have_task.cancel()
+        self._pending_haves = []
 
     def reopen(self, port):
         self.closed = False
         self.reported_port = port
         self.unthrottle_connections()
-        for addr in self.cached_peers:
+        for addr in self.cached_peers.keys():
             self._fire_cached_connection(addr)
         self.rawserver.internet_watcher.add_subscriber(self)
 
     def internet_active(self):
-        for addr in self.cached_peers.iterkeys():
+        for addr in self.cached_peers.keys():
             self._fire_cached_connection(addr)
 
     def remove_addr_from_cache(self, addr):
@@ -246,12 +265,12 @@ class ConnectionManager(InternetSubscriber):
         # or could have been dropped by the cache limit
         if addr in self.cached_peers:
             del self.cached_peers[addr]
+            self.cached_incomplete.discard(addr)
 
     def try_one_connection(self):
-        keys = self.cached_peers.keys()
-        if not keys:
+        if not self.cached_peers:
             return False
-        addr = random.choice(keys)
+        addr = self.cached_peers.random_key()
         self._fire_cached_connection(addr)
         return True
 
@@ -270,21 +289,23 @@ class ConnectionManager(InternetSubscriber):
         # obey the cache size limit
         if (addr not in self.cached_peers and
             len(self.cached_peers) >= self.cache_limit):
-            for k, v in self.cached_peers.iteritems():
-                if not v[0]:
-                    del self.cached_peers[k]
-                    break
+            if self.cached_incomplete:
+                oldaddr = self.cached_incomplete.pop()
             else:
                 # cache full of completes, delete a random peer.
                 # yes, this can cache an incomplete when the cache is full of
                 # completes, but only 1 because of the filter above.
-                oldaddr = self.cached_peers.keys()[0]
-                del self.cached_peers[oldaddr]
+                oldaddr = self.cached_peers.random_key()
+            del self.cached_peers[oldaddr]
         elif not complete:
             if addr in self.cached_peers and self.cached_peers[addr][0]:
                 # don't overwrite a complete with an incomplete.
                 return
         self.cached_peers[addr] = (complete, (pid, handler, a, kw))
+        if complete:
+            self.cached_incomplete.discard(addr)
+        else:
+            self.cached_incomplete.add(addr)
 
     def send_keepalives(self):
         self._ka_task = self.add_task(self.config['keepalive_interval'],
@@ -303,10 +324,45 @@ class ConnectionManager(InternetSubscriber):
             c.send_pex(pex_set)
 
     def hashcheck_succeeded(self, i):
+        self._pending_haves.append(i)
+        interval = self.config['have_batch_interval']
+        if interval <= 0:
+            self.send_haves()
+        elif self._have_task is None:
+            self._have_task = self.add_task(interval, self.send_haves)
+
+    def send_haves(self):
+        """Announces the pieces verified since the last call, one write per
+           connection."""
+        self._have_task = None
+        haves = self._pending_haves
+        if not haves:
+            return
+        self._pending_haves = []
+        suppress = self.config['suppress_redundant_haves']
         for c in self.complete_connectors:
             # should we send a have message if peer already has the piece?
-            # yes! it is low bandwidth and useful for that peer.
-            c.send_have(i)
+            # by default yes! it is low bandwidth and useful for that peer.
+            if suppress and c.download is not None:
+                have = c.download.have
+                if have.numfalse == 0:
+                    l = []
+                else:
+                    l = [i for i in haves if not have[i]]
+                self.have_stats['suppressed'] += len(haves) - len(l)
+            else:
+                l = haves
+            if not l:
+                continue
+            if len(l) == 1:
+                c.send_have(l[0])
+            else:
+                c.send_haves(l)
+            self.have_stats['sent'] += len(l)
+            self.have_stats['writes'] += 1
+
+    def get_have_stats(self):
+        return dict(self.have_stats)
 
     def find_connection_in_common(self, addr):
         for c in self.complete_connectors:
@@ -350,18 +406,21 @@ class ConnectionManager(InternetSubscriber):
         if pid == self.my_id:
             return True
 
-        for v in self.connectors:
-            if pid and v.id == pid:
-                return True
-            if self.config['one_connection_per_ip'] and v.ip == addr[0]:
-                return True
+        if pid and pid in self.transport_ids:
+            return True
+        if (self.config['one_connection_per_ip'] and
+            addr[0] in self.transport_ips):
+            return True
 
         total_outstanding = len(self.connectors)
         # it's possible the pending connections could eventually complete,
         # so we have to account for those when enforcing max_initiate
         total_outstanding += len(self.pending_connections)
         
-        if total_outstanding >= self.config['max_initiate']:
+        limit = self.config['max_initiate']
+        if self.connection_limit is not None:
+            limit = min(limit, self.connection_limit)
+        if total_outstanding >= limit:
             self.spares[(addr, pid)] = (handler, a, kw)
             return False
 
@@ -443,6 +502,7 @@ class ConnectionManager(InternetSubscriber):
 
     def connection_handshake_completed(self, connector):
 
+        self._index_id(connector)
         self.connector_ips.add(connector.ip)
         self.connector_ids.add(connector.id)
 
@@ -501,6 +561,43 @@ class ConnectionManager(InternetSubscriber):
             if self.throttled:
                 break
 
+    def get_connection_usage(self):
+        interested = 0
+        seeds = 0
+        for c in self.complete_connectors:
+            if c.upload.interested or c.download.interested:
+                interested += 1
+            if c.download.have.numfalse == 0:
+                seeds += 1
+        return {'connections': (len(self.connectors) +
+                                len(self.pending_connections)),
+                'interested': interested,
+                'seeds': seeds,
+                'leechers': len(self.complete_connectors) - seeds}
+
+    def set_connection_limit(self, n):
+        """Sets the most connections this torrent may have, None for no
+           limit beyond max_initiate and max_allow_in. Closes idle
+           connections which are over the new limit, and returns how many."""
+        old = self.connection_limit
+        self.connection_limit = n
+        if n is None or (old is not None and n > old):
+            self.replace_connection()
+            return 0
+        excess = len(self.connectors) + len(self.pending_connections) - n
+        closed = 0
+        for c in self.complete_connectors:
+            if closed >= excess:
+                break
+            if c.closed or c.upload.interested or c.download.interested:
+                continue
+            if c.ip in self.tracker_ips:
+                continue
+            c.connection.close()
+            c.closed = True
+            closed += 1
+        return closed
+
     def close_connection(self, id):
         for c in self.connectors:
             if c.id == id and not c.closed:
@@ -531,6 +628,10 @@ class ConnectionManager(InternetSubscriber):
         if (m and len(self.connectors) >= m and 
             connector.ip not in self.tracker_ips):
             return False
+        if (self.connection_limit is not None and
+            len(self.connectors) >= self.connection_limit and
+            connector.ip not in self.tracker_ips):
+            return False
         self._add_connection(connector)
         if self.closed:
             return False
@@ -540,18 +641,33 @@ class ConnectionManager(InternetSubscriber):
 
     def _add_connection(self, connector):
         self.connectors.add(connector)
+        self.transport_ips.add(connector.ip)
+        self._index_id(connector)
 
         if self.closed:
             connector.connection.close()
         elif self.throttled:
             connector.connection.pause_reading()
 
+    def connector_id_received(self, connector):
+        """The handshake gave an incoming connector's peer id."""
+        self._index_id(connector)
+
+    def _index_id(self, connector):
+        if connector.id and connector not in self._indexed_ids:
+            self._indexed_ids[connector] = connector.id
+            self.transport_ids.add(connector.id)
+
     def ban(self, ip):
         self.banned.add(ip)
 
     def connection_lost(self, connector):
         assert isinstance(connector, Connector)
         self.connectors.remove(connector)
+        self.transport_ips.remove(connector.ip)
+        id = self._indexed_ids.pop(connector, None)
+        if id is not None:
+            self.transport_ids.remove(id)
 
         if self.ratelimiter:
             self.ratelimiter.dequeue(connector)
@@ -601,6 +717,8 @@ class SingleportListener(Handler):
         self.ld_services = {}
         self.use_local_discovery = use_local_discovery
         self._creating_local_discovery = False
+        # key the next adopted connection already answered with
+        self._handoff_key = None
         self.log_prefix = log_prefix
         self.logger = logging.getLogger(self.log_prefix)
 
@@ -733,8 +851,24 @@ class SingleportListener(Handler):
             return
         connector = Connector(self, connection, None, False,
                               log_prefix=self.log_prefix)
+        if self._handoff_key is not None:
+            connector.handed_off(self._handoff_key)
         self.connectors.add(connector)
 
+    def adopt_connection(self, sock, data, privkey=None):
+        """Takes over an incoming connection accepted by another process.
+           data is what it read from the connection, and privkey the key
+           it answered an encrypted handshake with, if it did."""
+        if not self.port:
+            sock.close()
+            return
+        serversocket = self.ports[self.port][0]
+        self._handoff_key = privkey
+        try:
+            self.rawserver.adopt_connection(serversocket, sock, data)
+        finally:
+            self._handoff_key = None
+
     def select_torrent(self, connector, infohash):
         """Called when infohash has been received allowing us to map
            the connection on to a given Torrent's ConnectionManager."""
@@ -27,21 +27,24 @@ log_data = False
 # for crypto
 from random import randrange
 from BTL.hash import sha
-from Crypto.Cipher import ARC4
+from BitTorrent.MSECrypto import get_provider as get_crypto
+from BitTorrent.MSECrypto import DH_BYTES
 # urandom comes from obsoletepythonsupport
 
 import struct
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from cStringIO import StringIO
 
 from BTL.bencode import bencode, bdecode
-from BitTorrent.RawServer_twisted import Handler
+from BTL.defer import Deferred
+from BitTorrent.RawServer_twisted import Handler, split_segments
 from BTL.bitfield import Bitfield
 from BTL import IPTools
 from BTL.obsoletepythonsupport import *
 from BitTorrent.ClientIdentifier import identify_client
 from BTL.platform import app_name
 from BitTorrent import version
+import BitTorrent.Upload
 import logging
 
 def toint(s):
@@ -144,16 +147,11 @@ FLAGS[7] = chr( LAST_BYTE )
 FLAGS = ''.join(FLAGS)
 protocol_name = 'BitTorrent protocol'
 
+# yielded by _read_messages once the handshake is done
+FRAMED = -1
+
 # for crypto
-dh_prime = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A63A36210000000000090563
 PAD_MAX = 200 # less than protocol maximum, and later assumed to be < 256
-DH_BYTES = 96
-def bytetonum(x):
-    return long(x.encode('hex'), 16)
-def numtobyte(x):
-    x = hex(x).lstrip('0x').rstrip('Ll')
-    x = '0'*(192 - len(x)) + x
-    return x.decode('hex')
 
 if noisy:
     connection_logger = logging.getLogger("BitTorrent.Connector")
@@ -203,10 +201,20 @@ class Connector(Handler):
         self._reader = self._read_messages()
         self._next_len = self._reader.next()
         self._message = None
+        # the start of a message split across chunks, once framing
+        self._rbuf = []
+        self._rbuf_len = 0
+        # length with prefix of the message in _rbuf, once that is known
+        self._rbuf_want = 0
+        self._message_count = 0
+        # [segment], the rest of the PIECE messages being sent
         self._partial_message = None
+        self._partial_length = 0
         self._outqueue = StringIO()
         self._decrypt = None
         self._privkey = None
+        # data received while _read_messages waits on a Deferred
+        self._held = None
         self.choke_sent = True
 
         self.uses_utorrent_extension = False
@@ -253,10 +261,8 @@ class Connector(Handler):
 
     def send_handshake(self):
         if self.obfuscate_outgoing:
-            privkey = bytetonum(urandom(20))
-            self._privkey = privkey
-            pubkey = pow(2, privkey, dh_prime)
-            out = numtobyte(pubkey) + urandom(randrange(PAD_MAX))
+            self._privkey, pubkey = get_crypto().get_keypair()
+            out = pubkey + urandom(randrange(PAD_MAX))
             self.connection.write(out)
         else:
             if noisy:
@@ -272,6 +278,11 @@ class Connector(Handler):
             if self.id is not None:
                 self.connection.write(self.parent.my_id)
 
+    def handed_off(self, privkey):
+        """This incoming connection was accepted by another process, which
+           answered its encrypted handshake with privkey's public key."""
+        self._privkey = privkey
+
     def set_parent(self, parent):
         self.parent = parent
         self.max_message_length = self.parent.config['max_message_length']
@@ -320,6 +331,14 @@ class Connector(Handler):
     def send_cancel(self, index, begin, length):
         self._send_message(pack("!ciii", CANCEL, index, begin, length))
 
+    def send_cancels(self, requests):
+        if self.closed:
+            return
+        if noisy:
+            log("SEND %s x%d" % (message_dict[CANCEL], len(requests)))
+        self._write(''.join([pack("!iciii", 13, CANCEL, index, begin, length)
+                             for index, begin, length in requests]))
+
     def send_bitfield(self, bitfield):
         if noisy:
             log("SEND %s" % message_dict[BITFIELD])
@@ -330,6 +349,13 @@ class Connector(Handler):
             log("SEND %s" % message_dict[HAVE])
         self._send_message(pack("!ci", HAVE, index))
 
+    def send_haves(self, indices):
+        if self.closed:
+            return
+        if noisy:
+            log("SEND %s x%d" % (message_dict[HAVE], len(indices)))
+        self._write(''.join([pack("!ici", 5, HAVE, i) for i in indices]))
+
     def send_have_all(self):
         assert(self.uses_fast_extension)
         if noisy:
@@ -397,20 +423,26 @@ class Connector(Handler):
         if self._partial_message is None and not self.upload.buffer:
             return 0
         if self._partial_message is None:
-            buf = StringIO()
-            while self.upload.buffer and buf.tell() < bytes:
+            # headers and pieces stay separate segments all the way to the
+            # socket, the payload is never copied into a message string
+            segments = []
+            total = 0
+            while self.upload.buffer and total < bytes:
                 t, piece = self.upload.buffer.pop(0)
                 index, begin, length = t
-                msg = pack("!icii%s" % len(piece), len(piece) + 9, PIECE,
-                           index, begin)
-                buf.write(msg)
-                buf.write(piece)
+                segments.append(pack("!icii", len(piece) + 9, PIECE,
+                                     index, begin))
+                segments.append(piece)
+                total += 13 + len(piece)
                 if noisy: log("SEND PIECE %d %d" % (index, begin))
-            self._partial_message = buf.getvalue()
-        if bytes < len(self._partial_message):
+            self._partial_message = segments
+            self._partial_length = total
+        if bytes < self._partial_length:
             self.fire_sent_listeners(bytes)
-            self.connection.write(buffer(self._partial_message, 0, bytes))
-            self._partial_message = buffer(self._partial_message, bytes)
+            head, self._partial_message = split_segments(
+                self._partial_message, bytes)
+            self._partial_length -= bytes
+            self.connection.write_sequence(head)
             return bytes
         if self.choke_sent != self.upload.choked:
             if self.upload.choked:
@@ -419,19 +451,21 @@ class Connector(Handler):
             else:
                 self._outqueue.write(pack("!ic", 1, UNCHOKE))
             self.choke_sent = self.upload.choked
-        buf = StringIO()
-        buf.write(self._partial_message)
+        segments = self._partial_message
+        total = self._partial_length
         self._partial_message = None
-        buf.write(self._outqueue.getvalue())
-        # optimize for cpu (reduce mallocs)
-        #self._outqueue.truncate(0)
-        # optimize for memory (free buffer memory)
-        self._outqueue.close()
-        self._outqueue = StringIO()
-        queue = buf.getvalue()
-        self.fire_sent_listeners(len(queue))
-        self.connection.write(queue)
-        return len(queue)
+        queue = self._outqueue.getvalue()
+        if queue:
+            segments.append(queue)
+            total += len(queue)
+            # optimize for cpu (reduce mallocs)
+            #self._outqueue.truncate(0)
+            # optimize for memory (free buffer memory)
+            self._outqueue.close()
+            self._outqueue = StringIO()
+        self.fire_sent_listeners(total)
+        self.connection.write_sequence(segments)
+        return total
 
     # yields the number of bytes it wants next, gets those in self._message
     def _read_messages(self):
@@ -446,24 +480,27 @@ class Connector(Handler):
                 dhstr = self._message
                 yield DH_BYTES - len(dhstr)
                 dhstr += self._message
-                pub = bytetonum(dhstr)
-                S = numtobyte(pow(pub, self._privkey, dh_prime))
-                pub = self._privkey = dhstr = None
+                crypto = get_crypto()
+                yield crypto.shared_secret(dhstr, self._privkey)
+                S = self._message
+                self._privkey = dhstr = None
                 SKEY = self.parent.infohash
                 x = sha('req3' + S).digest()
                 streamid = sha('req2'+SKEY).digest()
                 streamid = ''.join([chr(ord(streamid[i]) ^ ord(x[i]))
                                     for i in range(20)])
-                encrypt = ARC4.new(sha('keyA' + S + SKEY).digest()).encrypt
-                encrypt('x'*1024)
+                cipher = crypto.new_rc4(sha('keyA' + S + SKEY).digest())
+                cipher.discard(1024)
+                encrypt = cipher.encrypt
                 padlen = randrange(PAD_MAX)
                 x = sha('req1' + S).digest() + streamid + encrypt(
                     '\x00'*8 + '\x00'*3+'\x02'+'\x00'+chr(padlen)+
                     urandom(padlen)+'\x00\x00')
                 self.connection.write(x)
                 self.connection.encrypt = encrypt
-                decrypt = ARC4.new(sha('keyB' + S + SKEY).digest()).decrypt
-                decrypt('x'*1024)
+                cipher = crypto.new_rc4(sha('keyB' + S + SKEY).digest())
+                cipher.discard(1024)
+                decrypt = cipher.decrypt
                 VC = decrypt('\x00'*8) # actually encrypt
                 x = ''
                 while 1:
@@ -495,11 +532,16 @@ class Connector(Handler):
                 dhstr = self._message
                 yield DH_BYTES - len(dhstr)
                 dhstr += self._message
-                privkey = bytetonum(urandom(20))
-                pub = numtobyte(pow(2, privkey, dh_prime))
-                self.connection.write(''.join((pub, urandom(randrange(PAD_MAX)))))
-                pub = bytetonum(dhstr)
-                S = numtobyte(pow(pub, privkey, dh_prime))
+                crypto = get_crypto()
+                if self._privkey is not None:
+                    # our half went out before the connection was handed off
+                    privkey = self._privkey
+                    self._privkey = None
+                else:
+                    privkey, pub = crypto.get_keypair()
+                    self.connection.write(''.join((pub, urandom(randrange(PAD_MAX)))))
+                yield crypto.shared_secret(dhstr, privkey)
+                S = self._message
                 dhstr = pub = privkey = None
                 streamid = sha('req1' + S).digest()
                 x = ''
@@ -528,8 +570,9 @@ class Connector(Handler):
                     self.log_prefix + '.' + repr(self.parent.infohash) +
                     '.peer_id_not_yet')
                 SKEY = self.parent.infohash
-                decrypt = ARC4.new(sha('keyA' + S + SKEY).digest()).decrypt
-                decrypt('x'*1024)
+                cipher = crypto.new_rc4(sha('keyA' + S + SKEY).digest())
+                cipher.discard(1024)
+                decrypt = cipher.decrypt
                 s = decrypt(self._message[20:34])
                 if s[0:8] != '\x00' * 8:
                     self.protocol_violation('BAD VC')
@@ -542,8 +585,9 @@ class Connector(Handler):
                 self._decrypt = decrypt
                 yield padlen + 2
                 s = self._message
-                encrypt = ARC4.new(sha('keyB' + S + SKEY).digest()).encrypt
-                encrypt('x'*1024)
+                cipher = crypto.new_rc4(sha('keyB' + S + SKEY).digest())
+                cipher.discard(1024)
+                encrypt = cipher.encrypt
                 self.connection.encrypt = encrypt
                 if not crypto_provide & 2:
                     self.protocol_violation("peer doesn't support crypto mode 2")
@@ -616,6 +660,7 @@ class Connector(Handler):
             if self.id == self.parent.my_id:
                 #self.protocol_violation("talking to self")
                 return
+            self.parent.connector_id_received(self)
 
             if self.id in self.parent.connector_ids:
                 if self.parent.my_id > self.id:
@@ -643,6 +688,7 @@ class Connector(Handler):
                         'v': ('%s %s' % (app_name, version)).encode('utf8'),
                         'e': 0,
                         'p': self.parent.reported_port,
+                        'reqq': BitTorrent.Upload.MAX_REQUESTS,
                         }
             response = bencode(response)
             self._send_message(UTORRENT_MSG,
@@ -651,22 +697,9 @@ class Connector(Handler):
         self.complete = True
         self.parent.connection_handshake_completed(self)
 
-        message_count = 0
-        while True:
-            yield 4   # message length
-            l = toint(self._message)
-            if l > self.max_message_length:
-                d = '%s%s' % (self._message, self._rest)
-                d = d[:10]
-                self.protocol_violation("message length exceeds max "
-                                        "(%s > %s): %r, count:%d" %
-                                        (l, self.max_message_length, d,
-                                         message_count))
-                return
-            if l > 0:
-                yield l
-                self._got_message(self._message)
-                message_count += 1
+        # the rest of the stream is length-prefixed messages, which
+        # data_came_in frames itself
+        yield FRAMED
 
     def _got_utorrent_msg(self, msg_type, d):
         if msg_type == UTORRENT_MSG_INFO:
@@ -675,6 +708,11 @@ class Connector(Handler):
             if port:
                 self.listening_port = int(port)
             encryption = d.get('e')
+            reqq = d.get('reqq')
+            if (isinstance(reqq, (int, long)) and reqq > 0 and
+                self.download is not None):
+                # how many requests it will queue up from us
+                self.download.window.set_max_window(reqq)
             messages = d.get('m')
             if 'ut_pex' in messages:
                 self.uses_utorrent_pex = True
@@ -741,7 +779,7 @@ class Connector(Handler):
             self._got_azureus_msg(msg_type, d)
             return
         if t == HOLE_PUNCH and self.uses_nat_traversal:
-            d = ebdecode(message)
+            d = ebdecode(str(message))
             if noisy: log("HOLE_PUNCH: %r" % d)
             self._got_holepunch_msg(d)
             return
@@ -839,8 +877,9 @@ class Connector(Handler):
                                         len(message))
                 self.close()
                 return
-            n = len(message) - 9
-            i, a, b = unpack("!xii%ss" % n, message)
+            i, a = unpack("!xii", message[:9])
+            # a view, not a copy. the storage copies it if it holds on to it
+            b = buffer(message, 9)
             if noisy: log("GOT PIECE %d %d" % (i, a))
             if i >= self.parent.numpieces:
                 self.protocol_violation("PIECE %d >= %d" %
@@ -948,6 +987,80 @@ class Connector(Handler):
         s = ''.join(d)
         self._write(s)
 
+    def _check_length(self, l, d):
+        if l < 0:
+            self.protocol_violation("negative message length %d: %r, "
+                                    "count:%d" % (l, str(d)[:10],
+                                                  self._message_count))
+            self.close()
+            return False
+        if l > self.max_message_length:
+            self.protocol_violation("message length exceeds max "
+                                    "(%s > %s): %r, count:%d" %
+                                    (l, self.max_message_length, str(d)[:10],
+                                     self._message_count))
+            self.close()
+            return False
+        return True
+
+    def _frame_messages(self, s):
+        # Hands every complete message in s to _got_message as a view on s,
+        # so PIECE payloads reach the storage without a copy. Only a message
+        # split across chunks is copied, once, when its last part arrives.
+        pos = 0
+        total = len(s)
+        rbuf = self._rbuf
+        if rbuf:
+            if self._rbuf_len < 4:
+                n = min(4 - self._rbuf_len, total)
+                rbuf.append(s[:n])
+                self._rbuf_len += n
+                pos = n
+                if self._rbuf_len < 4:
+                    return
+                rbuf[:] = [''.join(rbuf)]
+                l = toint(rbuf[0])
+                if not self._check_length(l, rbuf[0] + s[pos:pos+6]):
+                    return
+                self._rbuf_want = 4 + l
+            want = self._rbuf_want
+            n = min(want - self._rbuf_len, total - pos)
+            rbuf.append(s[pos:pos+n])
+            self._rbuf_len += n
+            pos += n
+            if self._rbuf_len < want:
+                return
+            m = ''.join(rbuf)
+            del rbuf[:]
+            self._rbuf_len = 0
+            if want > 4:
+                self._message_count += 1
+                self._got_message(buffer(m, 4))
+                if self.closed:
+                    return
+
+        while total - pos >= 4:
+            l = unpack_from("!i", s, pos)[0]
+            if not self._check_length(l, buffer(s, pos, 14)):
+                return
+            if total - pos - 4 < l:
+                # checked already, the rest comes in later chunks
+                self._rbuf_want = 4 + l
+                break
+            if l > 0:
+                self._message_count += 1
+                self._got_message(buffer(s, pos + 4, l))
+                if self.closed:
+                    return
+            pos += 4 + l
+
+        if pos < total:
+            if pos == 0:
+                rbuf.append(s)
+            else:
+                rbuf.append(s[pos:])
+            self._rbuf_len = total - pos
+
     def data_came_in(self, conn, s):
         self.received_data = True
         if not self.download:
@@ -962,6 +1075,21 @@ class Connector(Handler):
             assert self.addr == (conn.ip, conn.port)
             open('%s_%d.log' % self.addr, 'ab').write(s)
 
+        self._process_data(s)
+
+    def _process_data(self, s):
+        if self.closed:
+            return
+        if self._held is not None:
+            # waiting on the key agreement
+            self._held.append(str(s))
+            return
+        if self._reader is None:
+            if self._decrypt is not None:
+                s = self._decrypt(s)
+            self._frame_messages(s)
+            return
+
         while True:
             if self.closed:
                 return
@@ -987,17 +1115,56 @@ class Connector(Handler):
                 m = self._decrypt(m)
             self._message = m
             self._rest = s
-            try:
-                self._next_len = self._reader.next()
-            except StopIteration:
-                self.close()
-                return
-            except:
-                self.protocol_violation("Message parsing failed")
-                self.logger.exception("Message parsing failed")
-                self.close()
+            if not self._next_message(s):
                 return
 
+    def _next_message(self, s):
+        """Resumes _read_messages with self._message. Returns False if the
+           rest of the data, s, has been dealt with."""
+        try:
+            self._next_len = self._reader.next()
+        except StopIteration:
+            self.close()
+            return False
+        except:
+            self.protocol_violation("Message parsing failed")
+            self.logger.exception("Message parsing failed")
+            self.close()
+            return False
+        if isinstance(self._next_len, Deferred):
+            # hold on to anything else which comes in until it fires
+            self._held = [str(s)]
+            self._next_len.addCallbacks(self._reader_resumed,
+                                        self._reader_failed)
+            return False
+        if self._next_len == FRAMED:
+            self._reader = None
+            if self.closed:
+                return False
+            s = str(s)
+            if self._decrypt is not None:
+                s = self._decrypt(s)
+            self._frame_messages(s)
+            return False
+        return True
+
+    def _reader_resumed(self, r):
+        if self.closed:
+            return
+        s = ''.join(self._held)
+        self._held = None
+        self._message = r
+        self._rest = s
+        if self._next_message(s):
+            self._process_data(s)
+
+    def _reader_failed(self, f):
+        if self.closed:
+            return
+        self.protocol_violation("Key agreement failed")
+        self.logger.error("Key agreement failed", exc_info=f.exc_info())
+        self.close()
+
     def _optional_restart(self):
         if (self.locally_initiated and not self.received_data and
             not self.obfuscate_outgoing):
@@ -1018,6 +1185,7 @@ class Connector(Handler):
             self.upload = None
             self.download = None
         del self._buffer
+        del self._rbuf
         del self.parent
         self._sent_listeners.clear()
         del self._message
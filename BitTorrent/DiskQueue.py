@@ -0,0 +1,176 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A disk op queue for the FilePool threads.
+#
+# Ops are served by priority (upload reads, then writes, then background
+# reads like hash checks), but not strictly: while several priorities have
+# ops waiting they share the disk threads in the ratio of PRIORITY_WEIGHTS,
+# so a seeder busy with uploads still gets its writes and hash checks done,
+# just more slowly. Within a priority, torrents take turns so one greedy
+# torrent can't starve the rest, and each torrent's ops are served in
+# (file, offset) order with a one-way elevator sweep, which turns a pile of
+# random reads into mostly sequential ones.
+
+import time
+from Queue import Empty
+from bisect import insort, bisect_left
+from BTL.Lists import QList
+import BTL.stackthreading as threading
+
+PRIORITY_READ = 0
+PRIORITY_WRITE = 1
+PRIORITY_BACKGROUND = 2
+NUM_PRIORITIES = 3
+
+PRIORITY_NAMES = ('read', 'write', 'background')
+PRIORITY_WEIGHTS = (4, 2, 1)
+
+# latency histogram buckets, in seconds. the last bucket is everything slower.
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+class _Elevator(object):
+    """One torrent's pending ops at one priority, kept sorted by position."""
+
+    __slots__ = ('ops', 'head')
+
+    def __init__(self):
+        self.ops = []
+        self.head = None
+
+    def put(self, key, item):
+        insort(self.ops, (key, item))
+
+    def get(self):
+        # the next op at or after the last one served, wrapping around to
+        # the start of the torrent when the sweep runs off the end
+        i = 0
+        if self.head is not None:
+            i = bisect_left(self.ops, (self.head,))
+            if i == len(self.ops):
+                i = 0
+        key, item = self.ops.pop(i)
+        self.head = key
+        return item
+
+    def __len__(self):
+        return len(self.ops)
+
+
+class _Level(object):
+
+    __slots__ = ('elevators', 'turns', 'depth', 'histogram', 'weight',
+                 'credit')
+
+    def __init__(self, weight):
+        self.weight = weight
+        # ops left to this level in the current cycle
+        self.credit = weight
+        self.elevators = {}
+        # torrents with pending ops, in round-robin order
+        self.turns = QList()
+        self.depth = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+class DiskQueue(object):
+    """A Queue.Queue-alike. Items put without a torrent go to the front,
+       which is what FilePool.finalize wants."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.control = QList()
+        self.levels = [ _Level(w) for w in PRIORITY_WEIGHTS ]
+        self.seq = 0
+
+    def put(self, item, torrent=None, filename=None, pos=0,
+            priority=PRIORITY_READ):
+        self.cond.acquire()
+        try:
+            if torrent is None and filename is None:
+                self.control.append(item)
+            else:
+                level = self.levels[priority]
+                e = level.elevators.get(torrent)
+                if e is None:
+                    e = level.elevators[torrent] = _Elevator()
+                if len(e) == 0:
+                    level.turns.append(torrent)
+                # seq keeps ops on the same spot in arrival order
+                self.seq += 1
+                e.put((filename, pos, self.seq), (time.time(), item))
+                level.depth += 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def get(self, block=True):
+        self.cond.acquire()
+        try:
+            while True:
+                if self.control:
+                    return self.control.popleft()
+                level = self._next_level()
+                if level is not None:
+                    return self._get(level)
+                if not block:
+                    raise Empty
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def _next_level(self):
+        for refill in (False, True):
+            if refill:
+                # every level with ops waiting has had its share
+                for level in self.levels:
+                    level.credit = level.weight
+            for level in self.levels:
+                if level.depth > 0 and level.credit > 0:
+                    level.credit -= 1
+                    return level
+        return None
+
+    def _get(self, level):
+        torrent = level.turns.popleft()
+        e = level.elevators[torrent]
+        queued, item = e.get()
+        if len(e) > 0:
+            level.turns.append(torrent)
+        else:
+            del level.elevators[torrent]
+        level.depth -= 1
+        wait = time.time() - queued
+        i = bisect_left(LATENCY_BUCKETS, wait)
+        level.histogram[i] += 1
+        return item
+
+    def qsize(self):
+        return len(self.control) + sum([l.depth for l in self.levels])
+
+    def get_stats(self):
+        """Returns {priority name: {'depth': n, 'latency': [(limit, count)]}}.
+           The last latency limit is None, meaning anything slower."""
+        self.cond.acquire()
+        try:
+            r = {}
+            limits = list(LATENCY_BUCKETS) + [None]
+            for name, level in zip(PRIORITY_NAMES, self.levels):
+                r[name] = {'depth': level.depth,
+                           'torrents': len(level.elevators),
+                           'latency': zip(limits, level.histogram)}
+            return r
+        finally:
+            self.cond.release()
@@ -0,0 +1,180 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Once every block has been requested, the blocks still outstanding are
+# requested from more peers so a slow one doesn't hold up the finish.
+#
+# Each block is mapped to the downloads it is outstanding on, so a block
+# coming in touches only the peers which had asked for it: they get a
+# CANCEL, and a chance to request something else. Blocks are also kept by
+# piece, so a peer looks only through the pieces it has. CANCELs to one
+# connection are sent as one write at the end of the reactor tick. A block
+# is requested from at most max_duplicates peers at once (0 for no limit).
+
+import random
+
+
+class Endgame(object):
+
+    def __init__(self, add_task, max_duplicates=0):
+        self.add_task = add_task
+        self.max_duplicates = max_duplicates
+        # (index, begin, length) -> set of Downloads it is outstanding on
+        self.requests = {}
+        # index -> its blocks in requests
+        self.pieces = {}
+        self.pending_cancels = {}
+        self.cancel_task = None
+        self.stats = {'cancels': 0, 'writes': 0, 'duplicates': 0}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, req):
+        return req in self.requests
+
+    def __iter__(self):
+        return iter(self.requests)
+
+    def start(self, downloads):
+        for d in downloads:
+            for req in d.active_requests:
+                self.add(req)
+                self.requests[req].add(d)
+
+    def add(self, req):
+        if req not in self.requests:
+            self.requests[req] = set()
+            self.pieces.setdefault(req[0], []).append(req)
+
+    def _remove(self, req):
+        holders = self.requests.pop(req)
+        blocks = self.pieces[req[0]]
+        blocks.remove(req)
+        if not blocks:
+            del self.pieces[req[0]]
+        return holders
+
+    def wants_any(self, have):
+        """Whether a peer with bitfield have has any block we need."""
+        for index in self.pieces:
+            if have[index]:
+                return True
+        return False
+
+    def wanted_by(self, download, n):
+        """Up to n blocks download may be asked for, least requested
+           first."""
+        have = download.have
+        active = download.active_requests
+        max_duplicates = self.max_duplicates
+        # blocks by how many peers they are outstanding on
+        by_holders = [[]]
+        for index, blocks in self.pieces.iteritems():
+            if not have[index]:
+                continue
+            for req in blocks:
+                if req in active:
+                    continue
+                k = len(self.requests[req])
+                if max_duplicates and k >= max_duplicates:
+                    continue
+                if k == 0:
+                    by_holders[0].append(req)
+                    if len(by_holders[0]) == n:
+                        # no one has these, so there's nothing to spread
+                        return by_holders[0]
+                    continue
+                while len(by_holders) <= k:
+                    by_holders.append([])
+                by_holders[k].append(req)
+        want = []
+        for reqs in by_holders:
+            if len(want) + len(reqs) >= n:
+                # different peers take different duplicates
+                want.extend(random.sample(reqs, n - len(want)))
+                break
+            want.extend(reqs)
+        return want
+
+    def request_sent(self, download, req):
+        holders = self.requests[req]
+        if holders:
+            self.stats['duplicates'] += 1
+        holders.add(download)
+
+    def received(self, req, download):
+        """Returns False if the block had already come in from someone
+           else."""
+        if req not in self.requests:
+            return False
+        holders = self._remove(req)
+        holders.discard(download)
+        for d in holders:
+            if not d.choked and req in d.active_requests:
+                d.active_requests.remove(req)
+                self._cancel(d, req)
+                if d.connector.uses_fast_extension:
+                    d.expecting_reject.add(req)
+        if not self.requests:
+            # nothing left to want, let every peer know
+            for d in download.multidownload.downloads:
+                d.fix_download_endgame()
+            return True
+        download.fix_download_endgame()
+        for d in holders:
+            d.fix_download_endgame()
+        return True
+
+    def dropped(self, download, reqs, downloads):
+        """download no longer has reqs outstanding: choked, rejected or
+           gone. Blocks the other peers can now take go to them."""
+        freed = False
+        for req in reqs:
+            holders = self.requests.get(req)
+            if holders is None or download not in holders:
+                continue
+            holders.remove(download)
+            # a block at max_duplicates has a slot again
+            if (not holders or
+                len(holders) == self.max_duplicates - 1):
+                freed = True
+        if freed:
+            for d in downloads:
+                if d is not download:
+                    d.fix_download_endgame()
+
+    def piece_failed(self, reqs, downloads):
+        for req in reqs:
+            self.add(req)
+        for d in downloads:
+            d.fix_download_endgame()
+
+    def _cancel(self, download, req):
+        self.pending_cancels.setdefault(download, []).append(req)
+        if self.cancel_task is None:
+            self.cancel_task = self.add_task(0, self.send_cancels)
+
+    def send_cancels(self):
+        self.cancel_task = None
+        pending = self.pending_cancels
+        self.pending_cancels = {}
+        for d, reqs in pending.iteritems():
+            if d.connector.closed:
+                continue
+            d.connector.send_cancels(reqs)
+            self.stats['cancels'] += len(reqs)
+            self.stats['writes'] += 1
+
+    def get_stats(self):
+        return dict(self.stats, outstanding=len(self.requests))
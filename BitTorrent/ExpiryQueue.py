@@ -0,0 +1,109 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Things which expire a fixed time after they were last touched, such as
+# the tracker's peers.
+#
+# Items go in buckets by the time they were last touched, one bucket per
+# granularity seconds, so touching one moves it between two buckets
+# without looking at anything else. Every tick expires the buckets which
+# have come due, oldest first, but no more than max_per_tick items: a
+# backlog is worked off over the following ticks rather than in one long
+# pause, and how far behind that leaves expiry is reported as the lag.
+
+from time import time
+
+
+class ExpiryQueue(object):
+
+    def __init__(self, lifetime, granularity, expire_func, max_per_tick,
+                 clock=time):
+        self.lifetime = lifetime
+        self.granularity = granularity
+        self.expire_func = expire_func
+        self.max_per_tick = max_per_tick
+        self.clock = clock
+        # bucket number: {item: value}
+        self.buckets = {}
+        # the oldest bucket which may have anything in it
+        self.next = self._bucket(clock())
+        self.size = 0
+        self.expired = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def _bucket(self, t):
+        return int(t // self.granularity)
+
+    def add(self, item, value, t):
+        b = self._bucket(t)
+        if b < self.next:
+            # touched before anything left, as when the clock goes back
+            self.next = b
+        bucket = self.buckets.get(b)
+        if bucket is None:
+            bucket = self.buckets[b] = {}
+        bucket[item] = value
+        self.size += 1
+
+    def remove(self, item, t):
+        b = self._bucket(t)
+        bucket = self.buckets[b]
+        del bucket[item]
+        if not bucket:
+            del self.buckets[b]
+        self.size -= 1
+
+    def move(self, item, value, old_t, t):
+        if self._bucket(old_t) == self._bucket(t):
+            return
+        self.remove(item, old_t)
+        self.add(item, value, t)
+
+    def tick(self):
+        now = self.clock()
+        # the last bucket all of whose items are older than lifetime
+        due = self._bucket(now - self.lifetime) - 1
+        if not self.buckets:
+            self.next = max(self.next, due + 1)
+        budget = self.max_per_tick
+        while self.next <= due:
+            bucket = self.buckets.get(self.next)
+            if bucket is None:
+                self.next += 1
+                continue
+            if not budget:
+                break
+            while bucket and budget:
+                item, value = bucket.popitem()
+                self.size -= 1
+                self.expired += 1
+                budget -= 1
+                self.expire_func(item, value)
+            if not bucket:
+                del self.buckets[self.next]
+                self.next += 1
+        if self.next <= due:
+            # what is left in the bucket was due to go this long ago
+            self.lag = now - ((self.next + 1) * self.granularity +
+                              self.lifetime)
+            self.max_lag = max(self.max_lag, self.lag)
+        else:
+            self.lag = 0.0
+
+    def get_stats(self):
+        return {'items': self.size, 'expired': self.expired,
+                'lag': self.lag, 'max_lag': self.max_lag}
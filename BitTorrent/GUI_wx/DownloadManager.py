@@ -609,6 +609,10 @@ class PeerListView(HashableListView):
                         'client_backlog': BTListColumn(_('client req.'),
                                                   1000,
                                                   enabled=VERBOSE),
+                        'rtt': BTListColumn(_('RTT ms'),
+                                            9.999,
+                                            renderer=lambda v: v is not None and '%d' % (v * 1000) or '',
+                                            enabled=VERBOSE),
                         'down_rate': BTListColumn(_('KB/s down'),
                                                   Rate(1024**2 - 1)),
                         'up_rate': BTListColumn(_('KB/s up'),
@@ -629,6 +633,7 @@ class PeerListView(HashableListView):
 
         self.column_order = ['address', 'ip', 'id', 'client', 'completed',
                              'current_backlog', 'max_backlog', 'client_backlog',
+                             'rtt',
                              'client_buffer',
                              'down_rate', 'up_rate', 'down_size', 'up_size',
                              'speed', 'initiation', 'total_eta']
@@ -3688,7 +3693,7 @@ class MainLoop(BasicApp, BTApp):
         tu = 0.0
         td = 0.0
         for infohash, v in rates.iteritems():
-            u, d = v
+            u, d = v[:2]
             if infohash in self.torrents:
                 t = self.torrents[infohash]
                 t.bandwidth_history.update(upload_rate=u, download_rate=d,
@@ -0,0 +1,301 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Upload scheduling as a hierarchical token bucket: a global bucket, then
+# one group per torrent (with an optional bucket of its own), then the
+# connections with data waiting.
+#
+# Groups take turns by deficit round robin, each getting unitsize * weight
+# bytes per turn, and within a group connections take turns sending up to
+# unitsize each. A connection is queued at most once and is taken off the
+# front of its group's queue, so a send step costs O(1) however many
+# connections and groups there are. A group whose own bucket runs dry
+# waits in a heap until it refills, O(log groups).
+#
+# Buckets hold at most burst seconds worth of tokens, and may go into debt
+# by up to one unit since whole units are sent. A limited group is kept
+# while it has nothing to send, bucket and all, until remove_group.
+
+import heapq
+import logging
+from collections import deque
+from BTL.platform import bttime
+
+# bytes sent per pass with no global limit, before letting the reactor run
+UNLIMITED_PASS = 2 ** 20
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, clock):
+        self.clock = clock
+        self.tokens = 0.0
+        self.last = clock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst):
+        """rate <= 0 means unlimited."""
+        if rate <= 0:
+            self.tokens = 0.0
+        self.rate = rate
+        self.depth = max(rate * burst, 1)
+        self.tokens = min(self.tokens, self.depth)
+
+    def refill(self, now):
+        if self.rate > 0 and now > self.last:
+            self.tokens = min(self.depth,
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def ready(self):
+        return self.rate <= 0 or self.tokens > 0
+
+    def time_until_ready(self):
+        if self.ready():
+            return 0
+        return -self.tokens / self.rate
+
+
+class _Group(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.weight = 1
+        self.bucket = None
+        self.conns = deque()
+        self.deficit = 0
+        # stopped by the global bucket partway through its turn
+        self.midturn = False
+        # in the round robin, waiting on its bucket, or neither
+        self.state = None
+
+
+class HTBRateLimiter(object):
+
+    # Since data is sent to peers in a round-robin fashion, max one
+    # full request at a time, setting this higher would send more data
+    # to peers that use request sizes larger than standard 16 KiB.
+    # 17000 instead of 16384 to allow room for metadata messages.
+    max_unitsize = 17000
+
+    def __init__(self, sched, clock=bttime):
+        """@param sched: add_task(delay, func, *args).
+           @param clock: where the time comes from."""
+        self.sched = sched
+        self.clock = clock
+        self.unitsize = self.max_unitsize
+        self.burst = 1.0
+        self.bucket = TokenBucket(0, self.burst, clock)
+        self.groups = {}
+        self.group_params = {}
+        self.ring = deque()
+        self.waiting = []
+        # conn -> (group, ticket). a ticket which doesn't match the one in
+        # the group's queue means the entry there is stale.
+        self.queued = {}
+        self.ticket = 0
+        self.task = None
+        self.task_time = None
+        self.running = False
+        self.logger = logging.getLogger("core.HTBRateLimiter")
+
+    def set_parameters(self, rate, unitsize=2**500, burst=None):
+        """rate in bytes per second, 0 for no limit. burst is how many
+           seconds of tokens the buckets can save up."""
+        if burst is not None:
+            self.burst = burst
+        self.bucket.refill(self.clock())
+        self.bucket.set_rate(rate, self.burst)
+        self.unitsize = min(unitsize, self.max_unitsize)
+        for group in self.groups.itervalues():
+            if group.bucket is not None:
+                group.bucket.set_rate(group.bucket.rate, self.burst)
+        if not self.running:
+            self.run()
+
+    def set_group_parameters(self, key, rate=0, weight=1):
+        """Limits the connections of group key (a torrent's
+           ConnectionManager) to rate, and gives it weight turns to every
+           one of a group with weight 1."""
+        self.group_params[key] = (rate, weight)
+        group = self.groups.get(key)
+        if group is not None:
+            self._configure(group)
+
+    def remove_group(self, key):
+        """Forgets group key's parameters; a group still sending finishes
+           with no limit of its own."""
+        self.group_params.pop(key, None)
+        group = self.groups.get(key)
+        if group is not None:
+            self._configure(group)
+            if group.state is None:
+                del self.groups[key]
+
+    def _configure(self, group):
+        rate, weight = self.group_params.get(group.key, (0, 1))
+        group.weight = weight
+        if rate > 0:
+            if group.bucket is None:
+                group.bucket = TokenBucket(rate, self.burst, self.clock)
+            else:
+                group.bucket.set_rate(rate, self.burst)
+        else:
+            group.bucket = None
+
+    def queue(self, conn):
+        if conn in self.queued:
+            return
+        key = getattr(conn, 'parent', None)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group(key)
+            self._configure(group)
+        self.ticket += 1
+        self.queued[conn] = (group, self.ticket)
+        group.conns.append((conn, self.ticket))
+        if group.state is None:
+            group.state = 'ring'
+            self.ring.append(group)
+        # a pending run is waiting on the global bucket, unless it has
+        # tokens and the run is for some throttled group
+        if not self.running and (self.task is None or self.bucket.ready()):
+            self.run()
+
+    def dequeue(self, conn):
+        # its entry in the group's queue is skipped when it comes up
+        self.queued.pop(conn, None)
+
+    def increase_offset(self, bytes):
+        # traffic sent around the limiter still counts against it
+        if self.bucket.rate > 0:
+            self.bucket.tokens -= bytes
+
+    def _kick(self, delay):
+        if self.running:
+            return
+        when = self.clock() + delay
+        if self.task is not None:
+            if self.task_time <= when:
+                return
+            self.task.cancel()
+        self.task = self.sched(delay, self.run)
+        self.task_time = when
+
+    def _wait(self, group, now):
+        group.state = 'waiting'
+        when = now + group.bucket.time_until_ready()
+        heapq.heappush(self.waiting, (when, id(group), group))
+
+    def _retire(self, group):
+        group.state = None
+        group.deficit = 0
+        group.midturn = False
+        # a group with a bucket of its own keeps it, and any debt in it,
+        # for when it next has something to send
+        if group.bucket is None and self.groups.get(group.key) is group:
+            del self.groups[group.key]
+
+    def _send(self, conn, n):
+        try:
+            return conn.send_partial(n)
+        except KeyboardInterrupt:
+            raise
+        except:
+            # don't stop the loop if we hit an error
+            self.logger.exception("send_partial failed")
+            return 0
+
+    def run(self):
+        if self.task is not None:
+            if self.task.active():
+                self.task.cancel()
+            self.task = None
+        self.running = True
+        try:
+            self._run()
+        finally:
+            self.running = False
+        self._schedule()
+
+    def _run(self):
+        now = self.clock()
+        bucket = self.bucket
+        bucket.refill(now)
+        while self.waiting and self.waiting[0][0] <= now:
+            when, i, group = heapq.heappop(self.waiting)
+            group.state = 'ring'
+            self.ring.append(group)
+
+        limited = bucket.rate > 0
+        sent_this_pass = 0
+        while self.ring:
+            if limited:
+                if bucket.tokens <= 0:
+                    break
+            elif sent_this_pass >= UNLIMITED_PASS:
+                break
+            group = self.ring.popleft()
+            gbucket = group.bucket
+            if gbucket is not None:
+                gbucket.refill(now)
+                if gbucket.tokens <= 0:
+                    self._wait(group, now)
+                    continue
+            if group.midturn:
+                # the rest of the turn it was on
+                group.midturn = False
+            else:
+                group.deficit += self.unitsize * group.weight
+            while group.deficit > 0 and group.conns:
+                if limited and bucket.tokens <= 0:
+                    break
+                if gbucket is not None and gbucket.tokens <= 0:
+                    break
+                conn, ticket = group.conns.popleft()
+                v = self.queued.get(conn)
+                if v is None or v[1] != ticket:
+                    continue
+                del self.queued[conn]
+                n = self._send(conn, min(self.unitsize, group.deficit))
+                group.deficit -= n
+                if limited:
+                    bucket.tokens -= n
+                if gbucket is not None:
+                    gbucket.tokens -= n
+                sent_this_pass += n
+                # a connection with more to send queues itself again once
+                # its data is flushed
+            if not group.conns:
+                self._retire(group)
+            elif gbucket is not None and gbucket.tokens <= 0:
+                self._wait(group, now)
+            else:
+                if group.deficit > 0 and limited and bucket.tokens <= 0:
+                    # ran out of global tokens mid-turn, keep its place
+                    group.midturn = True
+                    self.ring.appendleft(group)
+                    break
+                group.state = 'ring'
+                self.ring.append(group)
+
+    def _schedule(self):
+        if self.ring:
+            if self.bucket.rate > 0:
+                delay = self.bucket.time_until_ready()
+            else:
+                delay = 0
+            self._kick(max(delay, 0.001))
+        elif self.waiting:
+            delay = self.waiting[0][0] - self.clock()
+            self._kick(max(delay, 0.001))
@@ -216,9 +216,15 @@ class HTTPConnector(Connector):
     def send_cancel(self, index, begin, length):
         pass
 
+    def send_cancels(self, requests):
+        pass
+
     def send_have(self, index):
         pass
 
+    def send_haves(self, indices):
+        pass
+
     def send_bitfield(self, bitfield):
         pass
     
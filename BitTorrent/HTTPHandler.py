@@ -23,45 +23,92 @@ from BTL.translation import _
 
 DEBUG = False
 
+# a request line and headers longer than this close the connection
+MAX_HEADER_SIZE = 16384
+
+
 class HTTPConnector(object):
+    """One client connection. With HTTP/1.1, or HTTP/1.0 and
+       Connection: keep-alive, it stays open for more requests, and
+       requests sent before the answer to the last one (pipelining) are
+       answered in order."""
 
     def __init__(self, handler, connection):
         self.handler = handler
         self.connection = connection
         self.buf = ''
+        self.pos = 0
         self.closed = False
         self.done = False
-        self.donereading = False
+        # set while getfunc has yet to answer
+        self.waiting = False
+        self.parsing = False
+        self.requests = 0
+        # bytes of the request being read so far
+        self.header_size = 0
+        self.last_active = time.time()
         self.next_func = self.read_type
 
     def get_ip(self):
         return self.connection.ip
 
     def data_came_in(self, data):
-        if self.donereading or self.next_func is None:
+        if self.done or self.next_func is None:
             return True
-        self.buf += data
-        while True:
-            try:
-                i = self.buf.index('\n')
-            except ValueError:
-                return True
-            val = self.buf[:i]
-            self.buf = self.buf[i+1:]
+        self.last_active = time.time()
+        if self.pos:
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        else:
+            self.buf += data
+        return self._parse()
+
+    def _parse(self):
+        self.parsing = True
+        try:
+            return self._parse_lines()
+        finally:
+            self.parsing = False
+
+    def _parse_lines(self):
+        # lines are found from where the last search stopped, so a request
+        # coming in a byte at a time isn't rescanned
+        while not self.waiting:
+            i = self.buf.find('\n', self.pos)
+            if i == -1:
+                break
+            self.header_size += i + 1 - self.pos
+            if self.header_size > MAX_HEADER_SIZE:
+                return False
+            val = self.buf[self.pos:i]
+            self.pos = i + 1
             self.next_func = self.next_func(val)
-            if self.donereading:
+            if self.done:
                 return True
             if self.next_func is None or self.closed:
                 return False
+        if self.waiting:
+            # what is buffered belongs to the requests after this one
+            size = len(self.buf) - self.pos
+        else:
+            size = self.header_size + len(self.buf) - self.pos
+        if size > MAX_HEADER_SIZE:
+            return False
+        return True
 
     def read_type(self, data):
-        self.header = data.strip()
+        data = data.strip()
+        if data == '' and self.requests:
+            # stray CRLF between pipelined requests
+            return self.read_type
+        self.header = data
         words = data.split()
         if len(words) == 3:
-            self.command, self.path, garbage = words
+            self.command, self.path, self.version = words
             self.pre1 = False
         elif len(words) == 2:
             self.command, self.path = words
+            self.version = 'HTTP/0.9'
             self.pre1 = True
             if self.command != 'GET':
                 return None
@@ -72,10 +119,20 @@ class HTTPConnector(object):
         self.headers = {}
         return self.read_header
 
+    def _keep_alive(self):
+        if self.pre1 or self.requests >= self.handler.max_requests:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
     def read_header(self, data):
         data = data.strip()
         if data == '':
-            self.donereading = True
+            self.requests += 1
+            self.header_size = 0
+            self.keep_alive = self._keep_alive()
             # check for Accept-Encoding: header, pick a 
             if self.headers.has_key('accept-encoding'):
                 ae = self.headers['accept-encoding']
@@ -92,10 +149,11 @@ class HTTPConnector(object):
             else:
                 #default to identity. 
                 self.encoding = 'identity'
+            self.waiting = True
             r = self.handler.getfunc(self, self.path, self.headers)
             if r is not None:
                 self.answer(r)
-            return None
+            return self.read_type
         try:
             i = data.index(':')
         except ValueError:
@@ -108,6 +166,10 @@ class HTTPConnector(object):
     def answer(self, (responsecode, responsestring, headers, data)):
         if self.closed:
             return
+        self.waiting = False
+        self.last_active = time.time()
+        # the tracker hands out shared header dicts
+        headers = dict(headers)
         if self.encoding == 'gzip':
             #transform data using gzip compression
             #this is nasty but i'm unsure of a better way at the moment
@@ -144,29 +206,60 @@ class HTTPConnector(object):
             self.handler.lastflush = t
             stdout.flush()
 
-        self.done = True
         r = StringIO()
-        r.write('HTTP/1.0 ' + str(responsecode) + ' ' + 
-            responsestring + '\r\n')
+        if self.version == 'HTTP/1.1':
+            r.write('HTTP/1.1 ')
+        else:
+            r.write('HTTP/1.0 ')
+        r.write(str(responsecode) + ' ' + responsestring + '\r\n')
         if not self.pre1:
             headers['Content-Length'] = len(data)
+            if not self.keep_alive:
+                headers['Connection'] = 'close'
+            elif self.version == 'HTTP/1.0':
+                headers['Connection'] = 'keep-alive'
             for key, value in headers.items():
                 r.write(key + ': ' + str(value) + '\r\n')
             r.write('\r\n')
         if self.command != 'HEAD':
             r.write(data)
+        if not self.keep_alive:
+            self.done = True
         self.connection.write(r.getvalue())
-        if self.connection.is_flushed():
-            self.connection.shutdown(1)
+        if self.done:
+            if self.connection.is_flushed():
+                self.connection.shutdown(1)
+        elif not self.parsing and self.pos < len(self.buf):
+            # pipelined requests which came in while this one was waiting
+            if not self._parse() and not self.closed:
+                self.connection.shutdown(1)
 
 
 class HTTPHandler(Handler):
 
-    def __init__(self, getfunc, minflush):
+    def __init__(self, getfunc, minflush, add_task=None, max_requests=100,
+                 idle_timeout=15):
+        """@param add_task: if given, connections idle for idle_timeout
+           seconds between requests are closed.
+           @param max_requests: requests answered on one connection before
+           it is closed."""
         self.connections = {}
         self.getfunc = getfunc
         self.minflush = minflush
         self.lastflush = time.time()
+        self.add_task = add_task
+        self.max_requests = max_requests
+        self.idle_timeout = idle_timeout
+        if add_task is not None and idle_timeout > 0:
+            add_task(idle_timeout, self.close_idle)
+
+    def close_idle(self):
+        self.add_task(self.idle_timeout / 2.0, self.close_idle)
+        cutoff = time.time() - self.idle_timeout
+        for c in self.connections.values():
+            if not c.waiting and not c.done and c.last_active < cutoff:
+                c.done = True
+                c.connection.shutdown(1)
 
     def connection_made(self, connection):
         if DEBUG:
@@ -0,0 +1,77 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+
+from BTL.defer import Deferred, Failure
+import BTL.stackthreading as threading
+from BTL.hash import sha
+
+
+def hash_pieces(data, piece_size, lastlen):
+    """Returns a list of (prefix_digest, digest) tuples, one per piece in
+       data. prefix_digest covers the first lastlen bytes of the piece, which
+       is what a misplaced last piece would hash to."""
+    r = []
+    total = len(data)
+    for pos in xrange(0, total, piece_size):
+        plen = min(piece_size, total - pos)
+        sh = sha(buffer(data, pos, min(lastlen, plen)))
+        sp = sh.digest()
+        if plen > lastlen:
+            sh.update(buffer(data, pos + lastlen, plen - lastlen))
+        r.append((sp, sh.digest()))
+    return r
+
+
+class HashPool(object):
+    """Worker threads which SHA1 piece data off the reactor thread.
+
+    sha releases the GIL on large updates, so hashing scales across cores.
+    Results are delivered back on the reactor thread via external_add_task.
+    """
+
+    def __init__(self, doneflag, external_add_task, num_hash_threads):
+        self.doneflag = doneflag
+        self.external_add_task = external_add_task
+        self.num_hash_threads = max(1, num_hash_threads)
+        self.hashq = Queue.Queue()
+        for i in xrange(self.num_hash_threads):
+            t = threading.Thread(target=self._hash_thread,
+                                 name="hash_thread-%s" % (i+1))
+            t.setDaemon(True)
+            t.start()
+
+        self.doneflag.addCallback(self.finalize)
+
+    def finalize(self, r=None):
+        for i in xrange(self.num_hash_threads):
+            self._create_op(lambda : None)
+
+    def _create_op(self, _f, *args, **kwargs):
+        df = Deferred()
+        self.hashq.put((df, _f, args, kwargs))
+        return df
+
+    def hash_pieces(self, data, piece_size, lastlen):
+        return self._create_op(hash_pieces, data, piece_size, lastlen)
+
+    def _hash_thread(self):
+        while not self.doneflag.isSet():
+            df, func, args, kwargs = self.hashq.get(True)
+            try:
+                v = func(*args, **kwargs)
+            except:
+                self.external_add_task(0, df.errback, Failure())
+            else:
+                self.external_add_task(0, df.callback, v)
@@ -0,0 +1,281 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The crypto behind message stream encryption (MSE): RC4 for the stream and
+# Diffie-Hellman for the key agreement.
+#
+# RC4 comes from OpenSSL's libcrypto when it can be found, which is faster
+# than PyCrypto's, and falls back to PyCrypto. The modular
+# exponentiations of the key agreement run on worker threads; with libcrypto
+# they release the GIL, so a burst of incoming encrypted connections doesn't
+# stall the reactor.
+
+import Queue
+import ctypes
+import ctypes.util
+
+from BTL.defer import Deferred, Failure
+import BTL.stackthreading as threading
+from BTL.obsoletepythonsupport import urandom
+
+dh_prime = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A63A36210000000000090563
+DH_BYTES = 96
+
+# precomputed key pairs to keep around for new connections
+KEYPAIR_POOL_SIZE = 16
+
+
+def bytetonum(x):
+    return long(x.encode('hex'), 16)
+
+def numtobyte(x):
+    x = hex(x).lstrip('0x').rstrip('Ll')
+    x = '0'*(DH_BYTES * 2 - len(x)) + x
+    return x.decode('hex')
+
+
+_libcrypto = None
+try:
+    _name = ctypes.util.find_library('crypto') or ctypes.util.find_library('eay32')
+    if _name:
+        _libcrypto = ctypes.CDLL(_name)
+        _libcrypto.RC4_set_key.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                                           ctypes.c_char_p]
+        _libcrypto.RC4_set_key.restype = None
+        _libcrypto.RC4.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                   ctypes.c_char_p, ctypes.c_void_p]
+        _libcrypto.RC4.restype = None
+        for _f in ('BN_new', 'BN_CTX_new'):
+            getattr(_libcrypto, _f).restype = ctypes.c_void_p
+            getattr(_libcrypto, _f).argtypes = []
+        _libcrypto.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int,
+                                         ctypes.c_void_p]
+        _libcrypto.BN_bin2bn.restype = ctypes.c_void_p
+        _libcrypto.BN_bn2bin.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        _libcrypto.BN_bn2bin.restype = ctypes.c_int
+        _libcrypto.BN_num_bits.argtypes = [ctypes.c_void_p]
+        _libcrypto.BN_num_bits.restype = ctypes.c_int
+        _libcrypto.BN_mod_exp.argtypes = [ctypes.c_void_p] * 5
+        _libcrypto.BN_mod_exp.restype = ctypes.c_int
+        _libcrypto.BN_free.argtypes = [ctypes.c_void_p]
+        _libcrypto.BN_free.restype = None
+        _libcrypto.BN_CTX_free.argtypes = [ctypes.c_void_p]
+        _libcrypto.BN_CTX_free.restype = None
+except (OSError, AttributeError):
+    _libcrypto = None
+
+try:
+    from Crypto.Cipher import ARC4
+except ImportError:
+    ARC4 = None
+
+
+class PyCryptoRC4(object):
+
+    def __init__(self, key):
+        self.cipher = ARC4.new(key)
+        self.encrypt = self.decrypt = self.cipher.encrypt
+
+    def discard(self, n):
+        self.cipher.encrypt('\x00' * n)
+
+
+class OpenSSLRC4(object):
+    """RC4 from libcrypto, written into an output buffer which is reused
+       from call to call."""
+
+    # big enough for RC4_KEY whatever RC4_INT is
+    KEY_SIZE = 258 * 8
+
+    def __init__(self, key):
+        self.key = ctypes.create_string_buffer(self.KEY_SIZE)
+        _libcrypto.RC4_set_key(self.key, len(key), key)
+        self.out = ctypes.create_string_buffer(2 ** 14)
+        self.outlen = 2 ** 14
+
+    def encrypt(self, data):
+        n = len(data)
+        if n > self.outlen:
+            self.outlen = max(n, self.outlen * 2)
+            self.out = ctypes.create_string_buffer(self.outlen)
+        if not isinstance(data, str):
+            data = str(data)
+        _libcrypto.RC4(self.key, n, data, self.out)
+        return ctypes.string_at(self.out, n)
+    decrypt = encrypt
+
+    def discard(self, n):
+        # RC4 in place over the output buffer, nothing is returned
+        while n > 0:
+            a = min(n, self.outlen)
+            _libcrypto.RC4(self.key, a, ctypes.cast(self.out, ctypes.c_char_p),
+                           self.out)
+            n -= a
+
+
+def python_modexp(base, exp, mod):
+    return pow(base, exp, mod)
+
+def openssl_modexp(base, exp, mod):
+    # libcrypto doesn't hold the GIL, so these run in parallel across the
+    # worker threads
+    bns = []
+    ctx = _libcrypto.BN_CTX_new()
+    try:
+        for x in (base, exp, mod):
+            s = ('%x' % x)
+            if len(s) % 2:
+                s = '0' + s
+            s = s.decode('hex')
+            bns.append(_libcrypto.BN_bin2bn(s, len(s), None))
+        r = _libcrypto.BN_new()
+        bns.append(r)
+        if not _libcrypto.BN_mod_exp(r, bns[0], bns[1], bns[2], ctx):
+            raise ValueError("BN_mod_exp failed")
+        out = ctypes.create_string_buffer((_libcrypto.BN_num_bits(r) + 7) // 8)
+        n = _libcrypto.BN_bn2bin(r, out)
+        if n == 0:
+            return 0L
+        return long(out.raw[:n].encode('hex'), 16)
+    finally:
+        for b in bns:
+            _libcrypto.BN_free(b)
+        _libcrypto.BN_CTX_free(ctx)
+
+
+rc4_providers = {}
+if ARC4 is not None:
+    rc4_providers['pycrypto'] = PyCryptoRC4
+if _libcrypto is not None:
+    rc4_providers['openssl'] = OpenSSLRC4
+
+modexp_providers = {'python': python_modexp}
+if _libcrypto is not None:
+    modexp_providers['openssl'] = openssl_modexp
+
+
+def get_rc4_class(name='auto'):
+    # a provider which isn't available here falls back to the best one
+    if name not in rc4_providers:
+        for name in ('openssl', 'pycrypto'):
+            if name in rc4_providers:
+                break
+    return rc4_providers[name]
+
+def get_modexp(name='auto'):
+    if name == 'auto':
+        name = 'openssl'
+    return modexp_providers.get(name, python_modexp)
+
+
+class CryptoProvider(object):
+    """With no worker threads, everything is computed inline and the
+       Deferreds come back already fired."""
+
+    def __init__(self, name='auto', doneflag=None, external_add_task=None,
+                 num_dh_threads=0):
+        self.rc4_class = get_rc4_class(name)
+        self.modexp = get_modexp(name)
+        self.keypairs = []
+        self.keypairs_queued = 0
+        self.num_dh_threads = 0
+        if num_dh_threads > 0 and external_add_task is not None:
+            self.external_add_task = external_add_task
+            self.num_dh_threads = num_dh_threads
+            self.dhq = Queue.Queue()
+            for i in xrange(num_dh_threads):
+                t = threading.Thread(target=self._dh_thread,
+                                     name="dh_thread-%s" % (i+1))
+                t.setDaemon(True)
+                t.start()
+            self.doneflag = doneflag
+            self.doneflag.addCallback(self.finalize)
+            self._refill_keypairs()
+
+    def finalize(self, r=None):
+        for i in xrange(self.num_dh_threads):
+            self.dhq.put((None, None, None))
+
+    def new_rc4(self, key):
+        """Returns an object with encrypt, decrypt and discard(n)."""
+        return self.rc4_class(key)
+
+    def _make_keypair(self):
+        privkey = bytetonum(urandom(20))
+        return privkey, numtobyte(self.modexp(2, privkey, dh_prime))
+
+    def _create_op(self, _f, *args):
+        df = Deferred()
+        if self.num_dh_threads == 0:
+            try:
+                v = _f(*args)
+            except:
+                df.errback(Failure())
+            else:
+                df.callback(v)
+            return df
+        self.dhq.put((df, _f, args))
+        return df
+
+    def _refill_keypairs(self):
+        while (self.num_dh_threads and
+               len(self.keypairs) + self.keypairs_queued < KEYPAIR_POOL_SIZE):
+            self.keypairs_queued += 1
+            df = self._create_op(self._make_keypair)
+            df.addCallback(self._got_keypair)
+
+    def _got_keypair(self, keypair):
+        self.keypairs_queued -= 1
+        self.keypairs.append(keypair)
+
+    def get_keypair(self):
+        """Returns (privkey, public key string), precomputed if possible."""
+        if self.keypairs:
+            r = self.keypairs.pop()
+        else:
+            r = self._make_keypair()
+        self._refill_keypairs()
+        return r
+
+    def _shared_secret(self, pub, privkey):
+        return numtobyte(self.modexp(bytetonum(pub), privkey, dh_prime))
+
+    def shared_secret(self, pub, privkey):
+        """Returns a Deferred which fires with the shared secret string."""
+        return self._create_op(self._shared_secret, pub, privkey)
+
+    def _dh_thread(self):
+        while True:
+            df, func, args = self.dhq.get(True)
+            if df is None:
+                break
+            try:
+                v = func(*args)
+            except:
+                self.external_add_task(0, df.errback, Failure())
+            else:
+                self.external_add_task(0, df.callback, v)
+
+
+_provider = None
+
+def configure(config, doneflag, external_add_task):
+    global _provider
+    _provider = CryptoProvider(config['crypto_provider'], doneflag,
+                               external_add_task, config['num_dh_threads'])
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        _provider = CryptoProvider()
+    return _provider
@@ -13,12 +13,11 @@
 
 # Written by Bram Cohen, Uoti Urpala
 
-import array
 import random
 
-from BTL.sparse_set import SparseSet
 from BTL.obsoletepythonsupport import set
 from BitTorrent.Download import Download
+from BitTorrent.Endgame import Endgame
 
 SPARSE_SET = True
 if SPARSE_SET:
@@ -40,7 +39,8 @@ class PerIPStats(object):
 class MultiDownload(object):
 
     def __init__(self, config, storage, rm, urlage, picker, numpieces,
-                 finished, errorfunc, kickfunc, banfunc, get_downrate):
+                 finished, errorfunc, kickfunc, banfunc, get_downrate,
+                 add_task):
         self.config = config
         self.storage = storage
         self.rm = rm
@@ -66,25 +66,13 @@ class MultiDownload(object):
         
         if SPARSE_SET:
             self.piece_states = PieceSetBuckets()
-            nothing = SparseSet()
-            nothing.add(0, self.numpieces)
-            self.piece_states.buckets.append(nothing)
-
-            # I hate this
-            nowhere = [(i, 0) for i in xrange(self.numpieces)]
-            self.piece_states.place_in_buckets = dict(nowhere)
         else:
             typecode = resolve_typecode(self.numpieces)
             self.piece_states = SortedPieceBuckets(typecode)
-            nothing = array.array(typecode, range(self.numpieces))
-            self.piece_states.buckets.append(nothing)
-
-            # I hate this
-            nowhere = [(i, (0, i)) for i in xrange(self.numpieces)]
-            self.piece_states.place_in_buckets = dict(nowhere)
+        self.piece_states.add_all(self.numpieces)
         
         self.last_update = 0
-        self.all_requests = set()
+        self.endgame = Endgame(add_task, config['endgame_max_duplicates'])
 
     def attach_connection_manager(self, connection_manager):
         self.connection_manager = connection_manager
@@ -147,23 +135,24 @@ class MultiDownload(object):
         self.piece_states.popleft_bucket()
 
     def check_enter_endgame(self):
-        if not self.entered_endgame:
-            if self.rm.endgame:
-                self.entered_endgame = True
-                self.all_requests = set()
-                for d in self.downloads:
-                    self.all_requests.update(d.active_requests)
+        if self.entered_endgame:
+            # the endgame engine calls fix_download_endgame on the peers
+            # whose requests change
+            return
+        if self.rm.endgame:
+            self.entered_endgame = True
+            self.endgame.start(self.downloads)
         for d in self.downloads:
             d.fix_download_endgame()
 
     def hashchecked(self, index):
         if not self.storage.do_I_have(index):
             if self.rm.endgame:
+                reqs = []
                 while self.rm.want_requests(index):
                     nb, nl = self.rm.new_request(index)
-                    self.all_requests.add((index, nb, nl))
-                for d in self.downloads:
-                    d.fix_download_endgame()
+                    reqs.append((index, nb, nl))
+                self.endgame.piece_failed(reqs, self.downloads)
             else:
                 ds = [d for d in self.downloads if not d.choked]
                 random.shuffle(ds)
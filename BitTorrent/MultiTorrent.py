@@ -23,6 +23,7 @@ import traceback
 from copy import copy
 from BTL.translation import _
 from BitTorrent.Choker import Choker
+from BitTorrent.ConnectionBudget import ConnectionBudget
 from BTL.platform import bttime, encode_for_filesystem, get_filesystem_encoding
 from BitTorrent.platform import old_broken_config_subencoding
 from BitTorrent.Torrent import Feedback, Torrent
@@ -33,11 +34,14 @@ from BitTorrent.prefs import Preferences
 from BitTorrent.NatTraversal import NatTraverser
 from BitTorrent.BandwidthManager import BandwidthManager
 from BitTorrent.InternetWatcher import get_internet_watcher
-from BitTorrent.NewRateLimiter import MultiRateLimiter as RateLimiter
+from BitTorrent.HTBRateLimiter import HTBRateLimiter as RateLimiter
 from BitTorrent.DownloadRateLimiter import DownloadRateLimiter
 from BitTorrent.ConnectionManager import SingleportListener
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.Storage import FilePool
+from BitTorrent.Storage import get_filepool_class
+from BitTorrent.HashPool import HashPool
+from BitTorrent import MSECrypto
+from BitTorrent.ReadCache import ReadCache
 from BTL.yielddefer import launch_coroutine
 from BTL.defer import Deferred, DeferredEvent, wrap_task
 from BitTorrent import BTFailure, InfoHashType
@@ -149,9 +153,13 @@ class MultiTorrent(Feedback):
                                                       self.log_root,
                                                       config['use_local_discovery'])
         self.choker = Choker(self.config, self.rawserver.add_task)
+        self.connection_budget = ConnectionBudget(self.config,
+                                                  self.rawserver.add_task,
+                                                  self.running.values)
         self.up_ratelimiter = RateLimiter(self.rawserver.add_task)
         self.up_ratelimiter.set_parameters(config['max_upload_rate'],
-                                           config['upload_unit_size'])
+                                           config['upload_unit_size'],
+                                           config['upload_burst'])
         self.down_ratelimiter = DownloadRateLimiter(
                                            config['download_rate_limiter_interval'],
                                            self.config['max_download_rate'])
@@ -160,11 +168,23 @@ class MultiTorrent(Feedback):
         self._find_port(listen_fail_ok)
 
         self.filepool_doneflag = DeferredEvent()
+        FilePool = get_filepool_class(config['storage_backend'])
         self.filepool = FilePool(self.filepool_doneflag,
                                  self.rawserver.add_task,
                                  self.rawserver.external_add_task,
                                  config['max_files_open'],
                                  config['num_disk_threads'])
+        self.hashpool = None
+        if config['num_hash_threads'] > 0:
+            self.hashpool = HashPool(self.filepool_doneflag,
+                                     self.rawserver.external_add_task,
+                                     config['num_hash_threads'])
+        MSECrypto.configure(config, self.filepool_doneflag,
+                            self.rawserver.external_add_task)
+        self.readcache = None
+        if config['read_cache_size'] > 0:
+            self.readcache = ReadCache(config['read_cache_size'],
+                                       config['read_cache_torrent_size'])
 
         if self.resume_from_torrent_config:
             try:
@@ -244,6 +264,7 @@ class MultiTorrent(Feedback):
 
     def _shutdown(self):
         self.choker.shutdown()
+        self.connection_budget.shutdown()
         self.singleport_listener.close_sockets()
         for t in self.torrents.itervalues():
             try:
@@ -277,15 +298,27 @@ class MultiTorrent(Feedback):
             if dump:
                 self._dump_global_config()
 
-        if option in ['max_upload_rate', 'upload_unit_size']:
+        if option in ['max_upload_rate', 'upload_unit_size', 'upload_burst']:
             self.up_ratelimiter.set_parameters(self.config['max_upload_rate'],
-                                            self.config['upload_unit_size'])
+                                            self.config['upload_unit_size'],
+                                            self.config['upload_burst'])
+        elif option == 'torrent_max_upload_rate':
+            if infohash is not None:
+                torrents = [t]
+            else:
+                torrents = self.torrents.values()
+            for torrent in torrents:
+                torrent.set_upload_limit()
         elif option == 'max_download_rate':
             self.down_ratelimiter.set_parameters(
                 self.config['max_download_rate'])
             #pass # polled from the config automatically by MultiDownload
         elif option == 'max_files_open':
             self.filepool.set_max_files_open(value)
+        elif option in ['read_cache_size', 'read_cache_torrent_size']:
+            if self.readcache is not None:
+                self.readcache.set_max_size(self.config['read_cache_size'],
+                                            self.config['read_cache_torrent_size'])
         elif option == 'maxport':
             if not self.config['minport'] <= self.singleport_listener.port <= \
                    self.config['maxport']:
@@ -338,7 +371,8 @@ class MultiTorrent(Feedback):
                     self.down_ratelimiter, self.total_downmeasure,
                     self.filepool, self.dht, self,
                     self.log_root, hidden=hidden,
-                    is_auto_update=is_auto_update)
+                    is_auto_update=is_auto_update,
+                    hashpool=self.hashpool, readcache=self.readcache)
         if feedback:
             t.add_feedback(feedback)
 
@@ -420,6 +454,8 @@ class MultiTorrent(Feedback):
 
         self.running[infohash] = t
         t.start_download()
+        if t.is_running():
+            self.connection_budget.torrent_started(t)
         t._dump_torrent_config()
         return t.state
 
@@ -496,12 +532,19 @@ class MultiTorrent(Feedback):
         torrent._dump_torrent_config()
 
     def get_all_rates(self):
+        """Returns {infohash: (uprate, downrate, connection allocation)}.
+           The allocation is None when there is no global connection budget
+           or the torrent isn't running."""
         rates = {}
         for infohash, torrent in self.torrents.iteritems():
             rates[infohash] = (torrent.get_uprate() or 0,
-                               torrent.get_downrate() or 0)
+                               torrent.get_downrate() or 0,
+                               self.connection_budget.get_allocation(infohash))
         return rates
 
+    def get_disk_queue_stats(self):
+        return self.filepool.get_disk_queue_stats()
+
     def get_variance(self):
         return self.bandwidth_manager.current_std, self.bandwidth_manager.max_std
 
@@ -737,7 +780,8 @@ class MultiTorrent(Feedback):
                         self.singleport_listener, self.up_ratelimiter,
                         self.down_ratelimiter,
                         self.total_downmeasure, self.filepool, self.dht, self,
-                        self.log_root)
+                        self.log_root, hashpool=self.hashpool,
+                        readcache=self.readcache)
             t.metainfo.reported_errors = True # suppress redisplay on restart
             if infohash != t.metainfo.infohash:
                 self.logger.error((_("Corrupt data in \"%s\", cannot restore torrent.") % hashtext) +
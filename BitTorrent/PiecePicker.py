@@ -17,86 +17,184 @@ import array
 import random
 import itertools
 
+from BTL.bitfield import iter_set
+
+NO_SLOT = -2 ** 31
+
 def resolve_typecode(n):
     if n < 32768:
         return 'h'
     return 'l'
 
+_empty_bucket = array.array('h')
+
+class _BucketsView(object):
+    """Read-only list-like view of PieceBuckets by availability."""
+    __slots__ = ('pb',)
+
+    def __init__(self, pb):
+        self.pb = pb
+
+    def __len__(self):
+        return self.pb._top + 1
+
+    def __getitem__(self, bucketindex):
+        if bucketindex < 0:
+            bucketindex += len(self)
+        if not 0 <= bucketindex < len(self):
+            raise IndexError(bucketindex)
+        return self.pb._get_bucket(bucketindex)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.pb._get_bucket(i)
+
+
 class PieceBuckets(object):
     """A PieceBuckets object is an array of arrays.  ith bucket contains
        pieces that have i known instances within the network.  Pieces
-       within each bucket are randomly ordered."""
-    def __init__(self, typecode):
+       within each bucket are randomly ordered.
+
+       Each piece's bucket and position are kept in typed arrays indexed by
+       piece. Buckets are stored by a 'slot' number which never changes
+       while a piece sits in it; a piece's availability is its slot plus a
+       global offset, so a peer with every piece coming or going is O(1)."""
+    def __init__(self, typecode, numpieces):
         self.typecode = typecode
-        # [[piece]]
-        self.buckets = []
-        # {piece: (bucket, bucketpos)}
-        self.place_in_buckets = {}
+        # [[piece]], list position is slot - self._base
+        self._slots = []
+        self._base = 0
+        # availability = slot + self._offset
+        self._offset = 0
+        # highest availability with a non-empty bucket, or -1
+        self._top = -1
+        self._count = 0
+        # piece => slot, NO_SLOT if the piece isn't here
+        self._slot_of = array.array('l', [NO_SLOT]) * numpieces
+        # piece => position within its bucket
+        self._pos = array.array('l', [0]) * numpieces
+        self.buckets = _BucketsView(self)
+
+    def _get_bucket(self, bucketindex):
+        i = bucketindex - self._offset - self._base
+        if 0 <= i < len(self._slots):
+            return self._slots[i]
+        return _empty_bucket
+
+    def _bucket_for_add(self, bucketindex):
+        slot = bucketindex - self._offset
+        if slot < self._base:
+            n = self._base - slot
+            self._slots[0:0] = [ array.array(self.typecode)
+                                 for i in xrange(n) ]
+            self._base = slot
+        while len(self._slots) <= slot - self._base:
+            self._slots.append(array.array(self.typecode))
+        return slot, self._slots[slot - self._base]
 
     def get_position(self, piece):  # returns which bucket piece is in.
-        return self.place_in_buckets[piece][0]
+        return self._slot_of[piece] + self._offset
 
     def __contains__(self, piece):
-        return piece in self.place_in_buckets
+        return self._slot_of[piece] != NO_SLOT
+
+    def __len__(self):
+        return self._count
 
     def add(self, piece, bucketindex):
-        assert not self.place_in_buckets.has_key(piece)
-        while len(self.buckets) <= bucketindex:
-            self.buckets.append(array.array(self.typecode))
-        bucket = self.buckets[bucketindex]
+        assert self._slot_of[piece] == NO_SLOT
+        slot, bucket = self._bucket_for_add(bucketindex)
         # randomly swap piece with piece already in bucket...
         newspot = random.randrange(len(bucket) + 1)
         if newspot == len(bucket):
             bucket.append(piece)
         else:
             tomove = bucket[newspot]
-            self.place_in_buckets[tomove] = (bucketindex, len(bucket))
+            self._pos[tomove] = len(bucket)
             bucket.append(tomove)
             bucket[newspot] = piece
-        self.place_in_buckets[piece] = (bucketindex, newspot)
+        self._slot_of[piece] = slot
+        self._pos[piece] = newspot
+        self._count += 1
+        if bucketindex > self._top:
+            self._top = bucketindex
 
     def remove(self, piece):
-        bucketindex, bucketpos = self.place_in_buckets.pop(piece)
-        bucket = self.buckets[bucketindex]
+        slot = self._slot_of[piece]
+        assert slot != NO_SLOT
+        bucketpos = self._pos[piece]
+        bucket = self._slots[slot - self._base]
         tomove = bucket[-1]
         if tomove != piece:
             bucket[bucketpos] = tomove
-            self.place_in_buckets[tomove] = (bucketindex, bucketpos)
+            self._pos[tomove] = bucketpos
         del bucket[-1]
-        while len(self.buckets) > 0 and len(self.buckets[-1]) == 0:
-            del self.buckets[-1]
-        return bucketindex
+        self._slot_of[piece] = NO_SLOT
+        self._count -= 1
+        while self._top >= 0 and len(self._get_bucket(self._top)) == 0:
+            self._top -= 1
+        return slot + self._offset
 
     # to be removed
     def bump(self, piece):
-        bucketindex, bucketpos = self.place_in_buckets[piece]
-        bucket = self.buckets[bucketindex]
+        slot = self._slot_of[piece]
+        bucketpos = self._pos[piece]
+        bucket = self._slots[slot - self._base]
         tomove = bucket[-1]
         if tomove != piece:
             bucket[bucketpos] = tomove
-            self.place_in_buckets[tomove] = (bucketindex, bucketpos)
+            self._pos[tomove] = bucketpos
             bucket[-1] = piece
-            self.place_in_buckets[piece] = (bucketindex, len(bucket)-1)
+            self._pos[piece] = len(bucket) - 1
 
     def prepend_bucket(self):
         # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
+        if self._count == 0:
             return
-        self.buckets.insert(0, array.array(self.typecode))
-        # bleh.
-        for piece in self.place_in_buckets:
-            index, pos = self.place_in_buckets[piece]
-            self.place_in_buckets[piece] = (index + 1, pos)
+        self._offset += 1
+        self._top += 1
 
     def popleft_bucket(self):
         # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
+        if self._count == 0:
             return
-        self.buckets.pop(0)
-        # bleh.
-        for piece in self.place_in_buckets:
-            index, pos = self.place_in_buckets[piece]
-            self.place_in_buckets[piece] = (index - 1, pos)
+        # nothing should be left with no copies, but if something is, keep
+        # it at zero rather than losing track of it
+        for piece in list(self._get_bucket(0)):
+            self.remove(piece)
+            self.add(piece, 1)
+        self._offset -= 1
+        self._top -= 1
+
+    def rarest(self, haves, bans):
+        """returns the rarest piece (with at least one copy) which the peer
+           has and which isn't banned, or None."""
+        # the peer's bitfield keeps its count as numfalse
+        if (len(haves) - haves.numfalse) * 4 < self._count:
+            # the peer has few pieces, walk those instead of the buckets.
+            # through tostring(), as cBitfield has no iter_set
+            bits = haves.tostring()
+            slot_of = self._slot_of
+            pos = self._pos
+            floor = 1 - self._offset
+            best = None
+            bestkey = None
+            for j in iter_set(bits):
+                slot = slot_of[j]
+                if slot < floor or j in bans:
+                    continue
+                # same pick as the bucket walk: rarest, then earliest in
+                # the (randomly ordered) bucket
+                key = (slot, pos[j])
+                if bestkey is None or key < bestkey:
+                    best = j
+                    bestkey = key
+            return best
+        for i in xrange(1, len(self.buckets)):
+            for j in self._get_bucket(i):
+                if haves[j] and j not in bans:
+                    return j
+        return None
 
 class PiecePicker(object):
 
@@ -104,7 +202,7 @@ class PiecePicker(object):
         self.config = config
         self.numpieces = numpieces
         self.typecode = resolve_typecode(numpieces)
-        self.piece_bucketss = [PieceBuckets(self.typecode)]
+        self.piece_bucketss = [PieceBuckets(self.typecode, numpieces)]
         self.scrambled = array.array(self.typecode)
         self.numgot = self.numpieces
         for i in not_have:
@@ -128,7 +226,8 @@ class PiecePicker(object):
 
     def set_priority(self, pieces, priority):
         while len(self.piece_bucketss) <= priority:
-            self.piece_bucketss.append(PieceBuckets(self.typecode))
+            self.piece_bucketss.append(PieceBuckets(self.typecode,
+                                                    self.numpieces))
         for piece in pieces:
             for p in self.piece_bucketss:
                 if piece in p:
@@ -213,12 +312,17 @@ class PiecePicker(object):
                 best = random.choice([j for (i, j) in rarity_of_started
                     if i == bestnum]) # random pick of those in smallest bkt
                                                       
-            for i in xrange(1, len(piece_buckets.buckets)):
-                if bestnum == i:      # if best of started is also rarest...
+            if bestnum is not None and bestnum < 1:
+                bestnum = None
+            j = piece_buckets.rarest(haves, bans)
+            if j is None:
+                if bestnum is not None:
                     return best
-                for j in piece_buckets.buckets[i]:
-                    if haves[j] and j not in bans:
-                        return j      # return first found.
+            elif bestnum is not None and \
+                 bestnum <= piece_buckets.get_position(j):
+                return best   # if best of started is also rarest...
+            else:
+                return j      # return first found.
         return None
     
     # to be removed
@@ -18,118 +18,130 @@
 ## down
 # p.add(piece, p.remove(piece) - 1)
 
+import array
+import bisect
+
 from BTL.sparse_set import SparseSet
 
-class PieceSetBuckets(object):
-    """A PieceBuckets object is an array of arrays.  ith bucket contains
-       pieces that have i known instances within the network.  Pieces
-       within each bucket are randomly ordered."""
+
+class _OffsetBuckets(object):
+    """Buckets are stored by a 'slot' number which never changes while a
+       piece sits in it; a piece's bucket is its slot plus a global
+       offset, so a peer with every piece coming or going is O(1), as in
+       PiecePicker.PieceBuckets."""
+
     def __init__(self):
-        # [SparseSet(piece)]
-        self.buckets = []
-        # {piece: (bucket)}
+        # list position is slot - self._base
+        self._slots = []
+        self._base = 0
+        # bucket index = slot + self._offset
+        self._offset = 0
+        # {piece: slot}
         self.place_in_buckets = {}
 
+    def _get_buckets(self):
+        lead = self._base + self._offset
+        if lead < 0:
+            return self._slots[-lead:]
+        return [self._new_bucket() for i in xrange(lead)] + self._slots
+    buckets = property(_get_buckets)
+
     def get_position(self, piece):  # returns which bucket piece is in.
-        return self.place_in_buckets[piece]
+        return self.place_in_buckets[piece] + self._offset
 
     def __contains__(self, piece):
         return piece in self.place_in_buckets
 
+    def _bucket_for_add(self, bucketindex):
+        slot = bucketindex - self._offset
+        if not self._slots:
+            self._base = slot
+        elif slot < self._base:
+            self._slots[0:0] = [self._new_bucket()
+                                for i in xrange(self._base - slot)]
+            self._base = slot
+        while len(self._slots) <= slot - self._base:
+            self._slots.append(self._new_bucket())
+        return slot, self._slots[slot - self._base]
+
     def add(self, piece, bucketindex):
         assert not self.place_in_buckets.has_key(piece)
-        while len(self.buckets) <= bucketindex:
-            self.buckets.append(SparseSet())
-        bucket = self.buckets[bucketindex]
-        bucket.add(piece)
-        self.place_in_buckets[piece] = bucketindex
+        slot, bucket = self._bucket_for_add(bucketindex)
+        self._insert(bucket, piece)
+        self.place_in_buckets[piece] = slot
 
     def remove(self, piece):
-        bucketindex = self.place_in_buckets.pop(piece)
-        bucket = self.buckets[bucketindex]
-        bucket.subtract(piece)
-        while len(self.buckets) > 0 and len(self.buckets[-1]) == 0:
-            del self.buckets[-1]
-        return bucketindex
+        slot = self.place_in_buckets.pop(piece)
+        self._discard(self._slots[slot - self._base], piece)
+        while len(self._slots) > 0 and len(self._slots[-1]) == 0:
+            del self._slots[-1]
+        return slot + self._offset
 
     def prepend_bucket(self):
         # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
+        if len(self._slots) == 0:
             return
-        self.buckets.insert(0, SparseSet())
-        # bleh.
-        for piece in self.place_in_buckets:
-            self.place_in_buckets[piece] += 1
+        self._offset += 1
 
     def popleft_bucket(self):
         # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
-            return 
-        self.buckets.pop(0)
-        # bleh.
-        for piece in self.place_in_buckets:
-            self.place_in_buckets[piece] -= 1
+        if len(self._slots) == 0:
+            return
+        # nothing should be left with no copies, but if something is, keep
+        # it at zero rather than losing track of it
+        i = -self._offset - self._base
+        if 0 <= i < len(self._slots):
+            for piece in list(self._slots[i]):
+                self.remove(piece)
+                self.add(piece, 1)
+        self._offset -= 1
 
 
-import array
-import bisect
+class PieceSetBuckets(_OffsetBuckets):
+    """A PieceBuckets object is an array of arrays.  ith bucket contains
+       pieces that have i known instances within the network.  Pieces
+       within each bucket are randomly ordered."""
+
+    def add_all(self, numpieces):
+        """Puts pieces 0 to numpieces - 1, none of them here, in bucket 0."""
+        slot, bucket = self._bucket_for_add(0)
+        bucket.add(0, numpieces)
+        self.place_in_buckets = dict.fromkeys(xrange(numpieces), slot)
+
+    def _new_bucket(self):
+        return SparseSet()
+
+    def _insert(self, bucket, piece):
+        bucket.add(piece)
+
+    def _discard(self, bucket, piece):
+        bucket.subtract(piece)
+
 
 def resolve_typecode(n):
     if n < 32768:
         return 'h'
     return 'l'
 
-class SortedPieceBuckets(object):
+class SortedPieceBuckets(_OffsetBuckets):
     """A PieceBuckets object is an array of arrays.  ith bucket contains
        pieces that have i known instances within the network.  Pieces
-       within each bucket are randomly ordered."""
+       within each bucket are sorted."""
     def __init__(self, typecode):
+        _OffsetBuckets.__init__(self)
         self.typecode = typecode
-        # [[piece]]
-        self.buckets = []
-        # {piece: (bucket, bucketpos)}
-        self.place_in_buckets = {}
 
-    def get_position(self, piece):  # returns which bucket piece is in.
-        return self.place_in_buckets[piece][0]
-
-    def __contains__(self, piece):
-        return piece in self.place_in_buckets
+    def add_all(self, numpieces):
+        """Puts pieces 0 to numpieces - 1, none of them here, in bucket 0."""
+        slot, bucket = self._bucket_for_add(0)
+        bucket.extend(xrange(numpieces))
+        self.place_in_buckets = dict.fromkeys(xrange(numpieces), slot)
 
-    def add(self, piece, bucketindex):
-        assert not self.place_in_buckets.has_key(piece)
-        while len(self.buckets) <= bucketindex:
-            self.buckets.append(array.array(self.typecode))
-        bucket = self.buckets[bucketindex]
-        newspot = bisect.bisect_right(bucket, piece)
-        bucket.insert(newspot, piece)
-        self.place_in_buckets[piece] = (bucketindex, newspot)
+    def _new_bucket(self):
+        return array.array(self.typecode)
 
-    def remove(self, piece):
-        bucketindex, bucketpos = self.place_in_buckets.pop(piece)
-        bucket = self.buckets[bucketindex]
-        newspot = bisect.bisect_left(bucket, piece)
-        del bucket[newspot]
-        while len(self.buckets) > 0 and len(self.buckets[-1]) == 0:
-            del self.buckets[-1]
-        return bucketindex
-    
-    def prepend_bucket(self):
-        # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
-            return
-        self.buckets.insert(0, array.array(self.typecode))
-        # bleh.
-        for piece in self.place_in_buckets:
-            index, pos = self.place_in_buckets[piece]
-            self.place_in_buckets[piece] = (index + 1, pos)
+    def _insert(self, bucket, piece):
+        bucket.insert(bisect.bisect_right(bucket, piece), piece)
 
-    def popleft_bucket(self):
-        # it' possible we had everything to begin with
-        if len(self.buckets) == 0:
-            return
-        self.buckets.pop(0)
-        # bleh.
-        for piece in self.place_in_buckets:
-            index, pos = self.place_in_buckets[piece]
-            self.place_in_buckets[piece] = (index - 1, pos)
+    def _discard(self, bucket, piece):
+        del bucket[bisect.bisect_left(bucket, piece)]
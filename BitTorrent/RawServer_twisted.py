@@ -19,6 +19,7 @@ import socket
 import signal
 import string
 import struct
+import errno
 import thread
 import logging
 
@@ -68,6 +69,70 @@ NOLINGER = struct.pack('ii', 1, 0)
 SHUT_RD = getattr(socket, 'SHUT_RD', 0)
 SHUT_WR = getattr(socket, 'SHUT_WR', 1)
 
+# Vectored socket writes. writev sends a message header and its payload in
+# one syscall straight from the strings (or buffers) they live in, where
+# handing them to the transport means joining them into one string first.
+writev = None
+
+if os.name == 'posix' and not is_iocpreactor:
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _writev = _libc.writev
+        _as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+    except (ImportError, OSError, AttributeError, TypeError):
+        pass
+    else:
+        class _iovec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_void_p),
+                        ('iov_len', ctypes.c_size_t)]
+
+        _writev.argtypes = [ctypes.c_int, ctypes.POINTER(_iovec),
+                            ctypes.c_int]
+        _writev.restype = ctypes.c_ssize_t
+        _as_read_buffer.argtypes = [ctypes.py_object,
+                                    ctypes.POINTER(ctypes.c_void_p),
+                                    ctypes.POINTER(ctypes.c_ssize_t)]
+        _as_read_buffer.restype = ctypes.c_int
+
+        # IOV_MAX is at least 16 by POSIX and 1024 on Linux
+        _IOV_MAX = 1024
+
+        def writev(fd, segments):
+            """One non-blocking writev of as many segments as fit. Returns
+               the number of bytes written, 0 if the socket buffer is full."""
+            segments = segments[:_IOV_MAX]
+            iov = (_iovec * len(segments))()
+            p = ctypes.c_void_p()
+            l = ctypes.c_ssize_t()
+            for i, seg in enumerate(segments):
+                # points into seg itself, no copy. segments keeps them alive
+                _as_read_buffer(seg, ctypes.byref(p), ctypes.byref(l))
+                iov[i].iov_base = p.value
+                iov[i].iov_len = l.value
+            n = _writev(fd, iov, len(segments))
+            if n < 0:
+                e = ctypes.get_errno()
+                if e in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return 0
+                raise socket.error(e, os.strerror(e))
+            return n
+
+
+def split_segments(segments, n):
+    """Splits a list of strings/buffers after its first n bytes, slicing
+       the segment which straddles the split. Returns (head, tail)."""
+    for i, seg in enumerate(segments):
+        if n < len(seg):
+            if n == 0:
+                return segments[:i], segments[i:]
+            return (segments[:i] + [buffer(seg, 0, n)],
+                    [buffer(seg, n)] + segments[i+1:])
+        n -= len(seg)
+    return segments, []
+
+
 # this is a base class for all the callbacks the server could use
 class Handler(object):
 
@@ -208,15 +273,43 @@ class ConnectionWrapper(object):
         return ret
 
     def write(self, b):
+        self.write_sequence([b])
+
+    def write_sequence(self, segments):
+        """Writes a list of strings/buffers as one stream, without joining
+           them when the socket can take them right away."""
         self.flushed = False
         if not self.write_open:
-            return            
+            return
+        segments = [ b for b in segments if len(b) > 0 ]
+        if not segments:
+            return
         if self.encrypt is not None:
-            b = self.encrypt(b)
-        # bleh
-        if isinstance(b, buffer):
-            b = str(b)
-        self.transport.write(b)
+            segments = [ self.encrypt(b) for b in segments ]
+        t = self.transport
+        if (writev is not None and
+            # nothing queued in the transport which should go out first
+            getattr(t, 'dataBuffer', None) == "" and
+            not getattr(t, '_tempDataBuffer', True) and
+            not getattr(t, 'TLS', False) and
+            getattr(t, 'producer', None) is self and
+            t.connected and not t.disconnecting):
+            try:
+                n = writev(t.fileno(), segments)
+            except socket.error:
+                # let the transport hit the error and tear down as usual
+                n = 0
+            sent, segments = split_segments(segments, n)
+            if not segments:
+                # the transport would have called this once its buffer
+                # drained, but it never saw the data
+                self.resumeProducing()
+                return
+        # the transport joins what it buffers, and can't join buffers
+        if len(segments) == 1:
+            t.write(str(segments[0]))
+        else:
+            t.writeSequence([ str(b) for b in segments ])
 
     def resumeProducing(self):
         self.flushed = True
@@ -667,6 +760,21 @@ class RawServer(RawServerMixin):
         return self._create_udpsocket(port, bind,
                                       create_func = reactor.listenMulticast)
 
+    def adopt_connection(self, serversocket, sock, data=''):
+        """Treats sock, a connection accepted somewhere else, as if
+           serversocket had accepted it, and data as already received
+           on it."""
+        port = serversocket.listening_port
+        addr = sock.getpeername()
+        sock.setblocking(0)
+        protocol = port.factory.buildProtocol(port._buildAddr(addr))
+        s = port.sessionno
+        port.sessionno = s + 1
+        transport = port.transport(sock, protocol, addr, port, s)
+        protocol.makeConnection(transport)
+        if data:
+            protocol.dataReceived(data)
+
     def _start_listening(self, s):
         if not s.listening_port.listening:
             s.listening_port.startListening()
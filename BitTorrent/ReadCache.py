@@ -0,0 +1,155 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A size-bounded LRU cache of whole pieces, shared by every torrent in a
+# MultiTorrent. Sits in front of Storage.read on the upload path so that
+# many peers pulling the same popular pieces don't each cost a disk op.
+#
+# Each owner (one per torrent) is registered with add_owner before it
+# uses the cache and dropped with discard_owner; a read which completes
+# after that is not cached, so nothing of the owner is left behind.
+
+
+class _Entry(object):
+    # linked into both the global LRU list (prev/next) and the owner's
+    # LRU list (oprev/onext)
+    __slots__ = ('key', 'data', 'prev', 'next', 'oprev', 'onext')
+
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+        self.prev = self.next = self
+        self.oprev = self.onext = self
+
+
+class ReadCacheStats(object):
+    __slots__ = ('hits', 'misses', 'evictions', 'size', 'head')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self.head = _Entry(None, None)
+
+    def get(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': self.size}
+
+
+class ReadCache(object):
+
+    def __init__(self, max_size, max_torrent_size=0):
+        self.entries = {}
+        # circular list, head.next is the most recently used entry
+        self.head = _Entry(None, None)
+        self.size = 0
+        self.stats = {}
+        self.set_max_size(max_size, max_torrent_size)
+
+    def set_max_size(self, max_size, max_torrent_size=0):
+        if max_torrent_size <= 0 or max_torrent_size > max_size:
+            max_torrent_size = max_size
+        self.max_size = max_size
+        self.max_torrent_size = max_torrent_size
+        for owner in self.stats.keys():
+            self._evict(owner)
+        self._evict(None)
+
+    def _unlink(self, e):
+        e.prev.next = e.next
+        e.next.prev = e.prev
+        e.oprev.onext = e.onext
+        e.onext.oprev = e.oprev
+
+    def _push_front(self, e):
+        e.prev = self.head
+        e.next = self.head.next
+        self.head.next.prev = e
+        self.head.next = e
+        ohead = self.stats[e.key[0]].head
+        e.oprev = ohead
+        e.onext = ohead.onext
+        ohead.onext.oprev = e
+        ohead.onext = e
+
+    def add_owner(self, owner):
+        if owner not in self.stats:
+            self.stats[owner] = ReadCacheStats()
+
+    def get(self, owner, index):
+        s = self.stats.get(owner)
+        if s is None:
+            return None
+        e = self.entries.get((owner, index))
+        if e is None:
+            s.misses += 1
+            return None
+        s.hits += 1
+        self._unlink(e)
+        self._push_front(e)
+        return e.data
+
+    def put(self, owner, index, data):
+        key = (owner, index)
+        s = self.stats.get(owner)
+        if s is None or len(data) > self.max_torrent_size:
+            return
+        if key in self.entries:
+            self._remove(self.entries[key])
+        e = _Entry(key, data)
+        self.entries[key] = e
+        self._push_front(e)
+        self.size += len(data)
+        s.size += len(data)
+        self._evict(owner)
+
+    def _remove(self, e):
+        self._unlink(e)
+        del self.entries[e.key]
+        self.size -= len(e.data)
+        self.stats[e.key[0]].size -= len(e.data)
+
+    def _evict(self, owner):
+        # evict the owner's least recently used pieces first if it is over
+        # its share, then everyone's if the cache as a whole is over.
+        if owner is not None:
+            s = self.stats[owner]
+            while s.size > self.max_torrent_size:
+                self._remove(s.head.oprev)
+                s.evictions += 1
+        while self.size > self.max_size:
+            e = self.head.prev
+            self._remove(e)
+            self.stats[e.key[0]].evictions += 1
+
+    def discard(self, owner, index):
+        e = self.entries.get((owner, index))
+        if e is not None:
+            self._remove(e)
+
+    def discard_owner(self, owner):
+        s = self.stats.get(owner)
+        if s is None:
+            return
+        while s.head.onext is not s.head:
+            self._remove(s.head.onext)
+        del self.stats[owner]
+
+    def get_stats(self, owner):
+        s = self.stats.get(owner)
+        if s is None:
+            return None
+        return s.get()
@@ -0,0 +1,190 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# How many requests to keep outstanding on a connection.
+#
+# The time from sending a request to getting its chunk is the round trip
+# plus however long the request waits behind others at the peer. The
+# smallest recent one is taken as the round trip, and the window is sized
+# to the rate times that (the bandwidth-delay product), with some to spare.
+#
+# A new connection starts in slow start, opening the window by one for
+# every chunk received, until latency rises enough to show requests are
+# queueing at the peer. From then on the window follows the
+# bandwidth-delay product, one step at a time. A snubbing peer has its
+# window halved.
+#
+# With a full window every request waits behind others, so once the
+# smallest latency is too old to trust, the window drops to about the
+# bandwidth-delay product until a request sent after that comes back.
+# That drains the queue at the peer while keeping the link busy, and gives
+# a fresh round trip without the queueing. A small window which latency
+# shows isn't queueing is trusted as it is.
+
+from BTL.platform import bttime
+
+# the old optimistic backlog for new connections
+INITIAL_WINDOW = 10
+MIN_WINDOW = 2
+# for peers which don't say how many requests they take. Older clients,
+# this one included, dropped requests past 256
+DEFAULT_MAX_WINDOW = 250
+# requests in flight as a multiple of the bandwidth-delay product
+GAIN = 1.5
+# latency this far above the round trip means requests are queueing
+QUEUEING = 1.5
+# samples needed before latency can end slow start
+MIN_SAMPLES = 8
+# seconds the smallest latency seen is trusted as the round trip
+MIN_RTT_LIFETIME = 10.0
+# windows up to this are only probed when latency shows queueing
+PROBE_WINDOW = 4 * MIN_WINDOW
+# shortest interval the rate is measured over
+RATE_INTERVAL = 0.5
+
+
+class RequestWindow(object):
+
+    def __init__(self, chunksize, snub_time, clock=bttime):
+        self.chunksize = chunksize
+        self.snub_time = snub_time
+        self.clock = clock
+        self.window = INITIAL_WINDOW
+        self.max_window = DEFAULT_MAX_WINDOW
+        self.slow_start = True
+        self.sent_at = {}
+        self.samples = 0
+        self.srtt = None
+        self.min_rtt = None
+        self.min_rtt_time = 0
+        self.rate = 0.0
+        self.rate_bytes = 0
+        self.rate_since = None
+        self.last_progress = None
+        # when the window was dropped to measure the round trip
+        self.probing = None
+        self.probe_window = None
+
+    def set_max_window(self, n):
+        """The most requests the peer will queue, if it says."""
+        self.max_window = max(MIN_WINDOW, n)
+        self.window = min(self.window, self.max_window)
+
+    def size(self, outstanding):
+        """The number of requests to have outstanding."""
+        if (outstanding and self.last_progress is not None and
+            self.clock() - self.last_progress > self.snub_time):
+            self.snubbed()
+        return self.window
+
+    def snubbed(self):
+        if self.probing is not None:
+            self.window = self.probe_window
+            self.probing = None
+        self.window = max(MIN_WINDOW, self.window // 2)
+        self.slow_start = False
+        # at most once per snub_time
+        self.last_progress = self.clock()
+
+    def request_sent(self, req, active):
+        """@param active: the outstanding requests, req included."""
+        now = self.clock()
+        if len(active) == 1:
+            # the connection was idle, which says nothing about the rate
+            self.last_progress = now
+            self.rate_since = now
+            self.rate_bytes = 0
+        if len(self.sent_at) > 2 * len(active) + 16:
+            # drop requests cancelled, rejected or lost
+            for r in self.sent_at.keys():
+                if r not in active:
+                    del self.sent_at[r]
+        self.sent_at[req] = now
+
+    def piece_received(self, req, length):
+        now = self.clock()
+        self.last_progress = now
+        if self.probing is None:
+            # the drain would count as a slowdown
+            self._update_rate(now, length)
+        sent = self.sent_at.pop(req, None)
+        if sent is None:
+            return
+        sample = now - sent
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt = sample
+        else:
+            self.srtt += (sample - self.srtt) / 8
+
+        if self.probing is not None:
+            if sent >= self.probing:
+                self.min_rtt = sample
+                self.min_rtt_time = now
+                self.window = self.probe_window
+                self.probing = None
+                self.rate_since = now
+                self.rate_bytes = 0
+            return
+        if self.min_rtt is None or sample <= self.min_rtt:
+            self.min_rtt = sample
+            self.min_rtt_time = now
+        elif (not self.slow_start and
+              now - self.min_rtt_time > MIN_RTT_LIFETIME):
+            if (self.window <= PROBE_WINDOW and
+                self.srtt <= QUEUEING * self.min_rtt):
+                self.min_rtt_time = now
+            else:
+                self.probing = now
+                self.probe_window = self.window
+                self.window = max(MIN_WINDOW,
+                                  int(self.window / GAIN) - 1)
+                return
+
+        if self.slow_start:
+            if (self.samples >= MIN_SAMPLES and
+                sample > QUEUEING * self.min_rtt):
+                self.slow_start = False
+            elif self.window < self.max_window:
+                self.window += 1
+            else:
+                self.slow_start = False
+            return
+        target = self.target()
+        if target > self.window:
+            self.window += 1
+        elif target < self.window:
+            self.window -= 1
+
+    def _update_rate(self, now, length):
+        if self.rate_since is None:
+            self.rate_since = now
+        self.rate_bytes += length
+        interval = now - self.rate_since
+        if interval < max(RATE_INTERVAL, self.srtt or 0):
+            return
+        rate = self.rate_bytes / interval
+        if self.rate:
+            self.rate = (self.rate + rate) / 2
+        else:
+            self.rate = rate
+        self.rate_bytes = 0
+        self.rate_since = now
+
+    def target(self):
+        """The window the bandwidth-delay product calls for."""
+        if self.min_rtt is None:
+            return self.window
+        bdp = self.rate * self.min_rtt / self.chunksize
+        n = MIN_WINDOW + int(GAIN * bdp + 0.5)
+        return max(MIN_WINDOW, min(n, self.max_window))
@@ -0,0 +1,469 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# LaunchMany spread over several processes, so seeding isn't bound to the
+# one core the reactor runs on.
+#
+# The supervisor owns the listening port everyone announces, and starts one
+# worker per shard, each a LaunchMany (with its own RawServer,
+# SingleportListener and FilePool) running the torrents whose infohash falls
+# in its shard. An incoming connection is read just far enough to find the
+# infohash -- for an encrypted one, that means answering the key exchange --
+# and then the socket and the bytes read so far are passed to the worker,
+# which replays them as if it had accepted the connection itself.
+#
+# Workers are started afresh rather than forked, so they don't share the
+# reactor's poller. They report their stats back to the supervisor, which
+# displays them together. Posix only, since it relies on passing sockets.
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import logging
+import cPickle
+import subprocess
+from random import randrange
+from struct import pack, unpack
+
+from BTL.translation import _
+from BTL.hash import sha
+from BTL.platform import encode_for_filesystem
+from BTL.obsoletepythonsupport import urandom
+import BTL.stackthreading as threading
+from BitTorrent import BTFailure
+from BitTorrent.Connector import protocol_name, PAD_MAX
+from BitTorrent.MSECrypto import CryptoProvider, DH_BYTES
+
+try:
+    from _multiprocessing import sendfd, recvfd
+except (ImportError, AttributeError):
+    sendfd = recvfd = None
+
+ENVIRONMENT_KEY = 'BITTORRENT_SHARD'
+# seconds a connection gets to say which torrent it's for
+SNIFF_TIMEOUT = 30
+# seconds between workers telling the supervisor about their torrents
+REPORT_INTERVAL = 5
+
+HEADER = chr(len(protocol_name)) + protocol_name
+# the length byte and name, reserved bytes, infohash
+HEADER_LENGTH = len(HEADER) + 8 + 20
+
+
+def shard_of(infohash, num_shards):
+    return unpack("!I", infohash[:4])[0] % num_shards
+
+
+def _send_frame(sock, obj):
+    data = cPickle.dumps(obj, 2)
+    sock.sendall(pack("!i", len(data)) + data)
+
+def _recv_exactly(sock, n):
+    r = []
+    while n > 0:
+        s = sock.recv(n)
+        if not s:
+            raise socket.error(errno.ECONNRESET, "connection closed")
+        r.append(s)
+        n -= len(s)
+    return ''.join(r)
+
+def _recv_frame(sock):
+    l = unpack("!i", _recv_exactly(sock, 4))[0]
+    return cPickle.loads(_recv_exactly(sock, l))
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class _Sniffer(object):
+    """An incoming connection on the shared port, until we know which
+       torrent it is for."""
+
+    def __init__(self, sock, crypto):
+        self.sock = sock
+        self.crypto = crypto
+        self.started = time.time()
+        self.data = ''
+        # written when the socket is writable; it is non-blocking
+        self.out = ''
+        self.privkey = None
+        self.S = None
+        # known once routed, handed off once self.out is written
+        self.infohash = None
+
+    def route(self, obfuscated):
+        """Returns the infohash, or None if more data is needed. Raises
+           ValueError if this isn't going to work out."""
+        data = self.data
+        if HEADER.startswith(data[:len(HEADER)]):
+            if len(data) < HEADER_LENGTH:
+                return None
+            return data[HEADER_LENGTH - 20:HEADER_LENGTH]
+
+        # an encrypted handshake, see Connector._read_messages
+        if len(data) < DH_BYTES:
+            return None
+        if self.privkey is None:
+            self.privkey, pub = self.crypto.get_keypair()
+            self.out += pub + urandom(randrange(PAD_MAX))
+            df = self.crypto.shared_secret(data[:DH_BYTES], self.privkey)
+            self.S = df.getResult()
+        i = data.find(sha('req1' + self.S).digest(), DH_BYTES)
+        if i < 0:
+            if len(data) >= DH_BYTES + 532:
+                raise ValueError("incoming VC not found")
+            return None
+        if len(data) < i + 40:
+            return None
+        streamid = data[i + 20:i + 40]
+        x = sha('req3' + self.S).digest()
+        streamid = ''.join([chr(ord(streamid[j]) ^ ord(x[j]))
+                            for j in range(20)])
+        if streamid not in obfuscated:
+            raise ValueError("download id unknown")
+        return obfuscated[streamid]
+
+
+class _WorkerProcess(object):
+
+    def __init__(self, index, process, sock):
+        self.index = index
+        self.process = process
+        self.sock = sock
+        self.buffer = ''
+        self.stats = []
+        self.infohashes = []
+
+
+class ShardSupervisor(object):
+
+    def __init__(self, config, display, argv=None):
+        """@param display: called with the stats of all the workers' torrents
+              together, as LaunchMany would. Stops everything if it returns
+              true.
+           @param argv: command line which starts a worker, by default the
+              one this process was started with."""
+        if sendfd is None or os.name != 'posix':
+            raise BTFailure(_("Running in several processes is not supported "
+                              "on this platform."))
+        self.config = config
+        self.display = display
+        self.num_shards = config['shards']
+        if argv is None:
+            argv = [sys.executable] + sys.argv
+            if hasattr(sys, 'frozen'):
+                argv = [sys.executable] + sys.argv[1:]
+        self.argv = argv
+        self.logger = logging.getLogger('core.ShardSupervisor')
+        # inline, the supervisor does nothing else in the meantime
+        self.crypto = CryptoProvider(config['crypto_provider'])
+        self.workers = []
+        self.sniffers = {}
+        # sha('req2' + infohash) -> infohash, for routing encrypted handshakes
+        self.obfuscated = {}
+        self.listener = None
+        self.port = None
+        self.done = False
+
+    def _listen(self):
+        e = None
+        for port in xrange(max(1024, self.config['minport']),
+                           self.config['maxport'] + 1):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind((self.config['bind'], port))
+            except socket.error, e:
+                s.close()
+                continue
+            s.listen(128)
+            s.setblocking(0)
+            _set_cloexec(s.fileno())
+            self.listener = s
+            self.port = port
+            return
+        raise BTFailure(_("Could not open a listening port: %s.") % e)
+
+    def _start_workers(self):
+        for i in xrange(self.num_shards):
+            ours, theirs = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_STREAM)
+            _set_cloexec(ours.fileno())
+            env = dict(os.environ)
+            env[ENVIRONMENT_KEY] = '%d:%d:%d:%d' % (i, self.num_shards,
+                                                    theirs.fileno(), self.port)
+            p = subprocess.Popen(self.argv, env=env, close_fds=False)
+            theirs.close()
+            self.workers.append(_WorkerProcess(i, p, ours))
+
+    def run(self):
+        self._listen()
+        self._start_workers()
+        self.logger.info("listening on port %d, %d workers",
+                         self.port, self.num_shards)
+        try:
+            try:
+                self._loop()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            self._stop_workers()
+
+    def _loop(self):
+        next_display = time.time() + self.config['display_interval']
+        while not self.done:
+            socks = [self.listener] + self.sniffers.keys()
+            socks.extend([w.sock for w in self.workers])
+            wsocks = [sniffer.sock for sniffer in self.sniffers.itervalues()
+                      if sniffer.out]
+            timeout = max(0, min(next_display - time.time(), 1))
+            try:
+                r, w, e = select.select(socks, wsocks, [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for s in r:
+                if s is self.listener:
+                    self._accept()
+                elif s in self.sniffers:
+                    self._sniff(self.sniffers[s])
+                else:
+                    for worker in self.workers:
+                        if worker.sock is s:
+                            self._read_worker(worker)
+            for s in w:
+                # may have been dropped or handed off since
+                if s in self.sniffers:
+                    self._write(self.sniffers[s])
+            now = time.time()
+            for sniffer in self.sniffers.values():
+                if now - sniffer.started > SNIFF_TIMEOUT:
+                    self._drop(sniffer)
+            if now >= next_display:
+                next_display = now + self.config['display_interval']
+                self._display()
+            for worker in self.workers:
+                if worker.process.poll() is not None:
+                    self.logger.error("worker %d exited", worker.index)
+                    self.done = True
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            sock.setblocking(0)
+            self.sniffers[sock] = _Sniffer(sock, self.crypto)
+
+    def _drop(self, sniffer):
+        del self.sniffers[sniffer.sock]
+        sniffer.sock.close()
+
+    def _sniff(self, sniffer):
+        try:
+            data = sniffer.sock.recv(4096)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._drop(sniffer)
+            return
+        sniffer.data += data
+        if sniffer.infohash is not None:
+            # routed, still writing out our side of the key exchange
+            return
+        try:
+            infohash = sniffer.route(self.obfuscated)
+        except ValueError:
+            self._drop(sniffer)
+            return
+        if sniffer.out:
+            self._write(sniffer)
+        if infohash is None or sniffer.sock not in self.sniffers:
+            return
+        sniffer.infohash = infohash
+        if not sniffer.out:
+            self._hand_off(sniffer)
+
+    def _write(self, sniffer):
+        try:
+            n = sniffer.sock.send(sniffer.out)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._drop(sniffer)
+            return
+        sniffer.out = sniffer.out[n:]
+        if not sniffer.out and sniffer.infohash is not None:
+            self._hand_off(sniffer)
+
+    def _hand_off(self, sniffer):
+        worker = self.workers[shard_of(sniffer.infohash, self.num_shards)]
+        del self.sniffers[sniffer.sock]
+        try:
+            sendfd(worker.sock.fileno(), sniffer.sock.fileno())
+            _send_frame(worker.sock, (sniffer.data, sniffer.privkey))
+        finally:
+            # the worker has its own reference to the socket now, closing
+            # ours doesn't shut it down
+            sniffer.sock.close()
+
+    def _read_worker(self, worker):
+        data = worker.sock.recv(65536)
+        if not data:
+            self.logger.error("lost worker %d", worker.index)
+            self.done = True
+            return
+        worker.buffer += data
+        while len(worker.buffer) >= 4:
+            l = unpack("!i", worker.buffer[:4])[0]
+            if len(worker.buffer) < 4 + l:
+                break
+            kind, value = cPickle.loads(worker.buffer[4:4 + l])
+            worker.buffer = worker.buffer[4 + l:]
+            if kind == 'stats':
+                worker.stats = value
+            elif kind == 'torrents':
+                worker.infohashes = value
+                self.obfuscated = {}
+                for w in self.workers:
+                    for infohash in w.infohashes:
+                        self.obfuscated[sha('req2' + infohash).digest()] = \
+                                                                     infohash
+
+    def _display(self):
+        data = []
+        for worker in self.workers:
+            data.extend(worker.stats)
+        data.sort()
+        if self.display(data):
+            self.done = True
+
+    def _stop_workers(self):
+        # a worker shuts down when its connection to us closes
+        for worker in self.workers:
+            worker.sock.close()
+        for sniffer in self.sniffers.values():
+            self._drop(sniffer)
+        self.listener.close()
+        for worker in self.workers:
+            try:
+                worker.process.wait()
+            except OSError:
+                pass
+
+
+class ShardWorker(object):
+
+    def __init__(self, index, num_shards, fd, port):
+        self.index = index
+        self.num_shards = num_shards
+        self.port = port
+        self.sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        self.send_lock = threading.Lock()
+        self.launchmany = None
+        self.infohashes = None
+
+    def from_environment(cls):
+        """Returns the ShardWorker this process was started as, or None."""
+        v = os.environ.get(ENVIRONMENT_KEY)
+        if not v:
+            return None
+        del os.environ[ENVIRONMENT_KEY]
+        return cls(*[int(x) for x in v.split(':')])
+    from_environment = classmethod(from_environment)
+
+    def adjust_config(self, config):
+        """Gives this worker its share of the global limits, announces the
+           supervisor's port, and keeps state apart from the other
+           workers."""
+        n = self.num_shards
+        for name in ('max_upload_rate', 'max_download_rate'):
+            # 0 is unlimited, so a small limit mustn't round down to it
+            if config[name] > 0:
+                config[name] = max(1, config[name] // n)
+        if config.get('max_connections'):
+            config['max_connections'] = max(1, config['max_connections'] // n)
+        config['forwarded_port'] = self.port
+        config['data_dir'] = os.path.join(config['data_dir'],
+                                          'shard-%d' % self.index)
+        datadir = encode_for_filesystem(config['data_dir'])[0]
+        for d in ('', 'resume', 'metainfo', 'torrents'):
+            ddir = os.path.join(datadir, d)
+            if not os.path.exists(ddir):
+                os.mkdir(ddir, 0700)
+
+    def owns(self, infohash):
+        return shard_of(infohash, self.num_shards) == self.index
+
+    def attach(self, launchmany):
+        self.launchmany = launchmany
+        t = threading.Thread(target=self._receive,
+                             name="shard_handoff-%d" % self.index)
+        t.setDaemon(True)
+        t.start()
+        launchmany.rawserver.add_task(0, self._report_torrents)
+
+    def _send(self, kind, value):
+        self.send_lock.acquire()
+        try:
+            _send_frame(self.sock, (kind, value))
+        finally:
+            self.send_lock.release()
+
+    def _report_torrents(self):
+        rawserver = self.launchmany.rawserver
+        rawserver.add_task(REPORT_INTERVAL, self._report_torrents)
+        infohashes = [t.infohash
+                      for t in self.launchmany.multitorrent.get_torrents()]
+        infohashes.sort()
+        if infohashes != self.infohashes:
+            self.infohashes = infohashes
+            self._send('torrents', infohashes)
+
+    def display(self, data):
+        self._send('stats', data)
+        return False
+
+    def _receive(self):
+        rawserver = self.launchmany.rawserver
+        try:
+            while True:
+                fd = recvfd(self.sock.fileno())
+                data, privkey = _recv_frame(self.sock)
+                rawserver.external_add_task(0, self._adopt, fd, data, privkey)
+        except (OSError, RuntimeError, socket.error, EOFError):
+            # the supervisor is gone
+            rawserver.external_add_task(0, self.launchmany.core_doneflag.set)
+
+    def _adopt(self, fd, data, privkey):
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        multitorrent = self.launchmany.multitorrent
+        if multitorrent is None:
+            sock.close()
+            return
+        multitorrent.singleport_listener.adopt_connection(sock, data, privkey)
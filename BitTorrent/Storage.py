@@ -11,8 +11,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+
 # pick a Storage subsystem
 try:
     from Storage_IOCP import *
 except Exception, e:
     from Storage_threadpool import *
+
+def get_filepool_class(storage_backend):
+    """Returns the FilePool class for the storage_backend option. The
+    default ('auto') is whichever subsystem was picked above."""
+    if storage_backend == 'mmap':
+        from BitTorrent.Storage_mmap import FilePool as f
+        return f
+    if storage_backend == 'threadpool':
+        from BitTorrent.Storage_threadpool import FilePool as f
+        return f
+    return FilePool
+
+def get_storage_class(filepool):
+    """Returns the Storage class which goes with filepool."""
+    return sys.modules[filepool.__class__.__module__].Storage
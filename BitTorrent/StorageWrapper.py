@@ -18,6 +18,7 @@ from __future__ import generators
 
 import os
 import sys
+import time
 import struct
 import cPickle
 import logging
@@ -65,8 +66,9 @@ class DataPig(object):
     def _got_piece(self, index, begin, piece, source):
         df = self.read(index, len(piece), offset=begin)
         yield df
-        data = df.getResult()
-        if data != piece:
+        # either may be a buffer, which never compares equal to a str
+        data = str(df.getResult())
+        if data != str(piece):
             if (index in self.download_history and
                 begin in self.download_history[index]):
                 d = self.download_history[index][begin]
@@ -93,6 +95,45 @@ class DataPig(object):
             culprit.bad(index, bump = True)
             del self.failed_pieces[index] # found the culprit already
         
+
+class PieceHasher(object):
+    """Folds the blocks of a piece into a running SHA1 as they are written,
+       holding out-of-order blocks until the gap before them is filled."""
+    __slots__ = ('sh', 'pos', 'pending', 'buffered')
+
+    def __init__(self):
+        self.sh = sha()
+        self.pos = 0
+        self.pending = {}
+        self.buffered = 0
+
+    def add(self, begin, data):
+        """Returns False if the block overlaps data which was already hashed,
+           in which case the digest can no longer be trusted."""
+        if begin < self.pos:
+            return False
+        if begin in self.pending:
+            self.buffered -= len(self.pending[begin])
+        elif begin != self.pos:
+            # data may be a view on a reused receive buffer
+            data = str(data)
+        if begin != self.pos:
+            self.pending[begin] = data
+            self.buffered += len(data)
+            return True
+        self.sh.update(data)
+        self.pos += len(data)
+        while self.pos in self.pending:
+            data = self.pending.pop(self.pos)
+            self.buffered -= len(data)
+            self.sh.update(data)
+            self.pos += len(data)
+        return True
+
+    def digest(self):
+        return self.sh.digest()
+
+
 current_version = 2
 resume_prefix = 'BitTorrent resume state file, version '
 version_string = resume_prefix + str(current_version)
@@ -105,7 +146,7 @@ class StorageWrapper(object):
                  statusfunc, doneflag, data_flunked,
                  infohash, # needed for partials
                  is_batch, errorfunc, working_path, destination_path, resumefile,
-                 add_task, external_add_task):
+                 add_task, external_add_task, hashpool=None, readcache=None):
         assert len(hashes) > 0
         assert piece_size > 0
         self.initialized = False
@@ -122,6 +163,12 @@ class StorageWrapper(object):
         self.data_flunked = data_flunked
         self.errorfunc = errorfunc
         self.statusfunc = statusfunc
+        self.hashpool = hashpool
+        self.readcache = readcache
+        if readcache is not None:
+            readcache.add_owner(self)
+        # index => list of Deferreds waiting on a read-ahead of that piece
+        self._cache_waiters = {}
         self.total_length = storage.get_total_length()
         # a brief explanation about the mildly confusing amount_ variables:
         #   amount_left: total_length - fully_written_pieces
@@ -146,6 +193,12 @@ class StorageWrapper(object):
         self._pieces_in_buf = []
         self._piece_buf = None
 
+        # index => PieceHasher for pieces being hashed as they are written
+        self._hashers = {}
+        self._hash_buffered = 0
+        # pieces whose hasher was dropped, left to be read back from disk
+        self._hash_dropped = set()
+
         self.partial_mark = None
 
         if self.numpieces < 32768:
@@ -257,7 +310,7 @@ class StorageWrapper(object):
             elif t in (ALLOCATED, UNALLOCATED):
                 pass
             elif t == FASTRESUME_PARTIAL:
-                df = self._storage_read(i, piece_len)
+                df = self._storage_read(i, piece_len, background=True)
                 yield df
                 try:
                     data = df.getResult()
@@ -409,11 +462,27 @@ class StorageWrapper(object):
         d['have_set'] = self.have_set
         d['undownloaded'] = self.storage.undownloaded
         d['amount_left'] = self.amount_left
-        d['unwritten_partials'] = self.rm.get_unwritten_requests()
+        d['unwritten_partials'] = self._get_unwritten_partials()
         
         resumefile.write(cPickle.dumps(d))
 
         self.fastresume_dirty = False
+
+    def _get_unwritten_partials(self):
+        unwritten = self.rm.get_unwritten_requests()
+        # blocks still in the storage write buffer would be lost on a crash,
+        # so record them as unwritten too.
+        for pos, length in self.storage.get_unflushed_ranges():
+            end = pos + length
+            while pos < end:
+                p = pos // self.piece_size
+                plen = min(end, p * self.piece_size + self._piecelen(p)) - pos
+                if p < self.numpieces and self.rplaces[p] >= 0:
+                    index = self.rplaces[p]
+                    unwritten.setdefault(index, []).append(
+                        (pos - p * self.piece_size, plen))
+                pos += plen
+        return unwritten
     ############################################################################
 
     def _markgot(self, piece, pos):
@@ -455,7 +524,7 @@ class StorageWrapper(object):
         else:
             size = num_pieces * self.piece_size
         self._pieces_in_buf = range(i, i + num_pieces)
-        df = self._storage_read(i, size)
+        df = self._storage_read(i, size, background=True)
         yield df
         try:
             self._piece_buf = df.getResult()
@@ -465,16 +534,41 @@ class StorageWrapper(object):
         yield buffer(self._piece_buf, p * self.piece_size, self._piecelen(i))
         
     def hashcheck_pieces(self, begin=0, end=None):
-        df = launch_coroutine(wrap_task(self.add_task),
-                              self._hashcheck_pieces,
-                              begin, end)
+        if self.hashpool is not None:
+            f = self._hashcheck_pieces_parallel
+        else:
+            f = self._hashcheck_pieces
+        df = launch_coroutine(wrap_task(self.add_task), f, begin, end)
         return df
 
-    def _hashcheck_pieces(self, begin=0, end=None):
+    def _hashcheck_targets(self):
         # we need a full reverse-lookup of hashes for out of order compatability
         targets = {}
         for i in xrange(self.numpieces):
             targets[self.hashes[i]] = i
+        return targets
+
+    def _hashcheck_result(self, i, piece_len, sp, s, data, targets, partials):
+        # handle out-of-order pieces
+        if s in targets and piece_len == self._piecelen(targets[s]):
+            # handle one or more pieces with identical hashes properly
+            piece_found = i
+            if s != self.hashes[i]:
+                piece_found = targets[s]
+            self.checked_pieces.add(piece_found)
+            self._markgot(piece_found, i)
+        # last piece junk. I'm not even sure this is right.
+        elif (not self.have[self.numpieces - 1] and
+              sp == self.hashes[-1] and
+              (i == self.numpieces - 1 or
+               not self._waspre(self.numpieces - 1))):
+            self.checked_pieces.add(self.numpieces - 1)
+            self._markgot(self.numpieces - 1, i)
+        else:
+            self._check_partial(i, partials, data)
+
+    def _hashcheck_pieces(self, begin=0, end=None):
+        targets = self._hashcheck_targets()
         partials = {}
 
         if end is None:
@@ -507,23 +601,8 @@ class StorageWrapper(object):
             sp = sh.digest()
             sh.update(buffer(data, self.lastlen))
             s = sh.digest()
-            # handle out-of-order pieces
-            if s in targets and piece_len == self._piecelen(targets[s]):
-                # handle one or more pieces with identical hashes properly
-                piece_found = i
-                if s != self.hashes[i]:
-                    piece_found = targets[s]
-                self.checked_pieces.add(piece_found)
-                self._markgot(piece_found, i)
-            # last piece junk. I'm not even sure this is right.
-            elif (not self.have[self.numpieces - 1] and
-                  sp == self.hashes[-1] and
-                  (i == self.numpieces - 1 or
-                   not self._waspre(self.numpieces - 1))):
-                self.checked_pieces.add(self.numpieces - 1)
-                self._markgot(self.numpieces - 1, i)
-            else:
-                self._check_partial(i, partials, data)
+            self._hashcheck_result(i, piece_len, sp, s, data,
+                                   targets, partials)
             self.statusfunc(fractionDone = 1 - self.amount_left /
                             self.total_length)
             
@@ -533,6 +612,101 @@ class StorageWrapper(object):
         self.fastresume_dirty = True
         yield True
 
+    def _hashcheck_windows(self, begin, end):
+        # runs of preallocated pieces, at most READ_AHEAD_BUFFER_SIZE each
+        per_window = int(max(1, self.READ_AHEAD_BUFFER_SIZE / self.piece_size))
+        first = None
+        for i in xrange(begin, end):
+            if not self._waspre(i):
+                # hole in the file
+                if first is not None:
+                    yield first, i - first
+                    first = None
+                continue
+            if first is None:
+                first = i
+            elif i - first == per_window:
+                yield first, i - first
+                first = i
+        if first is not None:
+            yield first, end - first
+
+    def _hashcheck_window(self, first, count):
+        size = sum([self._piecelen(i) for i in xrange(first, first + count)])
+        df = self._storage_read(first, size, background=True)
+        yield df
+        try:
+            data = df.getResult()
+        except BTFailure: # short read
+            yield '', None
+        df = self.hashpool.hash_pieces(data, self.piece_size, self.lastlen)
+        yield df
+        yield data, df.getResult()
+
+    def _hashcheck_pieces_parallel(self, begin=0, end=None):
+        targets = self._hashcheck_targets()
+        partials = {}
+
+        if end is None:
+            end = self.numpieces
+
+        global_logger.debug('Parallel hashcheck from %d to %d' % (begin, end))
+
+        in_flight = max(1, self.config['hashcheck_reads_in_flight'])
+        windows = self._hashcheck_windows(begin, end)
+        pending = []
+        start = time.time()
+        checked = 0
+
+        while True:
+            # keep several reads queued; they complete in any order, but
+            # results are consumed in piece order.
+            while len(pending) < in_flight:
+                try:
+                    first, count = windows.next()
+                except StopIteration:
+                    break
+                df = launch_coroutine(wrap_task(self.add_task),
+                                      self._hashcheck_window, first, count)
+                pending.append((first, count, df))
+            if not pending:
+                break
+
+            first, count, df = pending.pop(0)
+            yield df
+            data, digests = df.getResult()
+
+            # we're shutting down, abort.
+            if self.doneflag.isSet():
+                yield False
+
+            pos = 0
+            for i in xrange(first, first + count):
+                piece_len = self._piecelen(i)
+                if digests is None:
+                    self._check_partial(i, partials, '')
+                    continue
+                sp, s = digests[i - first]
+                self._hashcheck_result(i, piece_len, sp, s,
+                                       buffer(data, pos, piece_len),
+                                       targets, partials)
+                pos += piece_len
+            checked += len(data)
+
+            elapsed = max(time.time() - start, 0.001)
+            rate = checked / elapsed / (1024 * 1024)
+            self.statusfunc(activity = _("checking existing data (%.1f MB/s)")
+                            % rate,
+                            fractionDone = 1 - self.amount_left /
+                            self.total_length)
+
+        global_logger.debug('Parallel hashcheck from %d to %d complete.' %
+                            (begin, end))
+
+        self._realize_partials(partials)
+        self.fastresume_dirty = True
+        yield True
+
     def hashcheck_piece(self, index, data = None):
         df = launch_coroutine(wrap_task(self.add_task),
                               self._hashcheck_piece,
@@ -660,12 +834,23 @@ class StorageWrapper(object):
         df.getResult()
 
         self.rm.request_received(index, begin, len(piece))
+        self._hash_block(index, begin, piece)
 
         hashcheck = self.rm.is_piece_received(index)
         if hashcheck:
-            df = self.hashcheck_piece(self.places[index])
+            df = self.storage.flush(self.places[index] * self.piece_size,
+                                    self._piecelen(index))
             yield df
-            passed = df.getResult()
+            df.getResult()
+            digest = self._pop_hasher_digest(index)
+            if digest is not None:
+                passed = digest == self.hashes[index]
+                if passed:
+                    self.checked_pieces.add(index)
+            else:
+                df = self.hashcheck_piece(self.places[index])
+                yield df
+                passed = df.getResult()
             self.rm.piece_finished(index)
             length = self._piecelen(index)
             if passed:
@@ -687,6 +872,42 @@ class StorageWrapper(object):
         self.fastresume_dirty = True
         yield hashcheck
 
+    def _hash_block(self, index, begin, piece):
+        limit = self.config['incremental_hash_buffer']
+        if limit <= 0 or self.places[index] != index:
+            return
+        if index in self._hash_dropped:
+            return
+        h = self._hashers.get(index)
+        if h is None:
+            h = self._hashers[index] = PieceHasher()
+        before = h.buffered
+        if not h.add(begin, piece):
+            self._drop_hasher(index)
+            return
+        self._hash_buffered += h.buffered - before
+        if self._hash_buffered > limit:
+            # over budget, this piece will be read back from disk instead
+            self._drop_hasher(index)
+
+    def _drop_hasher(self, index):
+        h = self._hashers.pop(index)
+        self._hash_buffered -= h.buffered
+        # the rest of the piece can't make a digest without the start of
+        # it, so don't spend the budget on it
+        self._hash_dropped.add(index)
+
+    def _pop_hasher_digest(self, index):
+        self._hash_dropped.discard(index)
+        if index not in self._hashers:
+            return None
+        h = self._hashers.pop(index)
+        self._hash_buffered -= h.buffered
+        # blocks written before a restart never pass through the hasher
+        if h.pos != self._piecelen(index) or h.pending:
+            return None
+        return h.digest()
+
     def get_piece(self, index):
         if not self.have[index]:
             df = defer.Deferred()
@@ -727,14 +948,55 @@ class StorageWrapper(object):
             raise ValueError("incorrect size: (%d + %d ==) %d >= %d" %
                              (begin, length,
                               begin + length, self._piecelen(index)))
+        if self.readcache is not None:
+            df = self._cached_read(index)
+            yield df
+            data = df.getResult()
+            yield data[begin:begin + length]
         df = self._storage_read(self.places[index], length, offset=begin)
         yield df
         data = df.getResult()
         yield data
 
-    def _storage_read(self, index, amount, offset=0):
+    def _cached_read(self, index):
+        """Returns a Deferred which fires with the whole of piece index,
+           reading it ahead into the shared read cache on a miss."""
+        df = defer.Deferred()
+        data = self.readcache.get(self, index)
+        if data is not None:
+            df.callback(data)
+            return df
+        if index in self._cache_waiters:
+            self._cache_waiters[index].append(df)
+            return df
+        self._cache_waiters[index] = [df]
+        rdf = self._storage_read(self.places[index], self._piecelen(index))
+        rdf.addCallback(self._cache_read_done, index)
+        rdf.addErrback(self._cache_read_failed, index)
+        return df
+
+    def _cache_read_done(self, data, index):
+        self.readcache.put(self, index, data)
+        for df in self._cache_waiters.pop(index):
+            df.callback(data)
+
+    def _cache_read_failed(self, failure, index):
+        for df in self._cache_waiters.pop(index):
+            df.errback(failure)
+
+    def get_read_cache_stats(self):
+        if self.readcache is None:
+            return None
+        return self.readcache.get_stats(self)
+
+    def discard_read_cache(self):
+        if self.readcache is not None:
+            self.readcache.discard_owner(self)
+
+    def _storage_read(self, index, amount, offset=0, background=False):
         assert index >= 0
-        return self.storage.read(index * self.piece_size + offset, amount)
+        return self.storage.read(index * self.piece_size + offset, amount,
+                                 background=background)
 
     def _storage_write(self, index, data, offset=0):
         return self.storage.write(index * self.piece_size + offset, data)
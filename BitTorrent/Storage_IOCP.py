@@ -201,6 +201,10 @@ class FilePool(object):
         self.max_files_open = max_files_open
         self.close_all()
 
+    def get_disk_queue_stats(self):
+        # overlapped ops go straight to the kernel, there is no queue to report
+        return {}
+
     def add_files(self, files, torrent):
         for filename in files:
             if filename in self.file_to_torrent:
@@ -419,7 +423,7 @@ class Storage(object):
 
         yield r
 
-    def read(self, pos, amount):
+    def read(self, pos, amount, background=False):
         df = launch_coroutine(wrap_task(self.add_task),
                               self._batch_read, pos, amount)
         return df
@@ -460,6 +464,15 @@ class Storage(object):
                               self._batch_write, pos, s)
         return df
 
+    # overlapped writes are not buffered, so there is never anything to flush
+    def flush(self, pos=0, amount=None):
+        df = Deferred()
+        df.callback(True)
+        return df
+
+    def get_unflushed_ranges(self):
+        return []
+
     def close(self):
         if not self.initialized:
             def post_init(r):
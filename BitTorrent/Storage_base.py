@@ -102,3 +102,110 @@ def open_sparse_file(path, mode, length=0, overlapped=False):
     f = os.fdopen(fd, mode)
     return f
 
+
+# Positional I/O. pread/pwrite don't touch the file pointer, so one handle
+# can be shared between disk threads without the seek-then-read race, and
+# each op is one syscall instead of two. pwritev writes a list of chunks
+# (strings or buffers) in one call, straight from where they are in memory,
+# without joining or copying them first.
+has_positional_io = False
+
+if os.name == 'posix':
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # the 64 bit variants take a 64 bit offset even on 32 bit systems
+        _pread = getattr(_libc, 'pread64', _libc.pread)
+        _pwrite = getattr(_libc, 'pwrite64', _libc.pwrite)
+        _pwritev = getattr(_libc, 'pwritev64', getattr(_libc, 'pwritev', None))
+        _as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+    except (ImportError, OSError, AttributeError, TypeError):
+        pass
+    else:
+        has_positional_io = True
+
+        class _iovec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_void_p),
+                        ('iov_len', ctypes.c_size_t)]
+
+        _pread.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                           ctypes.c_size_t, ctypes.c_int64]
+        _pread.restype = ctypes.c_ssize_t
+        _pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t, ctypes.c_int64]
+        _pwrite.restype = ctypes.c_ssize_t
+        if _pwritev is not None:
+            _pwritev.argtypes = [ctypes.c_int, ctypes.POINTER(_iovec),
+                                 ctypes.c_int, ctypes.c_int64]
+            _pwritev.restype = ctypes.c_ssize_t
+        _as_read_buffer.argtypes = [ctypes.py_object,
+                                    ctypes.POINTER(ctypes.c_void_p),
+                                    ctypes.POINTER(ctypes.c_ssize_t)]
+        _as_read_buffer.restype = ctypes.c_int
+
+        # IOV_MAX is at least 16 by POSIX and 1024 on Linux
+        _IOV_MAX = 1024
+
+        def _check(n):
+            if n < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            return n
+
+        def pread(fd, amount, pos):
+            buf = ctypes.create_string_buffer(amount)
+            got = 0
+            while got < amount:
+                n = _check(_pread(fd, ctypes.byref(buf, got),
+                                  amount - got, pos + got))
+                if n == 0:
+                    break
+                got += n
+            return buf.raw[:got]
+
+        def _address(c):
+            # where the bytes of a string or buffer are, no copy. the caller
+            # keeps c alive for as long as the address is used
+            p = ctypes.c_void_p()
+            l = ctypes.c_ssize_t()
+            if _as_read_buffer(c, ctypes.byref(p), ctypes.byref(l)) < 0:
+                raise TypeError("expected a string or buffer")
+            return p.value, l.value
+
+        def _pwrite_all(fd, s, pos):
+            p, l = _address(s)
+            total = 0
+            while total < l:
+                n = _check(_pwrite(fd, p + total, l - total, pos + total))
+                total += n
+            return total
+
+        def pwritev(fd, chunks, pos):
+            chunks = [c for c in chunks if len(c) > 0]
+            if _pwritev is None:
+                total = 0
+                for c in chunks:
+                    total += _pwrite_all(fd, c, pos + total)
+                return total
+            total = 0
+            while chunks:
+                batch = chunks[:_IOV_MAX]
+                iov = (_iovec * len(batch))()
+                want = 0
+                for i, c in enumerate(batch):
+                    iov[i].iov_base, iov[i].iov_len = _address(c)
+                    want += iov[i].iov_len
+                n = _check(_pwritev(fd, iov, len(batch), pos + total))
+                total += n
+                if n < want:
+                    # short write, finish the rest the slow way
+                    for c in batch:
+                        if n >= len(c):
+                            n -= len(c)
+                            continue
+                        total += _pwrite_all(fd, buffer(c, n), pos + total)
+                        n = 0
+                del chunks[:_IOV_MAX]
+            return total
+
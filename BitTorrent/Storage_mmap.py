@@ -0,0 +1,143 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A Storage backend which reads through memory maps of the torrent files.
+#
+# Reads return buffer slices of the mapping instead of copies, so uploads and
+# hash checks skip a copy and a syscall. Writes still go through file handles
+# on the disk threads: mapping for write would mean growing every file to its
+# full length up front, which defeats sparse allocation detection. Writes are
+# visible through the mappings since both share the page cache.
+#
+# Only suitable for 64-bit processes; a 32-bit address space runs out long
+# before a seed box does.
+
+import os
+import sys
+import mmap
+from BTL.translation import _
+
+from BitTorrent import BTFailure
+from BTL.DictWithLists import OrderedDict
+import BTL.stackthreading as threading
+from BitTorrent.Storage_base import UnregisteredFileException
+from BitTorrent.Storage_threadpool import FilePool as ThreadpoolFilePool
+from BitTorrent.Storage_threadpool import Storage as ThreadpoolStorage
+
+PAGE_SIZE = mmap.PAGESIZE
+
+
+class FilePool(ThreadpoolFilePool):
+
+    def __init__(self, doneflag, add_task, external_add_task,
+                 max_files_open, num_disk_threads):
+        # filename => mmap, least recently used first
+        self.maps = OrderedDict()
+        self.maps_lock = threading.Lock()
+        ThreadpoolFilePool.__init__(self, doneflag, add_task,
+                                    external_add_task, max_files_open,
+                                    num_disk_threads)
+
+    def close_all(self):
+        self.maps_lock.acquire()
+        self.maps.clear()
+        self.maps_lock.release()
+        ThreadpoolFilePool.close_all(self)
+
+    def close_files(self, file_set):
+        self.maps_lock.acquire()
+        for filename in file_set.iterkeys():
+            if filename in self.maps:
+                del self.maps[filename]
+        self.maps_lock.release()
+        ThreadpoolFilePool.close_files(self, file_set)
+
+    def acquire_map(self, filename, end):
+        """Returns a read-only mapping of filename which covers at least the
+           first end bytes. Called on the disk threads."""
+        self.maps_lock.acquire()
+        try:
+            if filename not in self.file_to_torrent:
+                raise UnregisteredFileException()
+            m = None
+            if filename in self.maps:
+                m = self.maps.pop(filename)
+            if m is None or len(m) < end:
+                # new, or the file has grown since it was mapped
+                self._ensure_exists(filename)
+                h = file(filename, 'rb')
+                try:
+                    size = os.fstat(h.fileno()).st_size
+                    if size < end:
+                        raise BTFailure(_("Short read (%d of %d) - something "
+                                          "truncated files?") % (size, end))
+                    # the mapping stays valid after the handle is closed, so
+                    # maps don't count against the open file limit
+                    m = mmap.mmap(h.fileno(), size, access=mmap.ACCESS_READ)
+                finally:
+                    h.close()
+            self.maps[filename] = m
+            # Dropping a reference is enough to unmap. Any buffer still
+            # queued for upload keeps its mapping alive until it is sent.
+            while len(self.maps) > self.max_files_open:
+                self.maps.popitem()
+            return m
+        finally:
+            self.maps_lock.release()
+
+
+class Storage(ThreadpoolStorage):
+
+    def _read(self, filename, pos, amount):
+        m = self.filepool.acquire_map(filename, pos + amount)
+        # fault the pages in here on the disk thread rather than later on
+        # the reactor thread
+        for i in xrange(pos - pos % PAGE_SIZE, pos + amount, PAGE_SIZE):
+            m[i]
+        return buffer(m, pos, amount)
+
+    def _batch_read(self, pos, amount, background=False):
+        # buffered writes have to hit the disk before they can be read back
+        if self._overlapping_runs(pos, pos + amount):
+            df = self.flush(pos, amount)
+            yield df
+            df.getResult()
+
+        dfs = []
+        for filename, pos, end in self._intervals(pos, amount):
+            df = self.filepool.read(self._read, filename, pos, end - pos,
+                                    background=background)
+            dfs.append(df)
+
+        r = []
+        exc = None
+        for df in dfs:
+            yield df
+            try:
+                r.append(df.getResult())
+            except:
+                exc = exc or sys.exc_info()
+        if exc:
+            raise exc[0], exc[1], exc[2]
+
+        if len(r) == 1:
+            # the common case, no copy at all
+            r = r[0]
+        else:
+            r = ''.join([str(b) for b in r])
+
+        if len(r) != amount:
+            raise BTFailure(_("Short read (%d of %d) - something truncated files?") %
+                            (len(r), amount))
+
+        yield r
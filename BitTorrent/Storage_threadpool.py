@@ -15,8 +15,7 @@
 
 import os
 import sys
-import Queue
-from bisect import bisect_right
+from bisect import bisect_left, bisect_right
 from BTL.translation import _
 
 from BTL.obsoletepythonsupport import set
@@ -26,11 +25,15 @@ from BTL.defer import Deferred, ThreadedDeferred, Failure, wrap_task
 from BTL.yielddefer import launch_coroutine
 from BitTorrent.platform import get_allocated_regions
 from BTL.sparse_set import SparseSet
-from BTL.DictWithLists import DictWithLists, DictWithSets
+from BTL.DictWithLists import DictWithLists, DictWithSets, DictWithInts
 import BTL.stackthreading as threading
 from BitTorrent.Storage_base import open_sparse_file, make_file_sparse
 from BitTorrent.Storage_base import bad_libc_workaround, is_open_for_write
 from BitTorrent.Storage_base import UnregisteredFileException
+from BitTorrent import Storage_base
+from BitTorrent.DiskQueue import DiskQueue
+from BitTorrent.DiskQueue import PRIORITY_READ, PRIORITY_WRITE
+from BitTorrent.DiskQueue import PRIORITY_BACKGROUND
 
 
 class FilePool(object):
@@ -44,10 +47,14 @@ class FilePool(object):
         self.free_handle_condition = threading.Condition()
         self.active_file_to_handles = DictWithSets()
         self.open_file_to_handles = DictWithLists()
+        # with positional I/O there is no seek race, so an active handle can
+        # be handed to several disk threads at once. counts users per handle.
+        self.share_handles = Storage_base.has_positional_io
+        self.handle_users = DictWithInts()
 
         self.set_max_files_open(max_files_open)
 
-        self.diskq = Queue.Queue()
+        self.diskq = DiskQueue()
         for i in xrange(num_disk_threads):
             t = threading.Thread(target=self._disk_thread,
                                  name="disk_thread-%s" % (i+1))
@@ -149,6 +156,13 @@ class FilePool(object):
             self.free_handle_condition.release()
             raise UnregisteredFileException()
 
+        if self.share_handles and filename in self.active_file_to_handles:
+            for handle in self.active_file_to_handles.getrow(filename):
+                if not for_write or is_open_for_write(handle.mode):
+                    self.handle_users.add(handle)
+                    self.free_handle_condition.release()
+                    return handle
+
         while self.active_file_to_handles.total_length() == self.max_files_open:
             self.free_handle_condition.wait()
 
@@ -171,11 +185,17 @@ class FilePool(object):
                 handle = open_sparse_file(filename, 'rb', length=length)
 
         self.active_file_to_handles.push_to_row(filename, handle)
+        self.handle_users.add(handle)
         self.free_handle_condition.release()
         return handle
 
     def release_handle(self, filename, handle):
         self.free_handle_condition.acquire()
+        self.handle_users.remove(handle)
+        if handle in self.handle_users:
+            # still in use by another disk thread
+            self.free_handle_condition.release()
+            return
         self.active_file_to_handles.remove_fom_row(filename, handle)
         self.open_file_to_handles.push_to_row(filename, handle)
         self.free_handle_condition.notify()
@@ -185,8 +205,27 @@ class FilePool(object):
         df = Deferred()
         self.diskq.put((df, _f, args, kwargs))
         return df
-    read = _create_op
-    write = _create_op
+
+    def _create_file_op(self, priority, _f, filename, pos, *args):
+        df = Deferred()
+        torrent = self.file_to_torrent.get(filename)
+        self.diskq.put((df, _f, (filename, pos) + args, {}),
+                       torrent=torrent, filename=filename, pos=pos,
+                       priority=priority)
+        return df
+
+    def read(self, _f, filename, pos, *args, **kwargs):
+        if kwargs.get('background'):
+            priority = PRIORITY_BACKGROUND
+        else:
+            priority = PRIORITY_READ
+        return self._create_file_op(priority, _f, filename, pos, *args)
+
+    def write(self, _f, filename, pos, *args):
+        return self._create_file_op(PRIORITY_WRITE, _f, filename, pos, *args)
+
+    def get_disk_queue_stats(self):
+        return self.diskq.get_stats()
 
     def _disk_thread(self):
         while not self.doneflag.isSet():
@@ -209,6 +248,14 @@ class Storage(object):
         self.doneflag = doneflag
         self.add_task = add_task
         self.external_add_task = external_add_task
+        # write-back buffer: sorted begins of contiguous dirty runs, and
+        # begin => [end, chunks] for each run
+        self._dirty_begins = []
+        self._dirty_runs = {}
+        self._dirty_size = 0
+        self._flush_scheduled = False
+        self._write_error = None
+        self._write_error_reported = False
         self.initialize(save_path, files)
 
     def initialize(self, save_path, files):
@@ -303,19 +350,29 @@ class Storage(object):
         if h is None:
             return
         try:
-            h.seek(pos)
-            r = h.read(amount)
+            if self.filepool.share_handles:
+                r = Storage_base.pread(h.fileno(), amount, pos)
+            else:
+                h.seek(pos)
+                r = h.read(amount)
         finally:
             self.filepool.release_handle(filename, h)
         return r
 
-    def _batch_read(self, pos, amount):
+    def _batch_read(self, pos, amount, background=False):
         dfs = []
         r = []
 
+        # buffered writes have to hit the disk before they can be read back
+        if self._overlapping_runs(pos, pos + amount):
+            df = self.flush(pos, amount)
+            yield df
+            df.getResult()
+
         # queue all the reads
         for filename, pos, end in self._intervals(pos, amount):
-            df = self.filepool.read(self._read, filename, pos, end - pos)
+            df = self.filepool.read(self._read, filename, pos, end - pos,
+                                    background=background)
             dfs.append(df)
 
         # yield on all the reads in order - they complete in any order
@@ -337,36 +394,71 @@ class Storage(object):
 
         yield r
 
-    def read(self, pos, amount):
+    def read(self, pos, amount, background=False):
+        """background reads, like hash checks, queue behind uploads."""
         df = launch_coroutine(wrap_task(self.add_task),
-                              self._batch_read, pos, amount)
+                              self._batch_read, pos, amount,
+                              background=background)
         return df
 
-    def _write(self, filename, pos, s):
+    def _write(self, filename, pos, chunks):
         begin, end = self.get_byte_range_for_filename(filename)
         length = end - begin
         h = self.filepool.acquire_handle(filename, for_write=True, length=length)
         if h is None:
             return
         try:
-            h.seek(pos)
-            h.write(s)
+            if self.filepool.share_handles:
+                total = Storage_base.pwritev(h.fileno(), chunks, pos)
+            else:
+                h.seek(pos)
+                total = 0
+                for c in chunks:
+                    h.write(c)
+                    total += len(c)
         finally:
             self.filepool.release_handle(filename, h)
-        return len(s)
+        return total
+
+    def _split_chunks(self, chunks, lengths):
+        # regroup a list of chunks into one list per length, slicing chunks
+        # which straddle a boundary
+        r = []
+        i = 0
+        offset = 0
+        for length in lengths:
+            group = []
+            while length > 0:
+                c = chunks[i]
+                n = min(len(c) - offset, length)
+                if offset == 0 and n == len(c):
+                    group.append(c)
+                else:
+                    group.append(buffer(c, offset, n))
+                offset += n
+                length -= n
+                if offset == len(c):
+                    i += 1
+                    offset = 0
+            r.append(group)
+        return r
 
     def _batch_write(self, pos, s):
+        """s is a string, or a list of chunks to be written contiguously."""
         dfs = []
 
+        if not isinstance(s, list):
+            s = [s]
+        amount = sum([len(c) for c in s])
+        intervals = self._intervals(pos, amount)
+        groups = self._split_chunks(s, [end - begin
+                                        for filename, begin, end in intervals])
         total = 0
-        amount = len(s)
 
         # queue all the writes
-        for filename, begin, end in self._intervals(pos, amount):
-            length = end - begin
-            d = buffer(s, total, length)
-            total += length
-            df = self.filepool.write(self._write, filename, begin, d)
+        for (filename, begin, end), group in zip(intervals, groups):
+            total += end - begin
+            df = self.filepool.write(self._write, filename, begin, group)
             dfs.append(df)
 
         # yield on all the writes - they complete in any order
@@ -383,14 +475,147 @@ class Storage(object):
         yield total
 
     def write(self, pos, s):
+        """With a write buffer the Deferred fires once s is buffered, not
+           once it is on disk: flush() waits for that. If buffered data
+           can't be written out, every later write and flush fails, and the
+           torrent is told."""
+        if self.config['write_buffer_size'] <= 0:
+            df = launch_coroutine(wrap_task(self.add_task),
+                                  self._batch_write, pos, s)
+            return df
+        df = Deferred()
+        if self._write_error is not None:
+            df.errback(self._write_error)
+            return df
+        self._buffer_write(pos, s)
+        if self._dirty_size > self.config['write_buffer_size']:
+            self._background_flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.add_task(self.config['write_buffer_flush_interval'],
+                          self._flush_timer)
+        df.callback(len(s))
+        return df
+
+    ## write-back buffer
+    ############################################################################
+    def _overlapping_runs(self, pos, end):
+        # runs which overlap or touch [pos, end), in order
+        i = max(bisect_right(self._dirty_begins, pos) - 1, 0)
+        r = []
+        for begin in self._dirty_begins[i:]:
+            if begin > end:
+                break
+            if self._dirty_runs[begin][0] >= pos:
+                r.append(begin)
+        return r
+
+    def _pop_run(self, begin):
+        del self._dirty_begins[bisect_left(self._dirty_begins, begin)]
+        end, chunks = self._dirty_runs.pop(begin)
+        self._dirty_size -= end - begin
+        return end, chunks
+
+    def _buffer_write(self, pos, s):
+        # copy, s may be a view on a reused receive buffer
+        s = str(s)
+        end = pos + len(s)
+        chunks = [s]
+        new_begin = pos
+        new_end = end
+        runs = self._overlapping_runs(pos, end)
+        for begin in runs:
+            run_end, run_chunks = self._pop_run(begin)
+            # only the first run can start before s, and only the last run
+            # can end after it. anything in between is overwritten.
+            if begin < pos:
+                new_begin = begin
+                if run_end == pos:
+                    left = run_chunks
+                else:
+                    left = [''.join(run_chunks)[:pos - begin]]
+                chunks = left + chunks
+            if run_end > end:
+                new_end = run_end
+                if begin == end:
+                    right = run_chunks
+                else:
+                    right = [''.join(run_chunks)[end - begin:]]
+                chunks.extend(right)
+        self._dirty_begins.insert(bisect_left(self._dirty_begins, new_begin),
+                                  new_begin)
+        self._dirty_runs[new_begin] = [new_end, chunks]
+        self._dirty_size += new_end - new_begin
+
+    def get_unflushed_ranges(self):
+        return [(begin, self._dirty_runs[begin][0] - begin)
+                for begin in self._dirty_begins]
+
+    def _flush_timer(self):
+        self._flush_scheduled = False
+        self._background_flush()
+
+    def _background_flush(self):
+        self.flush().addErrback(self._flush_failed)
+
+    def _flush_failed(self, failure):
+        # nobody is waiting on this flush to hear about it
+        if self._write_error_reported:
+            return
+        self._write_error_reported = True
+        for filename in self.range_by_name:
+            torrent = self.filepool.file_to_torrent.get(filename)
+            if torrent is not None:
+                torrent.got_exception(failure)
+                break
+
+    def flush(self, pos=0, amount=None):
+        """Writes out buffered data overlapping [pos, pos + amount), or all
+           buffered data if amount is None."""
+        if amount is None:
+            begins = list(self._dirty_begins)
+        else:
+            begins = [b for b in self._overlapping_runs(pos, pos + amount)
+                      if b < pos + amount and self._dirty_runs[b][0] > pos]
+        runs = []
+        for begin in begins:
+            end, chunks = self._pop_run(begin)
+            runs.append((begin, chunks))
+        df = launch_coroutine(wrap_task(self.add_task),
+                              self._flush, runs)
+        return df
+
+    def _flush(self, runs):
+        if self._write_error is not None:
+            raise self._write_error
+        dfs = [ self.write_through(begin, data) for begin, data in runs ]
+        exc = None
+        for df in dfs:
+            yield df
+            try:
+                df.getResult()
+            except:
+                exc = exc or sys.exc_info()
+        if exc:
+            # the data is gone, so fail every later write and flush too
+            self._write_error = exc[1]
+            raise exc[0], exc[1], exc[2]
+        yield True
+
+    def write_through(self, pos, s):
         df = launch_coroutine(wrap_task(self.add_task),
                               self._batch_write, pos, s)
         return df
+    ############################################################################
 
     def close(self):
         if not self.initialized:
             self.startup_df.addCallback(lambda *a : self.filepool.close_files(self.range_by_name))
             return self.startup_df
+        if self._dirty_begins:
+            df = self.flush()
+            df.addCallback(lambda *a : self.filepool.close_files(self.range_by_name))
+            return df
         self.filepool.close_files(self.range_by_name)
 
     def downloaded(self, pos, length):
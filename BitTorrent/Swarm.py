@@ -0,0 +1,152 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The tracker's record of the peers on one torrent.
+#
+# A peer is one small fixed-layout object. The address it is given out at
+# is kept as the ip string, for the bencoded forms, and in compact form,
+# six bytes, which is what nearly every client asks for. A peer whose
+# address can't be packed, such as an IPv6 one, is left out of compact
+# responses only.
+# The swarm counts its seeds and indexes the leechers and seeds it gives
+# out, so neither an announce nor a scrape scans its peers.
+
+from socket import inet_ntoa
+from struct import unpack
+
+from BTL.bencode import bencode, Bencached
+
+
+def compact_peer_info(ip, port):
+    try:
+        s = ( ''.join([chr(int(i)) for i in ip.split('.')])
+              + chr((port & 0xFF00) >> 8) + chr(port & 0xFF) )
+        if len(s) != 6:
+            s = ''
+    except:
+        s = ''  # not a valid IP, must be a domain name
+    return s
+
+
+class Peer(object):
+
+    __slots__ = ('id', 'ip', 'port', 'left', 'key', 'given_ip', 'nat',
+                 'time', 'out_ip', 'addr')
+
+    def __init__(self, id, ip, port, left, key=None, given_ip=None):
+        self.id = id
+        self.ip = ip
+        self.port = port
+        self.left = left
+        self.key = key
+        self.given_ip = given_ip
+        # -1 while a NAT check is outstanding, otherwise the number of
+        # failed checks
+        self.nat = -1
+        self.time = 0
+        # ip others are given, None if not given out
+        self.out_ip = None
+        # compact address others are given, '' if out_ip can't be packed
+        self.addr = None
+
+    def encode(self, return_type):
+        """This peer for an announce response: 0 with its id, 1 without,
+           2 compact."""
+        if return_type == 2:
+            return self.addr
+        d = {'ip': self.out_ip, 'port': self.port}
+        if return_type == 0:
+            d['peer id'] = self.id
+        return Bencached(bencode(d))
+
+    def export(self):
+        """This peer as the dictionary the state file holds."""
+        d = {'ip': self.ip, 'port': self.port, 'left': self.left}
+        if self.key is not None:
+            d['key'] = self.key
+        if self.given_ip is not None:
+            d['given ip'] = self.given_ip
+        if self.nat != -1:
+            d['nat'] = self.nat
+        return d
+
+
+class Swarm(object):
+
+    __slots__ = ('peers', 'seeds', 'given', 'cache')
+
+    def __init__(self):
+        self.peers = {}
+        self.seeds = 0
+        # peers given out, by id: leechers, seeds
+        self.given = [{}, {}]
+        # per response type, [time, leechers, seeds] still to give out
+        self.cache = [None, None, None]
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, peerid):
+        return peerid in self.peers
+
+    def get(self, peerid):
+        return self.peers.get(peerid)
+
+    def add(self, peer):
+        self.peers[peer.id] = peer
+        if not peer.left:
+            self.seeds += 1
+
+    def remove(self, peerid):
+        peer = self.peers.pop(peerid)
+        if not peer.left:
+            self.seeds -= 1
+        if peer.out_ip is not None:
+            del self.given[not peer.left][peerid]
+            # out of any cached responses too
+            peer.out_ip = peer.addr = None
+        return peer
+
+    def set_left(self, peer, left):
+        """Returns True if this makes peer a seed. Seeds stay seeds."""
+        if not peer.left:
+            return False
+        peer.left = left
+        if left:
+            return False
+        self.seeds += 1
+        if peer.out_ip is not None:
+            del self.given[0][peer.id]
+            self.given[1][peer.id] = peer
+        return True
+
+    def set_reachable(self, peer, ip, port):
+        """Give peer out to others at ip and port, which is the peer's
+           own port."""
+        self.given[not peer.left][peer.id] = peer
+        peer.out_ip = ip
+        peer.addr = compact_peer_info(ip, port)
+
+    def give(self, peer, addr):
+        """Give peer out to others at addr, in compact form."""
+        self.set_reachable(peer, inet_ntoa(addr[:4]),
+                           unpack('>H', addr[4:])[0])
+
+    def set_unreachable(self, peer):
+        if peer.out_ip is not None:
+            del self.given[not peer.left][peer.id]
+            peer.out_ip = peer.addr = None
+
+    def export(self):
+        return dict([(peerid, peer.export())
+                     for peerid, peer in self.peers.iteritems()])
@@ -42,7 +42,7 @@ from BitTorrent.RateMeasure import RateMeasure
 from BitTorrent.PiecePicker import PiecePicker
 from BitTorrent.Rerequester import Rerequester, DHTRerequester
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.Storage import Storage, UnregisteredFileException
+from BitTorrent.Storage import get_storage_class, UnregisteredFileException
 from BitTorrent.HTTPConnector import URLage
 from BitTorrent.StorageWrapper import StorageWrapper
 from BitTorrent.RequestManager import RequestManager
@@ -104,7 +104,8 @@ class Torrent(object):
                  singleport_listener, ratelimiter, down_ratelimiter,
                  total_downmeasure,
                  filepool, dht, feedback, log_root,
-                 hidden=False, is_auto_update=False):
+                 hidden=False, is_auto_update=False, hashpool=None,
+                 readcache=None):
         # The passed working path and destination_path should be filesystem
         # encoded or should be unicode if the filesystem supports unicode.
         fs_encoding = get_filesystem_encoding()
@@ -126,6 +127,8 @@ class Torrent(object):
         self._ratelimiter = ratelimiter
         self._down_ratelimiter = down_ratelimiter
         self._filepool = filepool
+        self._hashpool = hashpool
+        self._readcache = readcache
         self._dht = dht
         self._choker = choker
         self._total_downmeasure = total_downmeasure
@@ -419,6 +422,7 @@ class Torrent(object):
         self._register_files()
         self.logger.debug("_initialize: self.working_path=%s", self.working_path)
 
+        Storage = get_storage_class(self._filepool)
         self._storage = Storage(self.config, self._filepool, self.working_path,
                                 zip(self._myfiles, self.metainfo.sizes),
                                 self.add_task, self.external_add_task,
@@ -476,7 +480,9 @@ class Torrent(object):
                                               self.destination_path,
                                               resumefile,
                                               self.add_task,
-                                              self.external_add_task)
+                                              self.external_add_task,
+                                              hashpool=self._hashpool,
+                                              readcache=self._readcache)
 
         self._rm.set_storage(self._storagewrapper)
 
@@ -509,7 +515,7 @@ class Torrent(object):
         md = MultiDownload(self.config, self._storagewrapper, self._rm,
                            self._urlage, self._picker, numpieces,
                            self.finished, self.got_exception, kickpeer, banpeer,
-                           self._downmeasure.get_rate)
+                           self._downmeasure.get_rate, self.add_task)
         md.add_useful_received_listener(self._total_downmeasure.update_rate)
         md.add_useful_received_listener(self._downmeasure.update_rate)
         md.add_useful_received_listener(self._ratemeasure.data_came_in)
@@ -542,6 +548,7 @@ class Torrent(object):
                      self._myid, self.add_task, self.infohash, self, addContact,
                      0, tracker_ips, self.log_root)
         self.multidownload.attach_connection_manager(self._connection_manager)
+        self.set_upload_limit()
 
         self._statuscollector = TorrentStats(self.logger, self._choker,
             self.get_uprate, self.get_downrate, self._upmeasure.get_total,
@@ -705,6 +712,7 @@ class Torrent(object):
             df = self._storagewrapper.done_checking_df
             yield df
             df.getResult()
+            self._storagewrapper.discard_read_cache()
 
         if self._storage is not None:
             df = self._storage.close()
@@ -716,6 +724,7 @@ class Torrent(object):
         if self._connection_manager is not None:
             self._down_ratelimiter.remove_throttle_listener(
                 self._connection_manager )
+            self._ratelimiter.remove_group(self._connection_manager)
             self._connection_manager.cleanup()
         self.context_valid = False
 
@@ -1043,6 +1052,19 @@ class Torrent(object):
     def get_rates(self):
         return (self.get_uprate(), self.get_downrate())
 
+    def get_connection_usage(self):
+        if not self.is_running():
+            return None
+        usage = self._connection_manager.get_connection_usage()
+        usage['uprate'] = self._upmeasure.get_rate()
+        return usage
+
+    def set_connection_limit(self, n):
+        """Returns the number of idle connections closed to get under n."""
+        if self._connection_manager is None:
+            return 0
+        return self._connection_manager.set_connection_limit(n)
+
     def get_downtotal(self):
         if self.is_running():
             return self._downmeasure.get_total()
@@ -1104,6 +1126,15 @@ class Torrent(object):
         if self.config.has_key(option) and self.config[option] == value:
             return
         self.config[option] = value
+        if option == 'torrent_max_upload_rate':
+            self.set_upload_limit()
+
+    def set_upload_limit(self):
+        """Applies torrent_max_upload_rate to this torrent's uploads."""
+        if self._connection_manager is not None:
+            self._ratelimiter.set_group_parameters(
+                self._connection_manager,
+                self.config['torrent_max_upload_rate'])
 
     def change_port(self, new_port = None):
         r = self.config['forwarded_port']
@@ -0,0 +1,223 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Piece hashing for torrent creation.
+#
+# The files of a torrent are treated as one stream, cut into batches of whole
+# pieces. Worker threads each read a batch (crossing file boundaries where a
+# piece spans files) and SHA1 it; both the reads and sha release the GIL, so
+# several batches are in flight on different cores and spindles at once. The
+# calling thread puts the digests back in piece order, reports progress and
+# writes the checkpoint.
+
+import os
+import sys
+import time
+import Queue
+from bisect import bisect_right
+from threading import Event
+import BTL.stackthreading as threading
+from BTL.hash import sha
+from BTL.bencode import bencode, bdecode
+from BitTorrent.translation import _
+from BitTorrent import BTFailure
+
+CHECKPOINT_INTERVAL = 10
+
+
+def default_num_threads():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class TorrentHasher(object):
+
+    def __init__(self, files, piece_length, flag=None, num_threads=0,
+                 batch_size=2**22, checkpoint=None):
+        """@param files: [(filename, size)], in torrent order.
+           @param num_threads: worker threads, 0 means one per CPU.
+           @param checkpoint: file to save progress in, or None."""
+        self.files = files
+        self.piece_length = piece_length
+        self.flag = flag or Event()
+        if num_threads <= 0:
+            num_threads = default_num_threads()
+        self.num_threads = num_threads
+        self.checkpoint = checkpoint
+
+        self.starts = []
+        self.total = 0
+        for filename, size in files:
+            self.starts.append(self.total)
+            self.total += size
+        self.numpieces = (self.total + piece_length - 1) // piece_length
+        self.batch_pieces = max(1, batch_size // piece_length)
+        self.numbatches = ((self.numpieces + self.batch_pieces - 1) //
+                           self.batch_pieces)
+
+        self.lock = threading.Lock()
+        self.next_batch = 0
+        self.results = Queue.Queue()
+        self.stopped = Event()
+
+    def _file_info(self):
+        r = []
+        for filename, size in self.files:
+            r.append([filename, size, int(os.path.getmtime(filename))])
+        return r
+
+    def _load_checkpoint(self):
+        """Returns the digests of the pieces hashed by a previous run, as
+           long as the files haven't changed since."""
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return ''
+        try:
+            h = file(self.checkpoint, 'rb')
+            try:
+                d = bdecode(h.read())
+            finally:
+                h.close()
+            if (d['piece length'] != self.piece_length or
+                d['files'] != self._file_info()):
+                return ''
+            pieces = d['pieces']
+        except (IOError, ValueError, KeyError, TypeError):
+            return ''
+        # only keep whole batches, that's where the workers start
+        done = min(len(pieces) // 20, self.numpieces)
+        done -= done % self.batch_pieces
+        return pieces[:done * 20]
+
+    def _save_checkpoint(self, pieces):
+        d = {'piece length': self.piece_length,
+             'files': self._file_info(),
+             'pieces': ''.join(pieces)}
+        tmp = self.checkpoint + '.tmp'
+        h = file(tmp, 'wb')
+        try:
+            h.write(bencode(d))
+        finally:
+            h.close()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        os.rename(tmp, self.checkpoint)
+
+    def _read(self, pos, amount, handles):
+        r = []
+        i = bisect_right(self.starts, pos) - 1
+        while amount > 0:
+            filename, size = self.files[i]
+            offset = pos - self.starts[i]
+            a = min(amount, size - offset)
+            if a > 0:
+                h = handles.get(filename)
+                if h is None:
+                    # a worker moves forward through the files, so only the
+                    # last one is worth keeping open
+                    for old in handles.values():
+                        old.close()
+                    handles.clear()
+                    h = handles[filename] = file(filename, 'rb')
+                h.seek(offset)
+                data = h.read(a)
+                if len(data) != a:
+                    raise BTFailure(_("File %s changed size while the torrent "
+                                      "was being made") % filename)
+                r.append(data)
+                pos += a
+                amount -= a
+            i += 1
+        if len(r) == 1:
+            return r[0]
+        return ''.join(r)
+
+    def _hash_batch(self, i, handles):
+        first = i * self.batch_pieces
+        end = min(first + self.batch_pieces, self.numpieces)
+        pos = first * self.piece_length
+        amount = min(end * self.piece_length, self.total) - pos
+        data = self._read(pos, amount, handles)
+        digests = []
+        for p in xrange(0, amount, self.piece_length):
+            digests.append(sha(buffer(data, p, self.piece_length)).digest())
+        return digests, amount
+
+    def _worker(self):
+        handles = {}
+        try:
+            while not self.stopped.isSet() and not self.flag.isSet():
+                self.lock.acquire()
+                i = self.next_batch
+                self.next_batch += 1
+                self.lock.release()
+                if i >= self.numbatches:
+                    break
+                try:
+                    digests, amount = self._hash_batch(i, handles)
+                except:
+                    self.results.put((i, None, sys.exc_info()))
+                    break
+                self.results.put((i, digests, amount))
+        finally:
+            for h in handles.values():
+                h.close()
+
+    def run(self, progress):
+        """Returns the concatenated piece digests, or None if flag was set.
+           progress is called with the number of bytes hashed since the
+           last call, in file order."""
+        done = self._load_checkpoint()
+        pieces = [done]
+        emitted = len(done) // 20 // self.batch_pieces
+        if done:
+            progress(min(len(done) // 20 * self.piece_length, self.total))
+        self.next_batch = emitted
+
+        threads = []
+        for i in xrange(min(self.num_threads, self.numbatches - emitted)):
+            t = threading.Thread(target=self._worker,
+                                 name="makemetafile_hasher-%s" % (i+1))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        pending = {}
+        last_checkpoint = time.time()
+        try:
+            while emitted < self.numbatches:
+                if self.flag.isSet():
+                    if self.checkpoint is not None:
+                        self._save_checkpoint(pieces)
+                    return None
+                try:
+                    i, digests, amount = self.results.get(True, 0.5)
+                except Queue.Empty:
+                    continue
+                if digests is None:
+                    raise amount[0], amount[1], amount[2]
+                pending[i] = (digests, amount)
+                while emitted in pending:
+                    digests, amount = pending.pop(emitted)
+                    pieces.extend(digests)
+                    emitted += 1
+                    progress(amount)
+                if (self.checkpoint is not None and
+                    time.time() - last_checkpoint > CHECKPOINT_INTERVAL):
+                    self._save_checkpoint(pieces)
+                    last_checkpoint = time.time()
+        finally:
+            self.stopped.set()
+        return ''.join(pieces)
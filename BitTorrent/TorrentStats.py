@@ -64,7 +64,10 @@ class TorrentStats(object):
             d = c.download
             rec['download'] = (d.measure.get_total(), int(d.measure.get_rate()),
                                d.interested, d.choked, d.is_snubbed())
-            rec['max_backlog'] = d._backlog()
+            rec['max_backlog'] = d.window.window
+            # seconds, None until a request has come back
+            rec['rtt'] = d.window.srtt
+            rec['min_rtt'] = d.window.min_rtt
             rec['current_backlog'] = len(d.active_requests)
 
             rec['client_backlog'] = len(u.buffer)
@@ -123,6 +126,13 @@ class TorrentStats(object):
 
         status['pieceStates'] = self.piece_states()
 
+        read_cache = self.storage.get_read_cache_stats()
+        if read_cache is not None:
+            status['read_cache'] = read_cache
+
+        status['haves'] = self.connection_manager.get_have_stats()
+        status['endgame'] = self.multidownload.endgame.get_stats()
+
         if spewflag:
             status['spew'] = self.collect_spew(self.multidownload.numpieces)
             status['bad_peers'] = self.multidownload.bad_peers
@@ -0,0 +1,390 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The tracker's state on disk: a snapshot, and a journal of the changes
+# made since.
+#
+# Changes are appended to the journal as they happen, a record per peer
+# added, changed or dropped, and written out every flush_interval. Every
+# so often a fresh snapshot is written and the journals before it go. A
+# new journal is started first, and the snapshot written by a forked
+# child from its copy of the state, so the tracker carries on answering
+# while the snapshot is written. Where there is no fork the snapshot is
+# encoded in this process and written from a thread, as the pickled state
+# file used to be.
+#
+# Both are binary, in fixed layouts. At startup the snapshot is mapped
+# into memory and decoded in one pass, with no unpickling of the peers,
+# then the journals since it are replayed. Every peer is built then, as
+# the tracker goes through them all to set up their expiry anyway. A journal ending in a partial record, as after a crash, is
+# read up to it.
+#
+# Snapshot: header, then completed counts, then per torrent its peers,
+# then everything else in the state pickled:
+#   'BTTRACKS' version:H journal:I ncompleted:I nswarms:I
+#   (infohash:20s completed:Q) * ncompleted
+#   (infohash:20s npeers:I peer * npeers) * nswarms
+#   length:I pickle
+# Journal:
+#   'BTTRACKJ' version:H journal:I
+#   ('P' infohash:20s peer | 'D' infohash:20s peerid:20s |
+#    'X' infohash:20s | 'C' infohash:20s completed:Q) *
+# Peer:
+#   id:20s port:H left:Q nat:i iplen:H given_iplen:H keylen:H out_iplen:H
+#   ip given_ip key out_ip
+# The addresses are kept as the strings they came as, so hostnames and
+# IPv6 addresses are saved like any other. out_ip is the ip the peer is
+# given out at, empty if it isn't. A keylen of 0xFFFF is no key, which is
+# not the same as an empty one. The lengths fit in two bytes as the whole
+# announce does.
+
+import os
+import sys
+import mmap
+import cPickle
+import traceback
+from struct import Struct, error as struct_error
+
+from BTL.defer import ThreadedDeferred
+from BTL.yielddefer import wrap_task
+from BitTorrent.Swarm import Peer, Swarm
+
+VERSION = 1
+SNAPSHOT_MAGIC = 'BTTRACKS'
+JOURNAL_MAGIC = 'BTTRACKJ'
+
+SNAPSHOT_HEADER = Struct('>8sHIII')
+JOURNAL_HEADER = Struct('>8sHI')
+COMPLETED = Struct('>20sQ')
+SWARM = Struct('>20sI')
+PEER = Struct('>20sHQiHHHH')
+REMOVE = Struct('>20s20s')
+
+NO_KEY = 0xFFFF
+MAX_LEFT = 2 ** 64 - 1
+# seconds between checks on a snapshot being written
+CHILD_POLL_INTERVAL = 1.0
+
+
+def encode_peer(peer):
+    ip = peer.ip
+    given_ip = peer.given_ip or ''
+    key = peer.key
+    if key is None:
+        key = ''
+        keylen = NO_KEY
+    else:
+        keylen = len(key)
+    out_ip = peer.out_ip or ''
+    return ''.join((PEER.pack(peer.id, peer.port, min(peer.left, MAX_LEFT),
+                              peer.nat, len(ip), len(given_ip), keylen,
+                              len(out_ip)),
+                    ip, given_ip, key, out_ip))
+
+
+def _take(buf, offset, n):
+    s = buf[offset:offset + n]
+    if len(s) != n:
+        raise struct_error('truncated peer')
+    return s, offset + n
+
+
+def decode_peer(buf, offset):
+    """Returns the peer at offset in buf, the ip it is given out at and
+       the offset after it."""
+    (peerid, port, left, nat, iplen, given_iplen, keylen,
+     out_iplen) = PEER.unpack_from(buf, offset)
+    offset += PEER.size
+    ip, offset = _take(buf, offset, iplen)
+    given_ip, offset = _take(buf, offset, given_iplen)
+    key = None
+    if keylen != NO_KEY:
+        key, offset = _take(buf, offset, keylen)
+    out_ip, offset = _take(buf, offset, out_iplen)
+    peer = Peer(peerid, ip, port, left, key, given_ip or None)
+    peer.nat = nat
+    return peer, out_ip or None, offset
+
+
+def put_peer(downloads, infohash, peer, out_ip):
+    swarm = downloads.get(infohash)
+    if swarm is None:
+        swarm = downloads[infohash] = Swarm()
+    elif peer.id in swarm:
+        swarm.remove(peer.id)
+    swarm.add(peer)
+    if out_ip is not None:
+        swarm.set_reachable(peer, out_ip, peer.port)
+
+
+class TrackerStore(object):
+
+    def __init__(self, path, rawserver, flush_interval, errorfunc):
+        self.path = path
+        self.rawserver = rawserver
+        self.flush_interval = flush_interval
+        # errorfunc(message, exc_info)
+        self.errorfunc = errorfunc
+        self.journal = None
+        self.seq = 0
+        self.pending = []
+        self.flush_task = None
+        self.child = None
+        self.saving = False
+
+    def _journal_path(self, seq):
+        return '%s.journal.%d' % (self.path, seq)
+
+    def _journals(self):
+        """The sequence numbers of the journals on disk, in order."""
+        d, name = os.path.split(self.path)
+        prefix = name + '.journal.'
+        seqs = []
+        for f in os.listdir(d or os.curdir):
+            if f.startswith(prefix) and f[len(prefix):].isdigit():
+                seqs.append(int(f[len(prefix):]))
+        seqs.sort()
+        return seqs
+
+    def load(self, legacy):
+        """Returns (downloads, completed, rest of the state) as they were
+           saved, with the journals replayed. legacy reads the state file
+           the tracker used to write, returning the same. Raises
+           ValueError if something can't be read."""
+        downloads = {}
+        completed = {}
+        state = {}
+        seq = 0
+        if os.path.exists(self.path):
+            f = open(self.path, 'rb')
+            try:
+                if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    f.seek(0)
+                    downloads, completed, state = legacy(f.read())
+                else:
+                    try:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (mmap.error, EnvironmentError):
+                        f.seek(0)
+                        m = f.read()
+                    try:
+                        try:
+                            seq, state = self._read_snapshot(m, downloads,
+                                                             completed)
+                        except struct_error, e:
+                            raise ValueError('snapshot truncated: %s' % e)
+                    finally:
+                        if isinstance(m, mmap.mmap):
+                            m.close()
+            finally:
+                f.close()
+        # journals go on after the last, whatever is read
+        self.seq = seq
+        for s in self._journals():
+            if s >= seq:
+                self._read_journal(s, downloads, completed)
+            self.seq = max(self.seq, s)
+        return downloads, completed, state
+
+    def _read_snapshot(self, m, downloads, completed):
+        (magic, version, seq, ncompleted,
+         nswarms) = SNAPSHOT_HEADER.unpack_from(m, 0)
+        if version != VERSION:
+            raise ValueError('snapshot version %d not supported' % version)
+        offset = SNAPSHOT_HEADER.size
+        for i in xrange(ncompleted):
+            infohash, n = COMPLETED.unpack_from(m, offset)
+            completed[infohash] = n
+            offset += COMPLETED.size
+        for i in xrange(nswarms):
+            infohash, npeers = SWARM.unpack_from(m, offset)
+            offset += SWARM.size
+            swarm = downloads[infohash] = Swarm()
+            for j in xrange(npeers):
+                peer, out_ip, offset = decode_peer(m, offset)
+                swarm.add(peer)
+                if out_ip is not None:
+                    swarm.set_reachable(peer, out_ip, peer.port)
+        (length,) = Struct('>I').unpack_from(m, offset)
+        offset += 4
+        state = cPickle.loads(m[offset:offset + length])
+        return seq, state
+
+    def _read_journal(self, seq, downloads, completed):
+        f = open(self._journal_path(seq), 'rb')
+        data = f.read()
+        f.close()
+        if len(data) < JOURNAL_HEADER.size:
+            return
+        magic, version, s = JOURNAL_HEADER.unpack_from(data, 0)
+        if magic != JOURNAL_MAGIC or version != VERSION or s != seq:
+            raise ValueError('journal %d is not a version %d journal' %
+                             (seq, VERSION))
+        offset = JOURNAL_HEADER.size
+        try:
+            while offset < len(data):
+                op = data[offset]
+                infohash = data[offset + 1:offset + 21]
+                if len(infohash) != 20:
+                    break
+                offset += 21
+                if op == 'P':
+                    peer, out_ip, offset = decode_peer(data, offset)
+                    put_peer(downloads, infohash, peer, out_ip)
+                elif op == 'D':
+                    (peerid,) = Struct('>20s').unpack_from(data, offset)
+                    offset += 20
+                    swarm = downloads.get(infohash)
+                    if swarm is not None and peerid in swarm:
+                        swarm.remove(peerid)
+                elif op == 'X':
+                    downloads.pop(infohash, None)
+                elif op == 'C':
+                    (completed[infohash],) = Struct('>Q').unpack_from(data,
+                                                                      offset)
+                    offset += 8
+                else:
+                    raise ValueError('journal %d: unknown record %r' %
+                                     (seq, op))
+        except struct_error:
+            # cut off part way through writing it
+            pass
+
+    def start(self):
+        """Starts a new journal for the changes from now on."""
+        if self.journal is not None:
+            self.flush()
+            self.journal.close()
+        # never append to a journal left from before
+        self.seq = max([self.seq] + self._journals()) + 1
+        self.journal = open(self._journal_path(self.seq), 'ab')
+        self.journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, VERSION,
+                                               self.seq))
+        self.journal.flush()
+
+    def _record(self, r):
+        self.pending.append(r)
+        if self.flush_task is None:
+            self.flush_task = self.rawserver.add_task(self.flush_interval,
+                                                      self.flush)
+
+    def peer_changed(self, infohash, peer):
+        self._record('P' + infohash + encode_peer(peer))
+
+    def peer_removed(self, infohash, peerid):
+        self._record('D' + REMOVE.pack(infohash, peerid))
+
+    def swarm_removed(self, infohash):
+        self._record('X' + infohash)
+
+    def completed_changed(self, infohash, n):
+        self._record('C' + COMPLETED.pack(infohash, n))
+
+    def flush(self):
+        if self.flush_task is not None:
+            if self.flush_task.active():
+                self.flush_task.cancel()
+            self.flush_task = None
+        if not self.pending or self.journal is None:
+            return
+        pending = self.pending
+        self.pending = []
+        self.journal.write(''.join(pending))
+        self.journal.flush()
+
+    def close(self):
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def snapshot(self, downloads, completed, state):
+        """Writes the state as it is now in the background, unless a
+           snapshot is still being written."""
+        if self.saving:
+            return
+        self.saving = True
+        # the snapshot covers everything up to here
+        self.start()
+        seq = self.seq
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    try:
+                        self._write_snapshot(seq, downloads, completed, state)
+                    except:
+                        traceback.print_exc()
+                        code = 1
+                finally:
+                    os._exit(code)
+            self.child = pid
+            self.rawserver.add_task(CHILD_POLL_INTERVAL, self._check_child)
+        else:
+            data = self._encode_snapshot(seq, downloads, completed, state)
+            df = ThreadedDeferred(wrap_task(self.rawserver.external_add_task),
+                                  self._write, seq, data)
+            def cb(r):
+                self.saving = False
+            def eb(etup):
+                self.saving = False
+                self.errorfunc("save_dfile: snapshot failed", etup)
+            df.addCallbacks(cb, eb)
+
+    def _check_child(self):
+        try:
+            pid, status = os.waitpid(self.child, os.WNOHANG)
+        except OSError:
+            # reaped by someone else
+            pid, status = self.child, 0
+        if not pid:
+            self.rawserver.add_task(CHILD_POLL_INTERVAL, self._check_child)
+            return
+        self.child = None
+        self.saving = False
+        if status:
+            self.errorfunc("save_dfile: snapshot process exited with "
+                           "status %d" % status, None)
+
+    def _encode_snapshot(self, seq, downloads, completed, state):
+        r = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, VERSION, seq,
+                                  len(completed), len(downloads))]
+        for infohash, n in completed.iteritems():
+            r.append(COMPLETED.pack(infohash, n))
+        for infohash, swarm in downloads.iteritems():
+            r.append(SWARM.pack(infohash, len(swarm.peers)))
+            for peer in swarm.peers.itervalues():
+                r.append(encode_peer(peer))
+        s = cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+        r.append(Struct('>I').pack(len(s)))
+        r.append(s)
+        return ''.join(r)
+
+    def _write_snapshot(self, seq, downloads, completed, state):
+        self._write(seq, self._encode_snapshot(seq, downloads, completed,
+                                               state))
+
+    def _write(self, seq, data):
+        tmp = self.path + '.tmp'
+        h = open(tmp, 'wb')
+        h.write(data)
+        h.flush()
+        os.fsync(h.fileno())
+        h.close()
+        if sys.platform == 'win32' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        for s in self._journals():
+            if s < seq:
+                os.remove(self._journal_path(s))
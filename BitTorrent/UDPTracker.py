@@ -0,0 +1,141 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The UDP tracker protocol (BEP 15), answered from the same Tracker as
+# HTTP. An announce is one datagram each way with fixed binary fields, so
+# there is no connection to set up, nothing to unquote and nothing to
+# bencode; peers go back in compact form.
+#
+# A client first asks for a connection id, which proves it can receive at
+# the address it sends from. The id is a hash of that address, a secret
+# and the current period, so nothing is kept per client: an id is good
+# for the period it was given out in and the next one.
+
+import os
+import socket
+from struct import pack, unpack
+from time import time
+
+from BTL.hash import sha
+
+PROTOCOL_ID = 0x41727101980
+
+CONNECT = 0
+ANNOUNCE = 1
+SCRAPE = 2
+ERROR = 3
+
+EVENTS = {0: None, 1: 'completed', 2: 'started', 3: 'stopped'}
+
+# seconds; clients may use an id for a minute, trackers accept it for two
+CONNECTION_ID_PERIOD = 120
+# as many as fit in a datagram the size of an ethernet frame
+MAX_SCRAPE = 74
+
+ANNOUNCE_FORMAT = '>QII20s20sQQQIIIiH'
+ANNOUNCE_SIZE = 98
+
+
+class UDPTracker(object):
+
+    def __init__(self, tracker, serversocket):
+        self.tracker = tracker
+        self.socket = serversocket
+        self.secret = os.urandom(20)
+
+    def connection_id(self, addr, period):
+        h = sha(self.secret + pack('>4sHI', socket.inet_aton(addr[0]),
+                                   addr[1], period)).digest()
+        return unpack('>Q', h[:8])[0]
+
+    def valid_connection_id(self, addr, connection_id):
+        period = int(time() // CONNECTION_ID_PERIOD)
+        return (connection_id == self.connection_id(addr, period) or
+                connection_id == self.connection_id(addr, period - 1))
+
+    def data_came_in(self, addr, data):
+        if len(data) < 16:
+            return
+        connection_id, action, tid = unpack('>QII', data[:16])
+        if action == CONNECT:
+            if connection_id != PROTOCOL_ID:
+                return
+            period = int(time() // CONNECTION_ID_PERIOD)
+            self.send(addr, pack('>IIQ', CONNECT, tid,
+                                 self.connection_id(addr, period)))
+            return
+        if not self.valid_connection_id(addr, connection_id):
+            self.error(addr, tid, 'invalid connection id')
+            return
+        if action == ANNOUNCE:
+            self.announce(addr, tid, data)
+        elif action == SCRAPE:
+            self.scrape(addr, tid, data)
+        else:
+            self.error(addr, tid, 'unknown action')
+
+    def announce(self, addr, tid, data):
+        if len(data) < ANNOUNCE_SIZE:
+            self.error(addr, tid, 'announce too short')
+            return
+        (connection_id, action, tid, infohash, peerid, downloaded, left,
+         uploaded, event, ip, key, numwant, port) = \
+            unpack(ANNOUNCE_FORMAT, data[:ANNOUNCE_SIZE])
+        t = self.tracker
+        reason = t.not_allowed_reason(infohash)
+        if reason is not None:
+            self.error(addr, tid, reason)
+            return
+        if event not in EVENTS:
+            self.error(addr, tid, 'invalid event')
+            return
+        event = EVENTS[event]
+        gip = None
+        if ip:
+            gip = socket.inet_ntoa(pack('>I', ip))
+        if numwant < 0:
+            numwant = None
+        try:
+            rsize = t.announce(infohash, event, addr[0], peerid, port, left,
+                               '%08x' % key, gip, numwant)
+        except ValueError, e:
+            self.error(addr, tid, str(e))
+            return
+        data = t.peerlist(infohash, event == 'stopped', not left, 2, rsize)
+        self.send(addr, pack('>IIIII', ANNOUNCE, tid, data['interval'],
+                             data['incomplete'], data['complete']) +
+                  ''.join(data['peers']))
+
+    def scrape(self, addr, tid, data):
+        t = self.tracker
+        if t.config['scrape_allowed'] not in ['specific', 'full']:
+            self.error(addr, tid,
+                       'scrape function is not available with this tracker.')
+            return
+        r = [pack('>II', SCRAPE, tid)]
+        for i in xrange(16, min(len(data), 16 + 20 * MAX_SCRAPE) - 19, 20):
+            infohash = data[i:i + 20]
+            if ((t.allowed is not None and infohash not in t.allowed) or
+                infohash not in t.downloads):
+                r.append(pack('>III', 0, 0, 0))
+                continue
+            f = t.scrapedata(infohash, False)
+            r.append(pack('>III', f['complete'], f['downloaded'],
+                          f['incomplete']))
+        self.send(addr, ''.join(r))
+
+    def error(self, addr, tid, message):
+        self.send(addr, pack('>II', ERROR, tid) + message)
+
+    def send(self, addr, packet):
+        self.socket.sendto(packet, 0, addr)
@@ -26,8 +26,10 @@ import logging
 logger = logging.getLogger("BitTorrent.Upload")
 log = logger.debug
 
-# Maximum number of outstanding requests from a peer
-MAX_REQUESTS = 256
+# Maximum number of outstanding requests from a peer, sent to it as reqq.
+# Enough for 1.5 times the bandwidth-delay product of 16 KB chunks at
+# 100 MB/s over a 200 ms round trip
+MAX_REQUESTS = 2048
 
 def _compute_allowed_fast_list(infohash, ip, num_fast, num_pieces):
     
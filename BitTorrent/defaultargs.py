@@ -185,6 +185,12 @@ rare_options = [
      _("number of downloads at which to switch from random to rarest first")),
     ('upload_unit_size', 1380,
      _("how many bytes to write into network buffers at once.")),
+    ('upload_burst', 1.0,
+     _("seconds worth of upload rate which can be sent at once after the "
+       "upload has been idle")),
+    ('torrent_max_upload_rate', 0,
+     _("maximum B/s to upload at for each torrent, within max_upload_rate "
+       "(0 = no limit of its own)")),
     ('retaliate_to_garbled_data', True,
      _("refuse further connections from addresses with broken or intentionally "
        "hostile peers that send incorrect data")),
@@ -202,8 +208,54 @@ rare_options = [
      _("close connections with RST and avoid the TCP TIME_WAIT state")),
     ('num_disk_threads', 3,
      _("number of read threads to use in the storage object")),
+    ('storage_backend', 'auto',
+     _("disk I/O subsystem to use: 'auto', 'threadpool', or 'mmap' to read "
+       "through memory maps (64-bit systems only)")),
     ('num_piece_checks', 2,
      _("number of simultaneous piece checks to run per torrent, set to a low number like 2 or 3")),
+    ('num_hash_threads', 2,
+     _("number of threads to use for verifying existing data at startup "
+       "(0 = verify on the main thread)")),
+    ('hashcheck_reads_in_flight', 4,
+     _("number of read-ahead buffers to keep queued per torrent while "
+       "verifying existing data")),
+    ('incremental_hash_buffer', 2 ** 22,
+     _("maximum number of bytes of out-of-order blocks to hold per torrent "
+       "so that pieces can be verified as they are written instead of being "
+       "read back from disk (0 = always read back)")),
+    ('read_cache_size', 2 ** 25,
+     _("maximum number of bytes of piece data to cache in memory for "
+       "uploading, shared by all torrents (0 = no cache)")),
+    ('read_cache_torrent_size', 2 ** 24,
+     _("maximum number of bytes of the read cache one torrent may use "
+       "(0 = no per-torrent limit)")),
+    ('write_buffer_size', 2 ** 22,
+     _("maximum number of bytes of received data to buffer per torrent so "
+       "that adjacent blocks are written to disk together (0 = write each "
+       "block immediately)")),
+    ('write_buffer_flush_interval', 5.0,
+     _("maximum number of seconds received data is buffered before being "
+       "written to disk")),
+    ('crypto_provider', 'auto',
+     _("where encrypted connections get RC4 and Diffie-Hellman from: "
+       "'openssl', 'pycrypto', or 'auto' for the fastest one available")),
+    ('num_dh_threads', 2,
+     _("number of threads doing key agreement for encrypted connections "
+       "(0 = on the main thread)")),
+    ('max_connections', 0,
+     _("maximum number of peer connections across all torrents, shared out "
+       "by demand (0 = no global limit)")),
+    ('connection_budget_interval', 10.0,
+     _("number of seconds between reallocating the connection budget "
+       "among torrents")),
+    ('have_batch_interval', 0,
+     _("number of seconds to collect verified pieces before announcing them "
+       "to peers in one write (0 = announce each piece right away)")),
+    ('suppress_redundant_haves', False,
+     _("don't announce pieces to peers which already have them")),
+    ('endgame_max_duplicates', 4,
+     _("in endgame, the most peers to request the same block from at once "
+       "(0 = no limit)")),
     ('num_fast', 10,
      _("Number of pieces allowed fast.")),
     ('show_hidden_torrents', False,
@@ -219,6 +271,9 @@ rare_options = [
 tracker_options = [
     ('port', 80,
      _("Port to listen on.")),
+    ('udp_port', 0,
+     _("port to answer UDP tracker announces and scrapes on "
+       "(0 = HTTP only)")),
     ('dfile', u'',
      _("file to store recent downloader info in")),
     ('bind', '',
@@ -227,10 +282,23 @@ tracker_options = [
      _("timeout for closing connections")),
     ('close_with_rst', 0,
      _("close connections with RST and avoid the TCP TIME_WAIT state")),
+    ('http_keepalive_timeout', 5,
+     _("seconds a persistent HTTP connection may sit idle between "
+       "requests before it is closed")),
+    ('http_max_requests_per_connection', 100,
+     _("requests answered on one HTTP connection before it is closed")),
     ('save_dfile_interval', 5 * 60,
-     _("seconds between saving dfile")),
+     _("seconds between saving dfile; changes in between are written to "
+       "a journal next to it")),
+    ('journal_flush_interval', 1.0,
+     _("seconds between writing changes to the dfile journal")),
     ('timeout_downloaders_interval', 45 * 60,
-     _("seconds between expiring downloaders")),
+     _("seconds after its last announce that a downloader is expired")),
+    ('expire_tick_interval', 1.0,
+     _("seconds between passes expiring downloaders")),
+    ('max_expired_per_tick', 2000,
+     _("most downloaders to expire in one pass; the rest wait for the "
+       "next")),
     ('reannounce_interval', 30 * 60,
      _("seconds downloaders should wait between reannouncements")),
     ('response_size', 50,
@@ -490,6 +558,9 @@ def get_defaults(ui):
         r.extend([
             ('display_interval', 60,
             _("seconds between updates of displayed information")),
+            ('shards', 1,
+             _("number of processes to spread the torrents across, sharing "
+               "one listening port and the rate limits (posix only)")),
             ] )
     elif ui.startswith('launchmany-curses'):
         r.extend([
@@ -511,6 +582,12 @@ def get_defaults(ui):
             ('tracker_name', '',
              _("default tracker name")),
             ('tracker_list', '', ''),
+            ('num_hash_threads', 0,
+             _("number of threads reading and hashing files, "
+               "0 means one per CPU")),
+            ('resume', False,
+             _("save progress next to the .torrent file while hashing, so an "
+               "interrupted run can pick up where it left off")),
             ('use_tracker', True,
              _("if false then make a trackerless torrent, instead of "
                "announce URL, use reliable node in form of <ip>:<port> or an "
@@ -19,7 +19,8 @@ import logging
 from BTL.obsoletepythonsupport import *
 from BTL.platform import bttime
 from BitTorrent.CurrentRateMeasure import Measure
-from BTL.bitfield import Bitfield
+from BitTorrent.RequestWindow import RequestWindow
+from BTL.bitfield import Bitfield, iter_set, bits_andnot
 
 logger = logging.getLogger("BitTorrent.Download")
 log = logger.debug
@@ -75,10 +76,11 @@ class Download(object):
         self.prefer_full = False
         self.active_requests = set()
         self.expecting_reject = set()
-        self.intro_size = self.multidownload.chunksize * 4 # just a guess
         self.measure = Measure(multidownload.config['max_rate_period'])
         self.peermeasure = Measure(
             max(multidownload.storage.piece_size / 10000, 20))
+        self.window = RequestWindow(multidownload.chunksize,
+                                    multidownload.snub_time)
         self.have = Bitfield(multidownload.numpieces)
         self.last = 0
         self.example_interest = None
@@ -117,20 +119,9 @@ class Download(object):
             f(bytes)
 
     def _backlog(self):
-        # Dave's suggestion:
-        # backlog = 2 + thruput delay product in chunks.
-        # Assume one-way download propagation delay is always less than 200ms.
-        # backlog = 2 + int(0.2 * self.measure.get_rate() / 
-        #                 self.multidownload.chunksize
-        # Then eliminate the cap of 50 and the 0.075*backlog. 
-
-        backlog = 2 + int(4 * self.measure.get_rate() /
-                          self.multidownload.chunksize)
-        if self.total_bytes < self.intro_size:
-            # optimistic backlog to get things started
-            backlog = max(10, backlog)
-        if backlog > 50:
-            backlog = max(50, int(.075 * backlog))
+        # the connection's bandwidth-delay product in chunks, measured
+        # from how long requests take to come back
+        backlog = self.window.size(len(self.active_requests))
 
         if self.multidownload.rm.endgame:
             # OPTIONAL: zero pipelining during endgame
@@ -144,15 +135,8 @@ class Download(object):
         if self.have.numfalse == 0:
             self.multidownload.lost_have_all()
         else:
-            # arg, slow
-            count = 0
-            target = len(self.have) - self.have.numfalse
-            for i in xrange(len(self.have)):
-                if count == target:
-                    break
-                if self.have[i]:
-                    self.multidownload.lost_have(i)
-                    count += 1
+            for i in iter_set(self.have.tostring()):
+                self.multidownload.lost_have(i)
         self._letgo()
         self.guard.download = None
         
@@ -160,6 +144,8 @@ class Download(object):
         if not self.active_requests:
             return
         if self.multidownload.rm.endgame:
+            self.multidownload.endgame.dropped(self, self.active_requests,
+                                               self.multidownload.downloads)
             self.active_requests.clear()
             return
         lost = []
@@ -206,26 +192,17 @@ class Download(object):
             return
 
         self.active_requests.remove(req)
+        self.window.piece_received(req, len(piece))
         
         # we still give the peer credit in endgame, since we did request
         # the piece (it was in active_requests)
         self.fire_useful_received_listeners(len(piece))
 
         if self.multidownload.rm.endgame:
-            if req not in self.multidownload.all_requests:
+            # cancels it on the other peers which have it outstanding
+            if not self.multidownload.endgame.received(req, self):
                 self.multidownload.discarded_bytes += len(piece)
                 return
-
-            self.multidownload.all_requests.remove(req)
-
-            for d in self.multidownload.downloads:
-                if d.interested:
-                    if not d.choked and req in d.active_requests:
-                        d.connector.send_cancel(*req)
-                        d.active_requests.remove(req)
-                        if d.connector.uses_fast_extension:
-                            d.expecting_reject.add(req)
-                    d.fix_download_endgame()
         else:
             self._request_more()
             
@@ -249,7 +226,9 @@ class Download(object):
                              "(%d + %d == %d) > %d" %
                              (begin, length, begin + length, piece_size))
         self.multidownload.active_requests_add(index)
-        self.active_requests.add((index, begin, length))
+        req = (index, begin, length)
+        self.active_requests.add(req)
+        self.window.request_sent(req, self.active_requests)
         self.connector.send_request(index, begin, length)
 
     def _request_more(self, indices = []):
@@ -365,26 +344,24 @@ class Download(object):
         self.multidownload.check_enter_endgame()
                 
     def fix_download_endgame(self):
-        want = []
-        for a in self.multidownload.all_requests:
-            if not self.have[a[0]]:
-                continue
-            if a in self.active_requests:
-                continue
-            want.append(a)
+        endgame = self.multidownload.endgame
+        wants = endgame.wants_any(self.have)
 
-        if self.interested and not self.active_requests and not want:
+        if self.interested and not self.active_requests and not wants:
             self.interested = False
             self.connector.send_not_interested()
             return
-        if not self.interested and want:
+        if not self.interested and wants:
             self.interested = True
             self.connector.send_interested()
         if self.choked:
             return
-        random.shuffle(want)
-        for req in want[:self._backlog() - len(self.active_requests)]:
+        n = self._backlog() - len(self.active_requests)
+        if n <= 0:
+            return
+        for req in endgame.wanted_by(self, n):
             self.send_request(*req)
+            endgame.request_sent(self, req)
         
     def got_have(self, index):
         if self.have[index]:
@@ -413,23 +390,19 @@ class Download(object):
             self._got_have_all(have)
             return
         self.have = have
-        # arg, slow
-        count = 0
-        target = len(self.have) - self.have.numfalse
-        for i in xrange(len(self.have)):
-            if count == target:
-                break
-            if self.have[i]:
-                self.multidownload.got_have(i)
-                count += 1
+        have = have.tostring()
+        for i in iter_set(have):
+            self.multidownload.got_have(i)
         if self.multidownload.rm.endgame:
-            for piece, begin, length in self.multidownload.all_requests:
-                if self.have[piece]:
-                    self.interested = True
-                    self.connector.send_interested()
-                    return
-        for piece in self.multidownload.rm.iter_want():
-            if self.have[piece]:
+            if self.multidownload.endgame.wants_any(self.have):
+                self.interested = True
+                self.connector.send_interested()
+                return
+        # what does this peer have that we don't
+        storage = self.multidownload.storage
+        rm = self.multidownload.rm
+        for piece in iter_set(bits_andnot(have, storage.get_have_list())):
+            if rm.want_requests(piece):
                 self.interested = True
                 self.connector.send_interested()
                 return
@@ -451,7 +424,7 @@ class Download(object):
         self.have = have
         self.multidownload.got_have_all()
         if self.multidownload.rm.endgame:
-            for piece, begin, length in self.multidownload.all_requests:
+            if self.multidownload.endgame:
                 self.interested = True
                 self.connector.send_interested()
                 return
@@ -510,6 +483,8 @@ class Download(object):
             self.expecting_reject.remove(req)
 
         if self.multidownload.rm.endgame:
+            self.multidownload.endgame.dropped(self, [req],
+                                               self.multidownload.downloads)
             return
 
         self.multidownload.rm.request_lost(*req)
@@ -49,13 +49,15 @@ def coro(f, *args, **kwargs):
 
 class LaunchMany(object):
 
-    def __init__(self, config, display, configfile_key):
+    def __init__(self, config, display, configfile_key, shard=None):
       """Starts torrents for all .torrent files in a directory tree.
 
          All errors are logged using Python logging to 'configfile_key' logger.
 
          @param config: Preferences object storing config.
          @param display: output function for stats.
+         @param shard: ShardWorker if this is one of several processes, in
+           which case only the torrents in its shard are started.
       """
 
       # 4.4.x version of LaunchMany output exceptions to a displayer.
@@ -69,6 +71,7 @@ class LaunchMany(object):
         self.multitorrent = None
         self.rawserver = None
         self.config = config
+        self.shard = shard
         self.configfile_key = configfile_key
         self.display = display
 
@@ -137,6 +140,8 @@ class LaunchMany(object):
             data_dir = config['data_dir']
             self.multitorrent = MultiTorrent(config, self.rawserver, data_dir,
                                              resume_from_torrent_config=False)
+            if self.shard is not None:
+                self.shard.attach(self)
 
             self.rawserver.add_task(0, self.scan)
             self.rawserver.add_task(0.5, self.periodic_check_hashcheck_queue)
@@ -185,9 +190,13 @@ class LaunchMany(object):
             ( self.torrent_cache, self.file_cache, self.blocked_files,
                 added, removed ) = r
             for infohash, (path, metainfo) in removed.items():
+                if self.shard is not None and not self.shard.owns(infohash):
+                    continue
                 self.logger.info(_('dropped "%s"') % path)
                 self.remove(infohash)
             for infohash, (path, metainfo) in added.items():
+                if self.shard is not None and not self.shard.owns(infohash):
+                    continue
                 self.logger.info(_('added "%s"'  ) % path)
                 if self.config['launch_delay'] > 0:
                     self.rawserver.add_task(self.config['launch_delay'],
@@ -34,6 +34,7 @@ from BTL.exceptions import str_exc
 from BitTorrent import BTFailure
 from BTL.platform import decode_from_filesystem, get_filesystem_encoding
 from BitTorrent.platform import read_language_file
+from BitTorrent.TorrentHasher import TorrentHasher
 
 from khashmir.node import Node
 from khashmir.ktable import KTable
@@ -68,7 +69,9 @@ def make_meta_files(url,
                     content_type=None,  # <---what to do for batch torrents?
                     use_tracker=True,
                     data_dir = None,
-                    url_list = None):
+                    url_list = None,
+                    num_hash_threads=0,
+                    resume=False):
     if len(files) > 1 and target:
         raise BTFailure(_("You can't specify the name of the .torrent file "
                           "when generating multiple torrents at once"))
@@ -110,18 +113,22 @@ def make_meta_files(url,
                            piece_len_exp=my_piece_len_pow2, target=target,
                            title=title, comment=comment, safe=safe,
                            content_type=content_type,
-                           url_list=url_list)
+                           url_list=url_list,
+                           num_hash_threads=num_hash_threads, resume=resume)
         else:
             make_meta_file_dht(f, url, flag=flag, progress=callback,
                                piece_len_exp=my_piece_len_pow2, target=target,
                                title=title, comment=comment, safe=safe,
                                content_type = content_type,
-                               data_dir=data_dir)
+                               data_dir=data_dir,
+                               num_hash_threads=num_hash_threads,
+                               resume=resume)
 
 
 def make_meta_file(path, url, piece_len_exp, flag=Event(), progress=dummy,
                    title=None, comment=None, safe=None, content_type=None,
-                   target=None, url_list=None, name=None):
+                   target=None, url_list=None, name=None,
+                   num_hash_threads=0, resume=False):
     data = {'announce': url.strip(), 'creation date': int(gmtime())}
     piece_length = 2 ** piece_len_exp
     a, b = os.path.split(path)
@@ -132,7 +139,11 @@ def make_meta_file(path, url, piece_len_exp, flag=Event(), progress=dummy,
             f = os.path.join(a, b + '.torrent')
     else:
         f = target
-    info = makeinfo(path, piece_length, flag, progress, name, content_type)
+    checkpoint = None
+    if resume:
+        checkpoint = f + '.part'
+    info = makeinfo(path, piece_length, flag, progress, name, content_type,
+                    num_hash_threads=num_hash_threads, checkpoint=checkpoint)
     if flag.isSet():
         return
     check_info(info)
@@ -152,10 +163,13 @@ def make_meta_file(path, url, piece_len_exp, flag=Event(), progress=dummy,
         data['url-list'] = url_list
     h.write(bencode(data))
     h.close()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
 def make_meta_file_dht(path, nodes, piece_len_exp, flag=Event(),
                        progress=dummy, title=None, comment=None, safe=None,
-                       content_type=None, target=None, data_dir=None):
+                       content_type=None, target=None, data_dir=None,
+                       num_hash_threads=0, resume=False):
     # if nodes is empty, then get them out of the routing table in data_dir
     # else, expect nodes to be a string of comma seperated <ip>:<port> pairs
     # this has a lot of duplicated code from make_meta_file
@@ -168,7 +182,11 @@ def make_meta_file_dht(path, nodes, piece_len_exp, flag=Event(),
             f = os.path.join(a, b + '.torrent')
     else:
         f = target
-    info = makeinfo(path, piece_length, flag, progress, content_type)
+    checkpoint = None
+    if resume:
+        checkpoint = f + '.part'
+    info = makeinfo(path, piece_length, flag, progress, content_type,
+                    num_hash_threads=num_hash_threads, checkpoint=checkpoint)
     if flag.isSet():
         return
     check_info(info)
@@ -196,6 +214,8 @@ def make_meta_file_dht(path, nodes, piece_len_exp, flag=Event(),
         data['safe'] = safe
     h.write(bencode(data))
     h.close()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
 
 def calcsize(path):
@@ -205,8 +225,9 @@ def calcsize(path):
     return total
 
 def makeinfo(path, piece_length, flag, progress, name = None,
-             content_type = None):  # HEREDAVE. If path is directory,
+             content_type = None,   # HEREDAVE. If path is directory,
                                     # how do we assign content type?
+             num_hash_threads = 0, checkpoint = None):
     def to_utf8(name):
         if isinstance(name, unicode):
             u = name
@@ -229,17 +250,9 @@ def makeinfo(path, piece_length, flag, progress, name = None,
     if os.path.isdir(path):
         subs = subfiles(path)
         subs.sort()
-        pieces = []
-        sh = sha()
-        done = 0
         fs = []
-        totalsize = 0.0
-        totalhashed = 0
+        files = []
         for p, f in subs:
-            totalsize += os.path.getsize(f)
-
-        for p, f in subs:
-            pos = 0
             size = os.path.getsize(f)
             p2 = [to_utf8(n) for n in p]
             if content_type:
@@ -247,24 +260,15 @@ def makeinfo(path, piece_length, flag, progress, name = None,
                            'content_type' : content_type}) # HEREDAVE. bad for batch!
             else:
                 fs.append({'length': size, 'path': p2})
-            h = file(f, 'rb')
-            while pos < size:
-                a = min(size - pos, piece_length - done)
-                sh.update(h.read(a))
-                if flag.isSet():
-                    return
-                done += a
-                pos += a
-                totalhashed += a
-
-                if done == piece_length:
-                    pieces.append(sh.digest())
-                    done = 0
-                    sh = sha()
-                progress(a)
-            h.close()
-        if done > 0:
-            pieces.append(sh.digest())
+            files.append((f, size))
+
+        # pieces span file boundaries, the hasher reads across them
+        hasher = TorrentHasher(files, piece_length, flag,
+                               num_threads=num_hash_threads,
+                               checkpoint=checkpoint)
+        pieces = hasher.run(progress)
+        if pieces is None:
+            return
 
         if name is not None:
             assert isinstance(name, unicode)
@@ -272,30 +276,23 @@ def makeinfo(path, piece_length, flag, progress, name = None,
         else:
             name = to_utf8(os.path.split(path)[1])
 
-        return {'pieces': ''.join(pieces),
+        return {'pieces': pieces,
             'piece length': piece_length, 'files': fs,
             'name': name}
     else:
         size = os.path.getsize(path)
-        pieces = []
-        p = 0
-        h = file(path, 'rb')
-        while p < size:
-            x = h.read(min(piece_length, size - p))
-            if flag.isSet():
-                return
-            pieces.append(sha(x).digest())
-            p += piece_length
-            if p > size:
-                p = size
-            progress(min(piece_length, size - p))
-        h.close()
+        hasher = TorrentHasher([(path, size)], piece_length, flag,
+                               num_threads=num_hash_threads,
+                               checkpoint=checkpoint)
+        pieces = hasher.run(progress)
+        if pieces is None:
+            return
         if content_type is not None:
-            return {'pieces': ''.join(pieces),
+            return {'pieces': pieces,
                 'piece length': piece_length, 'length': size,
                 'name': to_utf8(os.path.split(path)[1]),
                 'content_type' : content_type }
-        return {'pieces': ''.join(pieces),
+        return {'pieces': pieces,
             'piece length': piece_length, 'length': size,
             'name': to_utf8(os.path.split(path)[1])}
 
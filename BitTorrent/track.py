@@ -42,6 +42,10 @@ from BitTorrent.configfile import parse_configuration_and_args
 #from BitTorrent.parseargs import parseargs, printHelp
 from BitTorrent.RawServer_twisted import RawServer
 from BitTorrent.HTTPHandler import HTTPHandler
+from BitTorrent.UDPTracker import UDPTracker
+from BitTorrent.Swarm import Peer, Swarm, compact_peer_info
+from BitTorrent.ExpiryQueue import ExpiryQueue
+from BitTorrent.TrackerStore import TrackerStore
 from BTL.parsedir import parsedir
 from BitTorrent.NatCheck import NatCheck
 from BTL.bencode import bencode, bdecode, Bencached
@@ -154,16 +158,6 @@ def get_forwarded_ip(headers):
         return None
     return x
 
-def compact_peer_info(ip, port):
-    try:
-        s = ( ''.join([chr(int(i)) for i in ip.split('.')])
-              + chr((port & 0xFF00) >> 8) + chr(port & 0xFF) )
-        if len(s) != 6:
-            s = ''
-    except:
-        s = ''  # not a valid IP, must be a domain name
-    return s
-
 def is_valid_ipv4(ip):
     a = ip.split('.')
     if len(a) != 4:
@@ -207,62 +201,45 @@ class Tracker(object):
                           _("specified favicon file -- %s -- does not exist.") %
                           favicon)
         self.rawserver = rawserver
-        self.cached = {}    # format: infohash: [[time1, l1, s1], [time2, l2, s2], [time3, l3, s3]]
-        self.cached_t = {}  # format: infohash: [time, cache]
-        self.times = {}
         self.state = {}
-        self.seedcount = {}
-        self.save_pending = False
+        self.timeout_downloaders_interval = config['timeout_downloaders_interval']
+        self.expire_tick_interval = config['expire_tick_interval']
+        # peers by when they last announced
+        self.expiry = ExpiryQueue(self.timeout_downloaders_interval,
+                                  self.expire_tick_interval, self.expire_peer,
+                                  config['max_expired_per_tick'])
         self.parse_pending = False
 
         self.only_local_override_ip = config['only_local_override_ip']
         if self.only_local_override_ip == 2:
             self.only_local_override_ip = not config['nat_check']
 
-        if os.path.exists(self.dfile):
-            try:
-                h = open(self.dfile, 'rb')
-                ds = h.read()
-                h.close()
-                try:
-                    tempstate = cPickle.loads(ds)
-                except:
-                    tempstate = bdecode(ds)  # backwards-compatibility.
-                if not tempstate.has_key('peers'):
-                    tempstate = {'peers': tempstate}
-                statefiletemplate(tempstate)
-                self.state = tempstate
-            except:
-                errorfunc(logging.WARNING,
-                          _("statefile %s corrupt; resetting") % self.dfile)
-
-        self.downloads = self.state.setdefault('peers', {})
-        self.completed = self.state.setdefault('completed', {})
+        # infohash: Swarm
+        self.downloads = {}
+        self.completed = {}
+        self.store = TrackerStore(self.dfile, rawserver,
+                                  config['journal_flush_interval'],
+                                  self._print_error)
+        try:
+            self.downloads, self.completed, self.state = \
+                            self.store.load(self.load_statefile)
+        except:
+            errorfunc(logging.WARNING,
+                      _("statefile %s corrupt; resetting") % self.dfile)
+        self.store.start()
 
-        self.becache = {}   # format: infohash: [[l1, s1], [l2, s2], [l3, s3]]
-        for infohash, ds in self.downloads.iteritems():
-            self.seedcount[infohash] = 0
-            for x, y in ds.iteritems():
-                if not y.get('nat', -1):
-                    ip = y.get('given_ip')
-                    if not (ip and self.allow_local_override(y['ip'], ip)):
-                        ip = y['ip']
-                    self.natcheckOK(infohash, x, ip, y['port'], y['left'])
-                if not y['left']:
-                    self.seedcount[infohash] += 1
-
-        for infohash in self.downloads:
-            self.times[infohash] = {}
-            for peerid in self.downloads[infohash]:
-                self.times[infohash][peerid] = 0
+        now = time()
+        for infohash, swarm in self.downloads.iteritems():
+            for peer in swarm.peers.itervalues():
+                peer.time = now
+                self.expiry.add(peer, infohash, now)
 
         self.reannounce_interval = config['reannounce_interval']
         self.save_dfile_interval = config['save_dfile_interval']
         self.show_names = config['show_names']
         rawserver.add_task(self.save_dfile_interval, self.save_dfile)
         self.prevtime = time()
-        self.timeout_downloaders_interval = config['timeout_downloaders_interval']
-        rawserver.add_task(self.timeout_downloaders_interval, self.expire_downloaders)
+        rawserver.add_task(self.expire_tick_interval, self.expire_downloaders)
         self.logfile = None
         self.log = None
         if (config['logfile'] != '') and (config['logfile'] != '-'):
@@ -309,6 +286,31 @@ class Tracker(object):
         self.uq_broken = unquote('+') != ' '
         self.keep_dead = config['keep_dead']
 
+    def load_statefile(self, ds):
+        """Reads the pickled state file the tracker used to save."""
+        try:
+            tempstate = cPickle.loads(ds)
+        except:
+            tempstate = bdecode(ds)  # backwards-compatibility.
+        if not tempstate.has_key('peers'):
+            tempstate = {'peers': tempstate}
+        statefiletemplate(tempstate)
+        downloads = {}
+        for infohash, ds in tempstate.pop('peers').iteritems():
+            swarm = downloads[infohash] = Swarm()
+            for x, y in ds.iteritems():
+                peer = Peer(x, y['ip'], y['port'], y['left'], y.get('key'),
+                            y.get('given ip'))
+                peer.nat = y.get('nat', -1)
+                swarm.add(peer)
+                if not peer.nat:
+                    ip = peer.given_ip
+                    if not (ip and self.allow_local_override(peer.ip, ip)):
+                        ip = peer.ip
+                    swarm.set_reachable(peer, ip, peer.port)
+        completed = tempstate.pop('completed', {})
+        return downloads, completed, tempstate
+
     def allow_local_override(self, ip, given_ip):
         return is_valid_ipv4(given_ip) and (
             not self.only_local_override_ip or is_local_ip(ip) )
@@ -332,7 +334,9 @@ class Tracker(object):
                 '<ul>\n'
                 '<li><strong>tracker version:</strong> %s</li>\n' \
                 '<li><strong>server time:</strong> %s</li>\n' \
-                '</ul>\n' % (version, isotime()))
+                '<li><strong>peer expiry lag:</strong> %.1f s (worst %.1f s)</li>\n' \
+                '</ul>\n' % (version, isotime(), self.expiry.lag,
+                              self.expiry.max_lag))
             if self.allowed is not None:
                 if self.show_names:
                     names = [ (value[1].name, infohash)
@@ -361,7 +365,7 @@ class Tracker(object):
                     l = self.downloads[infohash]
                     n = self.completed.get(infohash, 0)
                     tn = tn + n
-                    c = self.seedcount[infohash]
+                    c = l.seeds
                     tc = tc + c
                     d = len(l) - c
                     td = td + d
@@ -413,7 +417,7 @@ class Tracker(object):
     def scrapedata(self, infohash, return_name = True):
         l = self.downloads[infohash]
         n = self.completed.get(infohash, 0)
-        c = self.seedcount[infohash]
+        c = l.seeds
         d = len(l) - c
         f = {'complete': c, 'incomplete': d, 'downloaded': n}
         if return_name and self.show_names and self.allowed is not None:
@@ -463,47 +467,61 @@ class Tracker(object):
              open(fpath, 'rb').read())
 
     def check_allowed(self, infohash, paramslist):
+        reason = self.not_allowed_reason(infohash)
+        if reason is not None:
+            return (200, 'Not Authorized', default_headers,
+                    bencode({'failure reason': reason}))
+        return None
+
+    def not_allowed_reason(self, infohash):
         if self.allowed is not None:
             if not self.allowed.has_key(infohash):
-                return (200, 'Not Authorized', default_headers,
-                    bencode({'failure reason':
-                    "Requested download is not authorized for use with this tracker."}))
-                    #_("Requested download is not authorized for use with this tracker.")}))
+                return "Requested download is not authorized for use with this tracker."
+                #_("Requested download is not authorized for use with this tracker.")
             if self.config['allowed_controls']:
                 if self.allowed[infohash].has_key('failure reason'):
-                    return (200, 'Not Authorized', default_headers,
-                        bencode({'failure reason': self.allowed[infohash]['failure reason']}))
-
+                    return self.allowed[infohash]['failure reason']
         return None
 
     def add_data(self, infohash, event, ip, paramslist):
-        peers = self.downloads.setdefault(infohash, {})
-        ts = self.times.setdefault(infohash, {})
-        self.completed.setdefault(infohash, 0)
-        self.seedcount.setdefault(infohash, 0)
-
         def params(key, default = None, l = paramslist):
             if l.has_key(key):
                 return l[key][0]
             return default
 
         myid = params('peer_id','')
+        if len(myid) != 20:
+            raise ValueError, 'id not of length 20'
+        port = int(params('port',''))
+        left = int(params('left',''))
+        numwant = params('numwant')
+        if numwant is not None:
+            numwant = int(numwant)
+        return self.announce(infohash, event, ip, myid, port, left,
+                             params('key'), params('ip') or None, numwant)
+
+    def announce(self, infohash, event, ip, myid, port, left,
+                 mykey = None, gip = None, numwant = None):
+        """Records an announce whose fields are already decoded, and
+           returns how many peers to give back."""
         if len(myid) != 20:
             raise ValueError, 'id not of length 20'
         if event not in ['started', 'completed', 'stopped', 'snooped', None]:
             raise ValueError, 'invalid event'
-        port = int(params('port',''))
         if port < 0 or port > 65535:
             raise ValueError, 'invalid port'
-        left = int(params('left',''))
         if left < 0:
             raise ValueError, 'invalid amount left'
 
-        peer = peers.get(myid)
-        mykey = params('key')
-        auth = not peer or peer.get('key', -1) == mykey or peer.get('ip') == ip
+        swarm = self.downloads.get(infohash)
+        if swarm is None:
+            swarm = self.downloads[infohash] = Swarm()
+        self.completed.setdefault(infohash, 0)
+
+        peer = swarm.get(myid)
+        auth = (not peer or (peer.key is not None and peer.key == mykey) or
+                peer.ip == ip)
 
-        gip = params('ip')
         local_override = gip and self.allow_local_override(ip, gip)
         if local_override:
             ip1 = gip
@@ -512,8 +530,8 @@ class Tracker(object):
         if not auth and local_override and self.only_local_override_ip:
             auth = True
 
-        if params('numwant') is not None:
-            rsize = min(int(params('numwant')), self.max_give)
+        if numwant is not None:
+            rsize = min(numwant, self.max_give)
         else:
             rsize = self.response_size
 
@@ -522,81 +540,77 @@ class Tracker(object):
                 self.delete_peer(infohash,myid)
 
         elif not peer:
-            ts[myid] = time()
-            peer = {'ip': ip, 'port': port, 'left': left}
-            if mykey:
-                peer['key'] = mykey
-            if gip:
-                peer['given ip'] = gip
+            peer = Peer(myid, ip, port, left, mykey or None, gip)
+            peer.time = time()
+            swarm.add(peer)
+            self.expiry.add(peer, infohash, peer.time)
             if port:
                 if not self.natcheck or (local_override and self.only_local_override_ip):
-                    peer['nat'] = 0
-                    self.natcheckOK(infohash,myid,ip1,port,left)
+                    peer.nat = 0
+                    self.natcheckOK(infohash,myid,ip1,port)
                 else:
                     NatCheck(self.connectback_result,infohash,myid,ip1,port,self.rawserver)
             else:
-                peer['nat'] = 2**30
+                peer.nat = 2**30
             if event == 'completed':
                 self.completed[infohash] += 1
-            if not left:
-                self.seedcount[infohash] += 1
-
-            peers[myid] = peer
+                self.store.completed_changed(infohash,
+                                             self.completed[infohash])
+            self.store.peer_changed(infohash, peer)
 
         else:
             if not auth:
                 return rsize    # return w/o changing stats
 
-            ts[myid] = time()
-            if not left and peer['left']:
+            now = time()
+            self.expiry.move(peer, infohash, peer.time, now)
+            peer.time = now
+            # the journal keeps neither the time nor how much a leecher has
+            # left, only whether it is a seed
+            saved = (not peer.left, peer.ip, peer.given_ip, peer.nat,
+                     peer.out_ip)
+            if swarm.set_left(peer, left):
                 self.completed[infohash] += 1
-                self.seedcount[infohash] += 1
-                if not peer.get('nat', -1):
-                    for bc in self.becache[infohash]:
-                        bc[1][myid] = bc[0][myid]
-                        del bc[0][myid]
-            if peer['left']:
-                peer['left'] = left
+                self.store.completed_changed(infohash,
+                                             self.completed[infohash])
 
             recheck = False
-            if ip != peer['ip']:
-                peer['ip'] = ip
+            if ip != peer.ip:
+                peer.ip = ip
                 recheck = True
-            if gip != peer.get('given ip'):
-                if gip:
-                    peer['given ip'] = gip
-                elif peer.has_key('given ip'):
-                    del peer['given ip']
+            if gip != peer.given_ip:
+                peer.given_ip = gip
                 if local_override:
                     if self.only_local_override_ip:
-                        self.natcheckOK(infohash,myid,ip1,port,left)
+                        self.natcheckOK(infohash,myid,ip1,port)
                     else:
                         recheck = True
 
             if port and self.natcheck:
                 if recheck:
-                    if peer.has_key('nat'):
-                        if not peer['nat']:
-                            l = self.becache[infohash]
-                            y = not peer['left']
-                            for x in l:
-                                del x[y][myid]
-                        del peer['nat'] # restart NAT testing
+                    if peer.nat != -1:
+                        swarm.set_unreachable(peer)
+                        peer.nat = -1 # restart NAT testing
                 else:
-                    natted = peer.get('nat', -1)
+                    natted = peer.nat
                     if natted and natted < self.natcheck:
                         recheck = True
 
                 if recheck:
                     NatCheck(self.connectback_result,infohash,myid,ip1,port,self.rawserver)
 
+            if saved != (not peer.left, peer.ip, peer.given_ip, peer.nat,
+                         peer.out_ip):
+                self.store.peer_changed(infohash, peer)
+
         return rsize
 
     def peerlist(self, infohash, stopped, is_seed, return_type, rsize):
         data = {}    # return data
-        seeds = self.seedcount[infohash]
+        swarm = self.downloads[infohash]
+        seeds = swarm.seeds
         data['complete'] = seeds
-        data['incomplete'] = len(self.downloads[infohash]) - seeds
+        data['incomplete'] = len(swarm) - seeds
 
         if ( self.allowed is not None and self.config['allowed_controls'] and
                                 self.allowed[infohash].has_key('warning message') ):
@@ -607,14 +621,13 @@ class Tracker(object):
             data['peers'] = []
             return data
 
-        bc = self.becache.setdefault(infohash,[[{}, {}], [{}, {}], [{}, {}]])
-        len_l = len(bc[0][0])
-        len_s = len(bc[0][1])
+        len_l = len(swarm.given[0])
+        len_s = len(swarm.given[1])
         if not (len_l+len_s):   # caches are empty!
             data['peers'] = []
             return data
         l_get_size = int(float(rsize)*(len_l)/(len_l+len_s))
-        cache = self.cached.setdefault(infohash,[None,None,None])[return_type]
+        cache = swarm.cache[return_type]
         if cache:
             if cache[0] + self.config['min_time_between_cache_refreshes'] < time():
                 cache = None
@@ -623,19 +636,10 @@ class Tracker(object):
                      or len(cache[1]) < l_get_size or not cache[1] ):
                         cache = None
         if not cache:
-            vv = [[],[],[]]
-            cache = [ time(),
-                      bc[return_type][0].values()+vv[return_type],
-                      bc[return_type][1].values() ]
+            cache = [time(), swarm.given[0].values(), swarm.given[1].values()]
             shuffle(cache[1])
             shuffle(cache[2])
-            self.cached[infohash][return_type] = cache
-            for rr in xrange(len(self.cached[infohash])):
-                if rr != return_type:
-                    try:
-                        self.cached[infohash][rr][1].extend(vv[rr])
-                    except:
-                        pass
+            swarm.cache[return_type] = cache
         if len(cache[1]) < l_get_size:
             peerdata = cache[1]
             if not is_seed:
@@ -652,8 +656,15 @@ class Tracker(object):
             if rsize:
                 peerdata.extend(cache[1][-rsize:])
                 del cache[1][-rsize:]
+        # peers dropped or found unreachable since the cache was made
+        # have no address
         if return_type == 2:
-            peerdata = ''.join(peerdata)
+            # nor is there a compact form of every address
+            peerdata = ''.join([peer.addr for peer in peerdata
+                                if peer.addr])
+        else:
+            peerdata = [peer.encode(return_type) for peer in peerdata
+                        if peer.out_ip is not None]
         data['peers'] = peerdata
         return data
 
@@ -733,22 +744,22 @@ class Tracker(object):
 
         return (200, 'OK', default_headers, bencode(data))
 
-    def natcheckOK(self, infohash, peerid, ip, port, not_seed):
-        bc = self.becache.setdefault(infohash,[[{}, {}], [{}, {}], [{}, {}]])
-        bc[0][not not_seed][peerid] = Bencached(bencode({'ip': ip, 'port': port,
-                                              'peer id': peerid}))
-        bc[1][not not_seed][peerid] = Bencached(bencode({'ip': ip, 'port': port}))
-        bc[2][not not_seed][peerid] = compact_peer_info(ip, port)
+    def natcheckOK(self, infohash, peerid, ip, port):
+        swarm = self.downloads[infohash]
+        swarm.set_reachable(swarm.peers[peerid], ip, port)
 
     def natchecklog(self, peerid, ip, port, result):
         print isotime(), '"!natcheck-%s:%i" %s %i 0 - -' % (
             ip, port, quote(peerid), result)
 
     def connectback_result(self, result, downloadid, peerid, ip, port):
-        record = self.downloads.get(downloadid, {}).get(peerid)
+        record = None
+        swarm = self.downloads.get(downloadid)
+        if swarm is not None:
+            record = swarm.get(peerid)
         if ( record is None
-                 or (record['ip'] != ip and record.get('given ip') != ip)
-                 or record['port'] != port ):
+                 or (record.ip != ip and record.given_ip != ip)
+                 or record.port != port ):
             if self.config['log_nat_checks']:
                 self.natchecklog(peerid, ip, port, 404)
             return
@@ -758,48 +769,29 @@ class Tracker(object):
             else:
                 x = 503
             self.natchecklog(peerid, ip, port, x)
-        if not record.has_key('nat'):
-            record['nat'] = int(not result)
+        if record.nat == -1:
+            record.nat = int(not result)
             if result:
-                self.natcheckOK(downloadid,peerid,ip,port,record['left'])
-        elif result and record['nat']:
-            record['nat'] = 0
-            self.natcheckOK(downloadid,peerid,ip,port,record['left'])
+                self.natcheckOK(downloadid,peerid,ip,port)
+        elif result and record.nat:
+            record.nat = 0
+            self.natcheckOK(downloadid,peerid,ip,port)
         elif not result:
-            record['nat'] += 1
+            record.nat += 1
+        self.store.peer_changed(downloadid, record)
 
     def save_dfile(self):
-        if self.save_pending:
-            return
-        self.save_pending = True
-
-        # if this is taking all the time, threading it won't help anyway because
-        # of the GIL
-        #state = bencode(self.state)
-        state = cPickle.dumps(self.state) # pickle handles Unicode.
+        self.store.snapshot(self.downloads, self.completed, self.state)
+        self.rawserver.add_task(self.save_dfile_interval, self.save_dfile)
 
-        df = ThreadedDeferred(wrap_task(self.rawserver.external_add_task),
-                              self._save_dfile, state)
-        def cb(r):
-            self.save_pending = False
-            if NOISY:
-                self._print_event( "save_dfile: Completed" )
-        def eb(etup):
-            self.save_pending = False
-            self._print_exc( "save_dfile: ", etup )
-        df.addCallbacks(cb, eb)
+    def close(self):
+        self.store.close()
 
-    def _save_dfile(self, state):
-        exc_info = None
-        try:
-            h = open(self.dfile, 'wb')
-            h.write(state)
-            h.close()
-        except:
-            exc_info = sys.exc_info()
-        self.rawserver.external_add_task(self.save_dfile_interval, self.save_dfile)
-        if exc_info:
-            raise exc_info[0], exc_info[1], exc_info[2]
+    def _print_error(self, note, etup=None):
+        if etup:
+            self._print_exc(note, etup)
+        else:
+            self._print_event(note)
 
     def parse_allowed(self):
         if self.parse_pending:
@@ -841,42 +833,34 @@ class Tracker(object):
                               str(removed))
 
         for infohash in added:
-            self.downloads.setdefault(infohash, {})
+            if infohash not in self.downloads:
+                self.downloads[infohash] = Swarm()
             self.completed.setdefault(infohash, 0)
-            self.seedcount.setdefault(infohash, 0)
 
         self.state['allowed'] = self.allowed
         self.state['allowed_dir_files'] = self.allowed_dir_files
 
     def delete_peer(self, infohash, peerid):
-        dls = self.downloads[infohash]
-        peer = dls[peerid]
-        if not peer['left']:
-            self.seedcount[infohash] -= 1
-        if not peer.get('nat', -1):
-            l = self.becache[infohash]
-            y = not peer['left']
-            for x in l:
-                del x[y][peerid]
-        del self.times[infohash][peerid]
-        del dls[peerid]
+        peer = self.downloads[infohash].remove(peerid)
+        self.expiry.remove(peer, peer.time)
+        self.store.peer_removed(infohash, peerid)
+
+    def expire_peer(self, peer, infohash):
+        self.downloads[infohash].remove(peer.id)
+        self.store.peer_removed(infohash, peer.id)
 
     def expire_downloaders(self):
-        for infohash, peertimes in self.times.iteritems():
-            items = peertimes.items()
-            for myid, t in items:
-                if t < self.prevtime:
-                    self.delete_peer(infohash, myid)
-        self.prevtime = time()
-        if self.keep_dead != 1:
+        self.expiry.tick()
+        if (self.keep_dead != 1 and
+            time() - self.prevtime >= self.timeout_downloaders_interval):
+            self.prevtime = time()
             items = self.downloads.items()
             for key, peers in items:
                 if len(peers) == 0 and (self.allowed is None or
                                         key not in self.allowed):
-                    del self.times[key]
                     del self.downloads[key]
-                    del self.seedcount[key]
-        self.rawserver.add_task(self.timeout_downloaders_interval,
+                    self.store.swarm_removed(key)
+        self.rawserver.add_task(self.expire_tick_interval,
                                 self.expire_downloaders)
 
     def _print_event(self, message):
@@ -922,16 +906,27 @@ def track(args):
             print "track: create_serversocket, port=", config['port']
             #END
             s = r.create_serversocket(config['port'], config['bind'])
-            handler = HTTPHandler(t.get, config['min_time_between_log_flushes'])
+            handler = HTTPHandler(t.get, config['min_time_between_log_flushes'],
+                                  r.add_task,
+                                  config['http_max_requests_per_connection'],
+                                  config['http_keepalive_timeout'])
             r.start_listening(s, handler)
         except socket.error, e:
             print ("Unable to open port %d.  Use a different port?" %
                    config['port'])
             return
+        if config['udp_port']:
+            try:
+                u = r.create_udpsocket(config['udp_port'], config['bind'])
+                r.start_listening_udp(u, UDPTracker(t, u))
+            except socket.error, e:
+                print ("Unable to open UDP port %d.  Use a different port?" %
+                       config['udp_port'])
+                return
 
         r.listen_forever()
     finally:
-        if t: t.save_dfile()
+        if t: t.close()
         print _("# Shutting down: ") + isotime()
 
 
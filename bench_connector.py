@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmark for Connector message framing: peers which have finished
+# their handshake stream PIECE messages (with the odd HAVE mixed in) into
+# data_came_in in socket-sized chunks, as a fast download would.
+#
+# usage: bench_connector.py [peers] [megabytes] [block_size]
+
+import sys
+import time
+import random
+from struct import pack
+
+from BitTorrent import Connector
+
+GBIT = 10 ** 9 // 8
+
+
+class FakeConnection(object):
+    ip = '127.0.0.1'
+    port = 6881
+    handler = None
+
+
+class FakeParent(object):
+    config = {'max_message_length': 2 ** 23}
+    infohash = '\x00' * 20
+    numpieces = 10000
+    piece_size = 2 ** 18
+
+
+class FakeDownload(object):
+
+    def __init__(self):
+        self.pieces = 0
+        self.haves = 0
+
+    def got_piece(self, index, begin, piece):
+        self.pieces += 1
+
+    def got_have(self, index):
+        self.haves += 1
+
+    def fire_raw_received_listeners(self, bytes):
+        pass
+
+
+def make_connector(i):
+    c = Connector.Connector(FakeParent(), FakeConnection(), '%020d' % i,
+                            False)
+    # skip the handshake, straight to the message stream
+    c._reader = None
+    c.complete = True
+    c.max_message_length = FakeParent.config['max_message_length']
+    c.download = FakeDownload()
+    return c
+
+
+def make_stream(nbytes, block_size):
+    block = 'x' * block_size
+    msgs = []
+    total = 0
+    n = 0
+    while total < nbytes:
+        if n % 16 == 0:
+            m = pack("!ici", 5, Connector.HAVE, n % FakeParent.numpieces)
+        else:
+            m = pack("!icii", 9 + block_size, Connector.PIECE,
+                     n % FakeParent.numpieces, 0) + block
+        msgs.append(m)
+        total += len(m)
+        n += 1
+    return ''.join(msgs)
+
+
+def make_chunks(stream):
+    # what a socket read hands back on a busy link
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = random.choice((1448, 2896, 16384, 32768, 65536))
+        chunks.append(stream[pos:pos+n])
+        pos += n
+    return chunks
+
+
+def main(numpeers=100, megabytes=512, block_size=2 ** 14):
+    random.seed(0)
+    per_peer = megabytes * 2 ** 20 // numpeers
+    chunks = make_chunks(make_stream(per_peer, block_size))
+    peers = [ make_connector(i) for i in xrange(numpeers) ]
+
+    t = time.clock()
+    # interleave the peers, one chunk each in turn
+    for chunk in chunks:
+        for c in peers:
+            c.data_came_in(c.connection, chunk)
+    elapsed = time.clock() - t
+
+    messages = sum([c.download.pieces + c.download.haves for c in peers])
+    nbytes = sum([len(chunk) for chunk in chunks]) * numpeers
+    rate = nbytes / elapsed
+    print "%d peers, %d messages, %.1f MB in %.3fs cpu" % \
+          (numpeers, messages, nbytes / 2.0 ** 20, elapsed)
+    print "%.0f messages/s, %.1f MB/s per core" % \
+          (messages / elapsed, rate / 2.0 ** 20)
+    print "%.1f%% of a core at 1 Gbit/s" % (100.0 * GBIT / rate)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    for name in ('numpeers', 'megabytes', 'block_size'):
+        if args:
+            kw[name] = int(args.pop(0))
+    main(**kw)
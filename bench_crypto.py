@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Throughput of the crypto behind encrypted connections: RC4 per provider,
+# and Diffie-Hellman key agreements inline and on the worker threads.
+#
+# usage: bench_crypto.py [megabytes] [handshakes] [threads]
+
+import sys
+import time
+import Queue
+
+from BTL.defer import DeferredEvent
+from BitTorrent import MSECrypto
+
+
+def bench_rc4(megabytes, block_size=2 ** 14):
+    block = 'x' * block_size
+    n = megabytes * 2 ** 20 // block_size
+    for name, cls in sorted(MSECrypto.rc4_providers.items()):
+        cipher = cls('k' * 20)
+        cipher.discard(1024)
+        t = time.time()
+        for i in xrange(n):
+            cipher.encrypt(block)
+        elapsed = time.time() - t
+        print "rc4 %-8s %8.1f MB/s" % (name, n * block_size / elapsed / 2 ** 20)
+
+
+def bench_dh(handshakes, threads):
+    provider = MSECrypto.CryptoProvider()
+    _, pub = provider.get_keypair()
+    for name, modexp in sorted(MSECrypto.modexp_providers.items()):
+        provider.modexp = modexp
+        privkey, _ = provider.get_keypair()
+        t = time.time()
+        for i in xrange(handshakes):
+            provider.shared_secret(pub, privkey)
+        elapsed = time.time() - t
+        print "dh  %-8s %8.0f handshakes/s inline" % (name, handshakes / elapsed)
+
+    # what the reactor sees: queue everything, then run callbacks as they
+    # come back. the longest callback is the worst stall.
+    for t_count in sorted(set([1, threads])):
+        results = Queue.Queue()
+        doneflag = DeferredEvent()
+        provider = MSECrypto.CryptoProvider('auto', doneflag,
+                                            lambda d, f, *a: results.put((f, a)),
+                                            t_count)
+        privkey, _ = provider.get_keypair()
+        t = time.time()
+        for i in xrange(handshakes):
+            provider.shared_secret(pub, privkey)
+        done = 0
+        stall = 0.0
+        while done < handshakes:
+            f, a = results.get()
+            s = time.time()
+            f(*a)
+            stall = max(stall, time.time() - s)
+            done += 1
+        elapsed = time.time() - t
+        doneflag.set()
+        print "dh  pool x%d  %8.0f handshakes/s, longest reactor stall %.2fms" % \
+              (t_count, handshakes / elapsed, stall * 1000)
+
+
+def main(megabytes=256, handshakes=2000, threads=4):
+    bench_rc4(megabytes)
+    bench_dh(handshakes, threads)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    for name in ('megabytes', 'handshakes', 'threads'):
+        if args:
+            kw[name] = int(args.pop(0))
+    main(**kw)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmark for piece availability: a swarm of peers connecting and
+# disconnecting on a large torrent, with a piece pick per connection. The
+# HAVEs go through MultiDownload, which keeps its own availability index
+# for the piece bar as well as the PiecePicker's.
+#
+# usage: bench_piecepicker.py [peers] [pieces] [churn] [seed_fraction]
+
+import sys
+import time
+import random
+
+from BTL.bitfield import Bitfield, iter_set
+from BitTorrent.PiecePicker import PiecePicker
+from BitTorrent.MultiDownload import MultiDownload
+
+
+def make_peer(numpieces, seed_fraction):
+    if random.random() < seed_fraction:
+        return None
+    have = Bitfield(numpieces)
+    # leechers hold a small, random slice of the torrent
+    for i in random.sample(xrange(numpieces), random.randrange(1, 200)):
+        have[i] = 1
+    return have
+
+
+def connect(md, have):
+    if have is None:
+        md.got_have_all()
+    else:
+        for i in iter_set(have.tostring()):
+            md.got_have(i)
+
+
+def disconnect(md, have):
+    if have is None:
+        md.lost_have_all()
+    else:
+        for i in iter_set(have.tostring()):
+            md.lost_have(i)
+
+
+def main(numpeers=2000, numpieces=200000, churn=20000, seed_fraction=0.3):
+    random.seed(0)
+    config = {'rarest_first_cutoff': 0, 'download_chunk_size': 2 ** 14,
+              'snub_time': 30.0, 'endgame_max_duplicates': 4}
+
+    t = time.time()
+    picker = PiecePicker(config, numpieces, xrange(numpieces))
+    md = MultiDownload(config, None, None, None, picker, numpieces, None,
+                       None, None, None, None, None)
+    print "init %d pieces: %.3fs" % (numpieces, time.time() - t)
+
+    t = time.time()
+    peers = [ make_peer(numpieces, seed_fraction) for i in xrange(numpeers) ]
+    for have in peers:
+        connect(md, have)
+    print "connect %d peers: %.3fs" % (numpeers, time.time() - t)
+
+    seeds = 0
+    picks = 0
+    pick_time = 0.0
+    t = time.time()
+    for n in xrange(churn):
+        i = random.randrange(numpeers)
+        disconnect(md, peers[i])
+        have = peers[i] = make_peer(numpieces, seed_fraction)
+        connect(md, have)
+        if have is None:
+            seeds += 1
+        else:
+            s = time.time()
+            picker.next(have, (), (), ())
+            pick_time += time.time() - s
+            picks += 1
+    elapsed = time.time() - t
+    print "churn %d peers (%d seeds): %.3fs, %.1f us/peer" % \
+          (churn, seeds, elapsed, elapsed * 1e6 / churn)
+    if picks:
+        print "picks %d: %.1f us/pick" % (picks, pick_time * 1e6 / picks)
+    print "distributed copies: %.3f" % picker.get_distributed_copies()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    for name, conv in zip(('numpeers', 'numpieces', 'churn', 'seed_fraction'),
+                          (int, int, int, float)):
+        if args:
+            kw[name] = conv(args.pop(0))
+    main(**kw)
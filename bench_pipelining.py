@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Link utilization of request pipelining over simulated links: one
+# connection to a peer which answers requests in order at a fixed upload
+# rate, with a fixed delay each way. Compares the old backlog heuristic
+# (2 + 4 seconds of the rate in chunks, cut back past 50) with the
+# request window. The peer is one like this client, which says it takes
+# Upload.MAX_REQUESTS.
+#
+# usage: bench_pipelining.py [seconds]
+
+from __future__ import division
+
+import sys
+import heapq
+from collections import deque
+
+from BitTorrent.RequestWindow import RequestWindow
+from BitTorrent.Upload import MAX_REQUESTS
+
+CHUNK = 2 ** 14
+SNUB_TIME = 30.0
+# the old rate measure's period, max_rate_period
+RATE_PERIOD = 20.0
+
+LINKS = [
+    # name, peer upload B/s, round trip seconds
+    ('lan', 10 * 2 ** 20, 0.001),
+    ('dsl', 100 * 2 ** 10, 0.05),
+    ('cable', 2 * 2 ** 20, 0.03),
+    ('transatlantic', 10 * 2 ** 20, 0.15),
+    ('transatlantic fast', 50 * 2 ** 20, 0.15),
+    ('satellite', 1 * 2 ** 20, 0.6),
+    ('satellite fast', 4 * 2 ** 20, 0.6),
+    ]
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class OldBacklog(object):
+    """Download._backlog as it was."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.received = deque()
+        self.in_period = 0
+        self.total = 0
+
+    def size(self, outstanding):
+        now = self.clock()
+        while self.received and self.received[0][0] < now - RATE_PERIOD:
+            self.in_period -= self.received.popleft()[1]
+        rate = self.in_period / max(min(now, RATE_PERIOD), 1)
+        backlog = 2 + int(4 * rate / CHUNK)
+        if self.total < CHUNK * 4:
+            backlog = max(10, backlog)
+        if backlog > 50:
+            backlog = max(50, int(.075 * backlog))
+        return backlog
+
+    def request_sent(self, req, active):
+        pass
+
+    def piece_received(self, req, length):
+        self.received.append((self.clock(), length))
+        self.in_period += length
+        self.total += length
+
+
+class Window(RequestWindow):
+
+    def __init__(self, clock):
+        RequestWindow.__init__(self, CHUNK, SNUB_TIME, clock)
+        # as from the peer's reqq
+        self.set_max_window(MAX_REQUESTS)
+
+
+def simulate(controller, rate, rtt, seconds):
+    clock = Clock()
+    pipe = controller(clock)
+    events = []
+    active = set()
+    state = {'next': 0, 'peer_free': 0.0, 'bytes': 0, 'steady': 0,
+             'peak': 0}
+    steady_from = seconds / 2.0
+
+    def fill():
+        # more than the peer queues would be rejected
+        while len(active) < min(pipe.size(len(active)), MAX_REQUESTS):
+            req = state['next']
+            state['next'] += 1
+            active.add(req)
+            pipe.request_sent(req, active)
+            heapq.heappush(events, (clock.now + rtt / 2, 0, req))
+        state['peak'] = max(state['peak'], len(active))
+
+    fill()
+    while events:
+        when, kind, req = heapq.heappop(events)
+        if when > seconds:
+            break
+        clock.now = when
+        if kind == 0:
+            # at the peer, which sends requests in the order they came
+            start = max(when, state['peer_free'])
+            state['peer_free'] = start + CHUNK / float(rate)
+            heapq.heappush(events, (state['peer_free'] + rtt / 2, 1, req))
+        else:
+            active.discard(req)
+            pipe.piece_received(req, CHUNK)
+            state['bytes'] += CHUNK
+            if when >= steady_from:
+                state['steady'] += CHUNK
+            fill()
+
+    return {
+        'total': state['bytes'] / (rate * seconds),
+        'steady': state['steady'] / (rate * (seconds - steady_from)),
+        'window': pipe.size(len(active)),
+        'peak': state['peak'],
+        'rtt': getattr(pipe, 'min_rtt', None),
+        }
+
+
+def main(seconds=60):
+    print "%d s per link, %d byte chunks, peer queues at most %d requests" % \
+          (seconds, CHUNK, MAX_REQUESTS)
+    print "utilization over the whole run and over the second half"
+    print
+    print "%-19s %9s %7s %7s %7s %9s %7s %9s %7s %9s" % (
+        'link', 'B/s', 'rtt ms', 'BDP', 'old', 'old 2nd', 'new', 'new 2nd',
+        'window', 'est. rtt')
+    for name, rate, rtt in LINKS:
+        bdp = rate * rtt / CHUNK
+        old = simulate(OldBacklog, rate, rtt, seconds)
+        new = simulate(Window, rate, rtt, seconds)
+        print ("%-19s %9d %7.0f %7.1f %6.1f%% %8.1f%% %6.1f%% %8.1f%% "
+               "%7d %9.1f" % (
+            name, rate, rtt * 1000, bdp, old['total'] * 100,
+            old['steady'] * 100, new['total'] * 100, new['steady'] * 100,
+            new['window'], new['rtt'] * 1000))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    if args:
+        kw['seconds'] = int(args.pop(0))
+    main(**kw)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Simulated upload scheduling with the old round-robin limiter and the
+# hierarchical token bucket: many connections, spread unevenly over
+# torrents, each always having data to send and flushing it at its own
+# link speed. Time is simulated, so the CPU figures are the limiter's (and
+# the simulation's) cost alone.
+#
+# Reports how close each gets to the target rate over the whole run and
+# per second, how evenly the torrents and the connections within them
+# are served, and what a send costs.
+#
+# usage: bench_ratelimiter.py [connections] [torrents] [rate] [seconds]
+
+import sys
+import time
+import heapq
+import random
+
+from BitTorrent import NewRateLimiter
+from BitTorrent.HTBRateLimiter import HTBRateLimiter
+
+UNITSIZE = 16384 + 13
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        # the old limiter loops until the clock moves, so reading it takes
+        # a little time like it really does
+        self.now += 1e-6
+        return self.now
+
+    # for NewRateLimiter, which reads time.time() too
+    time = __call__
+
+
+class Task(object):
+
+    def __init__(self, sched, func, args):
+        self.sched = sched
+        self.func = func
+        self.args = args
+        self.called = False
+        self.cancelled = False
+        self.version = 0
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def getTime(self):
+        return self.when
+
+    def reset(self, delay):
+        # the entry already in the heap goes stale
+        self.version += 1
+        self.sched._push(self, delay)
+
+
+class Scheduler(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []
+        self.seq = 0
+
+    def _push(self, task, delay):
+        task.when = self.clock.now + delay
+        self.seq += 1
+        heapq.heappush(self.heap, (task.when, self.seq, task.version, task))
+
+    def add_task(self, delay, func, *args):
+        t = Task(self, func, args)
+        self._push(t, delay)
+        return t
+
+    def run_until(self, end):
+        while self.heap and self.heap[0][0] <= end:
+            when, seq, version, t = heapq.heappop(self.heap)
+            if version != t.version or not t.active():
+                continue
+            self.clock.now = max(self.clock.now, when)
+            t.called = True
+            t.func(*t.args)
+        self.clock.now = end
+
+
+class Torrent(object):
+    # what connections group by, like a ConnectionManager
+    pass
+
+
+class Connection(object):
+
+    def __init__(self, parent, limiter, sched, link):
+        self.parent = parent
+        self.limiter = limiter
+        self.sched = sched
+        self.link = link
+        self.sent = 0
+
+    def send_partial(self, n):
+        self.sent += n
+        self.limiter.sent += n
+        self.limiter.sends += 1
+        # flushed once the link has carried it
+        self.sched.add_task(n / self.link, self.limiter.queue, self)
+        return n
+
+
+def jain(xs):
+    s = sum(xs)
+    q = sum([x * x for x in xs])
+    if not q:
+        return 1.0
+    return float(s * s) / (len(xs) * q)
+
+
+def make_limiter(name, sched, clock):
+    if name == 'old':
+        NewRateLimiter.bttime = clock
+        NewRateLimiter.time = clock
+        limiter = NewRateLimiter.MultiRateLimiter(sched.add_task)
+    else:
+        limiter = HTBRateLimiter(sched.add_task, clock)
+    limiter.sent = 0
+    limiter.sends = 0
+    return limiter
+
+
+def simulate(name, connections, torrents, rate, seconds, limited_rate):
+    random.seed(0)
+    clock = Clock()
+    sched = Scheduler(clock)
+    limiter = make_limiter(name, sched, clock)
+    limiter.set_parameters(rate, UNITSIZE)
+
+    groups = [Torrent() for i in xrange(torrents)]
+    # a few big swarms and many small ones
+    weights = [1.0 / (i + 1) for i in xrange(torrents)]
+    total = sum(weights)
+    conns = []
+    by_group = {}
+    for g, w in zip(groups, weights):
+        by_group[g] = []
+        for i in xrange(max(1, int(connections * w / total))):
+            link = random.choice((32, 128, 512, 2048)) * 1024.0
+            c = Connection(g, limiter, sched, link)
+            by_group[g].append(c)
+            conns.append(c)
+    limited = groups[0]
+    if limited_rate and name != 'old':
+        limiter.set_group_parameters(limited, limited_rate)
+
+    for c in conns:
+        sched.add_task(random.random() * 0.01, limiter.queue, c)
+
+    per_second = []
+    cpu = 0.0
+    for s in xrange(seconds):
+        before = limiter.sent
+        t = time.clock()
+        sched.run_until(s + 1)
+        cpu += time.clock() - t
+        per_second.append(limiter.sent - before)
+
+    # the first second starts with an empty bucket and nothing queued
+    steady = per_second[1:]
+    achieved = sum(steady) / float(len(steady))
+    worst = max([abs(x - rate) for x in steady]) / float(rate)
+    group_bytes = [sum([c.sent for c in by_group[g]]) for g in groups]
+    within = [jain([c.sent for c in by_group[g]]) for g in groups
+              if len(by_group[g]) > 1]
+    return {
+        'conns': len(conns),
+        'achieved': achieved / rate,
+        'worst': worst,
+        'group_fair': jain(group_bytes),
+        'conn_fair': sum(within) / len(within),
+        'limited': group_bytes[0] / float(seconds),
+        'sends': limiter.sends,
+        'cpu': cpu,
+        }
+
+
+def main(connections=10000, torrents=200, rate=10 * 2 ** 20, seconds=20):
+    # half its fair share, so the limit binds
+    limited_rate = rate // (torrents * 2)
+    print "%d connections over %d torrents, %d B/s for %d s" % \
+          (connections, torrents, rate, seconds)
+    print "torrent 0 limited to %d B/s (htb only)" % limited_rate
+    print
+    print "%-7s %9s %9s %10s %9s %12s %9s %9s %11s" % (
+        'limiter', 'achieved', 'worst 1s', 'torrents', 'conns',
+        'torrent 0', 'sends', 'cpu s', 'us/send')
+    for name in ('old', 'htb'):
+        r = simulate(name, connections, torrents, rate, seconds, limited_rate)
+        print "%-7s %8.2f%% %8.2f%% %10.3f %9.3f %10.0f/s %9d %9.2f %11.1f" % (
+            name, r['achieved'] * 100, r['worst'] * 100, r['group_fair'],
+            r['conn_fair'], r['limited'], r['sends'], r['cpu'],
+            r['cpu'] / max(r['sends'], 1) * 1e6)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    for name in ('connections', 'torrents', 'rate', 'seconds'):
+        if args:
+            kw[name] = int(args.pop(0))
+    main(**kw)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Announce load against a tracker: a number of clients announcing as fast
+# as they are answered, each
+#   close     - a new connection per announce (HTTP/1.0)
+#   keepalive - one persistent connection, an announce at a time
+#   pipeline  - one persistent connection, several announces in flight
+# and the announces per second each way gets.
+#
+# Without an address, bittorrent-tracker.py is started on a spare port for
+# the run.
+#
+# usage: bench_tracker_http.py [host:port] [clients] [seconds] [depth]
+
+import os
+import sys
+import time
+import errno
+import random
+import select
+import socket
+import tempfile
+import subprocess
+from urllib import quote
+
+TORRENTS = 1000
+
+
+class Client(object):
+
+    def __init__(self, addr, mode, depth, stats):
+        self.addr = addr
+        self.mode = mode
+        self.depth = depth
+        self.stats = stats
+        self.peer_id = ''.join([chr(random.randrange(256)) for i in xrange(20)])
+        self.port = random.randrange(1024, 65536)
+        self.sock = None
+        self.connect()
+
+    def connect(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.sock.connect(self.addr)
+        except socket.error, e:
+            if e[0] not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise
+        self.buf = ''
+        self.pending = ''
+        self.outstanding = 0
+        self.stats['connects'] += 1
+        self.fill()
+
+    def request(self):
+        infohash = '%020d' % random.randrange(TORRENTS)
+        path = ('/announce?info_hash=%s&peer_id=%s&port=%d&uploaded=0'
+                '&downloaded=0&left=1000&compact=1' %
+                (quote(infohash), quote(self.peer_id), self.port))
+        if self.mode == 'close':
+            return 'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, self.addr[0])
+        return 'GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, self.addr[0])
+
+    def fill(self):
+        if self.mode == 'pipeline':
+            n = self.depth - self.outstanding
+        else:
+            n = 1 - self.outstanding
+        if n <= 0:
+            return
+        data = ''.join([self.request() for i in xrange(n)])
+        # requests are small, the send buffer takes them
+        try:
+            self.sock.sendall(data)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOTCONN):
+                # still connecting; try once the socket is writable
+                self.pending = data
+                return
+            raise
+        self.pending = ''
+        self.outstanding += n
+
+    def writable(self):
+        if self.pending:
+            data = self.pending
+            self.pending = ''
+            self.sock.sendall(data)
+            self.outstanding += data.count('GET ')
+
+    def readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            # closed by the tracker, after the last answer it will give
+            if self.outstanding and self.mode != 'close':
+                self.stats['dropped'] += self.outstanding
+            self.connect()
+            return
+        self.buf += data
+        close = False
+        while True:
+            i = self.buf.find('\r\n\r\n')
+            if i == -1:
+                break
+            head = self.buf[:i].lower()
+            j = head.find('content-length:')
+            if j == -1:
+                break
+            length = int(head[j + 15:].split('\r\n', 1)[0])
+            if len(self.buf) < i + 4 + length:
+                break
+            if not head.startswith('http/1.') or ' 200 ' not in head[:13]:
+                self.stats['errors'] += 1
+            else:
+                self.stats['announces'] += 1
+            if 'connection: close' in head:
+                close = True
+            self.buf = self.buf[i + 4 + length:]
+            self.outstanding -= 1
+        if close:
+            if self.outstanding:
+                self.stats['dropped'] += self.outstanding
+            self.connect()
+        elif self.mode != 'close':
+            self.fill()
+
+
+def run(addr, mode, clients, seconds, depth):
+    stats = {'announces': 0, 'connects': 0, 'errors': 0, 'dropped': 0}
+    cs = [Client(addr, mode, depth, stats) for i in xrange(clients)]
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        bysock = dict([(c.sock, c) for c in cs])
+        w = [c.sock for c in cs if c.pending]
+        r, w, e = select.select(bysock.keys(), w, [], 0.5)
+        for s in w:
+            bysock[s].writable()
+        for s in r:
+            bysock[s].readable()
+    elapsed = time.time() - start
+    for c in cs:
+        c.sock.close()
+    stats['rate'] = stats['announces'] / elapsed
+    return stats
+
+
+def start_tracker():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    dfile = os.path.join(tempfile.mkdtemp(), 'dfile')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'bittorrent-tracker.py')
+    p = subprocess.Popen([sys.executable, script, '--port', str(port),
+                          '--bind', '127.0.0.1', '--dfile', dfile],
+                         stdout=open(os.devnull, 'w'),
+                         stderr=subprocess.STDOUT)
+    for i in xrange(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    return p, ('127.0.0.1', port)
+
+
+def main(addr=None, clients=50, seconds=10, depth=8):
+    tracker = None
+    if addr is None:
+        tracker, addr = start_tracker()
+    try:
+        print "%d clients against %s:%d, %d s per mode" % \
+              ((clients,) + addr + (seconds,))
+        print
+        print "%-10s %12s %10s %8s %8s" % ('mode', 'announces/s',
+                                          'connects', 'errors', 'dropped')
+        for mode in ('close', 'keepalive', 'pipeline'):
+            r = run(addr, mode, clients, seconds, depth)
+            name = mode
+            if mode == 'pipeline':
+                name = 'pipeline%d' % depth
+            print "%-10s %12.0f %10d %8d %8d" % (name, r['rate'],
+                  r['connects'], r['errors'], r['dropped'])
+    finally:
+        if tracker is not None:
+            tracker.terminate()
+            tracker.wait()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kw = {}
+    if args and ':' in args[0]:
+        host, port = args.pop(0).rsplit(':', 1)
+        kw['addr'] = (host, int(port))
+    for name in ('clients', 'seconds', 'depth'):
+        if args:
+            kw[name] = int(args.pop(0))
+    main(**kw)
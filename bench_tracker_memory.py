@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memory per peer of the tracker's peer records: the old layout (a dict
+# per peer, its announce time in a second dict and three pre-encoded
+# forms in the becache) against Swarm and Peer, with the ExpiryQueue
+# entry each peer has in place of the time dict. Every peer is reachable,
+# as with NAT checking off, so the old layout holds all its encodings.
+#
+# Each layout is built in a process of its own and measured by how much
+# that process grows.
+#
+# usage: bench_tracker_memory.py [peers] [torrents]
+
+import os
+import sys
+import random
+import subprocess
+from time import time
+
+from BTL.bencode import bencode, Bencached
+from BitTorrent.Swarm import Peer, Swarm, compact_peer_info
+from BitTorrent.ExpiryQueue import ExpiryQueue
+
+
+def rss():
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        # kilobytes on Linux, bytes on Mac OS X
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def announces(peers, torrents):
+    r = random.Random(0)
+    infohashes = [''.join([chr(r.randrange(256)) for i in xrange(20)])
+                  for i in xrange(torrents)]
+    for i in xrange(peers):
+        infohash = infohashes[r.randrange(torrents)]
+        peerid = '-BT5000-' + '%012d' % r.randrange(10 ** 12)
+        ip = '%d.%d.%d.%d' % (r.randrange(1, 224), r.randrange(256),
+                              r.randrange(256), r.randrange(1, 255))
+        port = r.randrange(1024, 65536)
+        left = r.choice((0, 0, r.randrange(1, 2 ** 32)))
+        key = '%08X' % r.randrange(2 ** 32)
+        yield infohash, peerid, ip, port, left, key
+
+
+def build_dicts(peers, torrents):
+    downloads = {}
+    times = {}
+    becache = {}
+    for infohash, peerid, ip, port, left, key in announces(peers, torrents):
+        downloads.setdefault(infohash, {})[peerid] = \
+            {'ip': ip, 'port': port, 'left': left, 'key': key, 'nat': 0}
+        times.setdefault(infohash, {})[peerid] = time()
+        bc = becache.setdefault(infohash, [[{}, {}], [{}, {}], [{}, {}]])
+        bc[0][not left][peerid] = Bencached(bencode({'ip': ip, 'port': port,
+                                                     'peer id': peerid}))
+        bc[1][not left][peerid] = Bencached(bencode({'ip': ip, 'port': port}))
+        bc[2][not left][peerid] = compact_peer_info(ip, port)
+    return downloads, times, becache
+
+
+def build_slots(peers, torrents):
+    downloads = {}
+    expiry = ExpiryQueue(45 * 60, 1.0, None, 0)
+    for infohash, peerid, ip, port, left, key in announces(peers, torrents):
+        swarm = downloads.get(infohash)
+        if swarm is None:
+            swarm = downloads[infohash] = Swarm()
+        peer = Peer(peerid, ip, port, left, key)
+        peer.time = time()
+        swarm.add(peer)
+        expiry.add(peer, infohash, peer.time)
+        peer.nat = 0
+        swarm.set_reachable(peer, ip, port)
+    return downloads, expiry
+
+
+def measure(layout, peers, torrents):
+    build = {'dicts': build_dicts, 'slots': build_slots}[layout]
+    # the generator's own strings are part of either layout; warm it up
+    # so its imports and tables aren't counted
+    for x in announces(1, torrents):
+        pass
+    before = rss()
+    start = time()
+    state = build(peers, torrents)
+    elapsed = time() - start
+    return rss() - before, elapsed
+
+
+def main(peers=1000000, torrents=10000):
+    print "%d peers over %d torrents" % (peers, torrents)
+    print
+    print "%-7s %12s %10s %9s" % ('layout', 'MB', 'bytes/peer', 'build s')
+    results = {}
+    for layout in ('dicts', 'slots'):
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--child', layout, str(peers), str(torrents)],
+                             stdout=subprocess.PIPE)
+        grown, elapsed = p.communicate()[0].split()
+        grown = int(grown)
+        results[layout] = grown
+        print "%-7s %12.1f %10.0f %9.2f" % (layout, grown / 2.0 ** 20,
+                                            grown / float(peers),
+                                            float(elapsed))
+    print
+    print "slots use %.0f%% of the memory of dicts" % \
+          (100.0 * results['slots'] / results['dicts'])
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--child':
+        grown, elapsed = measure(args[1], int(args[2]), int(args[3]))
+        print grown, elapsed
+        sys.exit(0)
+    kw = {}
+    for name in ('peers', 'torrents'):
+        if args:
+            kw[name] = int(args.pop(0))
+    main(**kw)
@@ -25,6 +25,7 @@ import os
 
 from BitTorrent import platform
 from BitTorrent.launchmanycore import LaunchMany
+from BitTorrent.ShardedLaunchMany import ShardSupervisor, ShardWorker
 from BitTorrent.defaultargs import get_defaults
 from BitTorrent.parseargs import parseargs, printHelp
 from BitTorrent.prefs import Preferences
@@ -125,11 +126,22 @@ if __name__ == '__main__':
         sys.exit(1)
 
     d = HeadlessDisplayer()
+    shard = ShardWorker.from_environment()
+    if shard is not None:
+        shard.adjust_config(config)
     config = Preferences().initWithDict(config)
     injectLogger(use_syslog = False, capture_output = True, verbose = True,
                  log_level = logging.INFO, log_twisted = False )
     logging.getLogger('').removeHandler(console)  # remove handler installed by BitTorrent.__init__.
-    LaunchMany(config, d.display, 'launchmany-console')
+    if shard is not None:
+        LaunchMany(config, shard.display, 'launchmany-console', shard=shard)
+    elif config['shards'] > 1:
+        try:
+            ShardSupervisor(config, d.display).run()
+        except BTFailure, e:
+            log.error(unicode(e.args[0]))
+    else:
+        LaunchMany(config, d.display, 'launchmany-console')
 
     logging.getLogger("").critical( "After return from LaunchMany" )
 
@@ -65,7 +65,9 @@ if __name__ == '__main__':
                                                              # multifile case?
                         target=config['target'],
                         use_tracker=config['use_tracker'],
-                        data_dir=config['data_dir'])
+                        data_dir=config['data_dir'],
+                        num_hash_threads=config['num_hash_threads'],
+                        resume=config['resume'])
     except BTFailure, e:
         print unicode(e.args[0])
         sys.exit(1)
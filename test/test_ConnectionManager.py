@@ -0,0 +1,182 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Announcing verified pieces to the connected peers.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BTL.bitfield import Bitfield
+from BitTorrent.ConnectionManager import ConnectionManager
+
+NUMPIECES = 16
+
+
+class FakeTask(object):
+
+    def __init__(self, delay, func):
+        self.delay = delay
+        self.func = func
+        self.cancelled = False
+
+    def active(self):
+        return not self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeWatcher(object):
+
+    def add_subscriber(self, subscriber):
+        pass
+
+
+class FakeRawServer(object):
+    internet_watcher = FakeWatcher()
+
+
+class FakeStorage(object):
+    piece_size = 2 ** 18
+
+
+class FakeDownloader(object):
+    storage = FakeStorage()
+
+
+class FakeDownload(object):
+
+    def __init__(self, pieces):
+        self.have = Bitfield(NUMPIECES)
+        for i in pieces:
+            self.have[i] = True
+
+
+class FakeConnector(object):
+
+    def __init__(self, download=None):
+        self.download = download
+        self.writes = []
+
+    def send_have(self, index):
+        self.writes.append([index])
+
+    def send_haves(self, indices):
+        self.writes.append(list(indices))
+
+
+class HaveTests(TestCase):
+
+    def make(self, interval, suppress=False):
+        self.tasks = []
+        config = {'keepalive_interval': 120, 'pex_interval': 60,
+                  'have_batch_interval': interval,
+                  'suppress_redundant_haves': suppress}
+        self.cm = ConnectionManager(None, FakeDownloader(), None, NUMPIECES,
+                                    None, FakeRawServer(), config, True,
+                                    'm' * 20, self.add_task, 'i' * 20, None,
+                                    None, 6881, [], 'test')
+        return self.cm
+
+    def add_task(self, delay, func):
+        task = FakeTask(delay, func)
+        self.tasks.append(task)
+        return task
+
+    def run_have_task(self):
+        task = self.tasks.pop()
+        self.assertEqual(task.func, self.cm.send_haves)
+        task.func()
+
+    def test_default_sends_each_piece(self):
+        cm = self.make(0)
+        c = FakeConnector()
+        cm.complete_connectors.append(c)
+        cm.hashcheck_succeeded(3)
+        cm.hashcheck_succeeded(5)
+        self.assertEqual(c.writes, [[3], [5]])
+        self.assertEqual(len(self.tasks), 1) # just keepalives
+
+    def test_batch_written_once_per_connection(self):
+        cm = self.make(0.5)
+        a = FakeConnector()
+        b = FakeConnector()
+        cm.complete_connectors.extend([a, b])
+        for i in (3, 5, 7):
+            cm.hashcheck_succeeded(i)
+        self.assertEqual(a.writes, [])
+        # one task for the whole batch
+        self.assertEqual([t.delay for t in self.tasks], [120, 0.5])
+        self.run_have_task()
+        self.assertEqual(a.writes, [[3, 5, 7]])
+        self.assertEqual(b.writes, [[3, 5, 7]])
+        # nothing pending, nothing written
+        cm.send_haves()
+        self.assertEqual(a.writes, [[3, 5, 7]])
+        cm.hashcheck_succeeded(9)
+        self.run_have_task()
+        self.assertEqual(a.writes, [[3, 5, 7], [9]])
+        self.assertEqual(cm.get_have_stats(),
+                         {'sent': 8, 'suppressed': 0, 'writes': 4})
+
+    def test_cleanup_drops_pending(self):
+        cm = self.make(0.5)
+        cm.hashcheck_succeeded(3)
+        task = self.tasks[-1]
+        cm.closed = True
+        cm.cleanup()
+        self.assertTrue(task.cancelled)
+        self.assertEqual(cm._pending_haves, [])
+
+    def test_sent_to_everyone_unless_suppressed(self):
+        cm = self.make(0.5)
+        seed = FakeConnector(FakeDownload(range(NUMPIECES)))
+        cm.complete_connectors.append(seed)
+        cm.hashcheck_succeeded(3)
+        self.run_have_task()
+        self.assertEqual(seed.writes, [[3]])
+
+    def test_suppressed_for_seeds(self):
+        cm = self.make(0.5, suppress=True)
+        seed = FakeConnector(FakeDownload(range(NUMPIECES)))
+        unknown = FakeConnector()
+        cm.complete_connectors.extend([seed, unknown])
+        cm.hashcheck_succeeded(3)
+        cm.hashcheck_succeeded(5)
+        self.run_have_task()
+        self.assertEqual(seed.writes, [])
+        self.assertEqual(unknown.writes, [[3, 5]])
+        self.assertEqual(cm.get_have_stats(),
+                         {'sent': 2, 'suppressed': 2, 'writes': 1})
+
+    def test_suppressed_for_pieces_peer_has(self):
+        cm = self.make(0.5, suppress=True)
+        some = FakeConnector(FakeDownload([3, 7]))
+        most = FakeConnector(FakeDownload([3, 5, 7]))
+        cm.complete_connectors.extend([some, most])
+        for i in (3, 5, 7):
+            cm.hashcheck_succeeded(i)
+        self.run_have_task()
+        self.assertEqual(some.writes, [[5]])
+        self.assertEqual(most.writes, [])
+        self.assertEqual(cm.get_have_stats(),
+                         {'sent': 1, 'suppressed': 5, 'writes': 1})
+        # the counters are a copy
+        cm.get_have_stats()['sent'] = 100
+        self.assertEqual(cm.have_stats['sent'], 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Framing of the message stream, once the handshake is done.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from struct import pack
+from unittest import TestCase, main
+
+from BitTorrent import Connector
+
+
+class FakeConnection(object):
+    ip = '127.0.0.1'
+    port = 6881
+    handler = None
+
+
+class FakeParent(object):
+    config = {'max_message_length': 2 ** 16}
+    infohash = '\x00' * 20
+    numpieces = 100
+    piece_size = 2 ** 18
+
+
+def message(body):
+    return pack("!i", len(body)) + body
+
+
+class FramingTests(TestCase):
+
+    def setUp(self):
+        c = Connector.Connector(FakeParent(), FakeConnection(), '0' * 20,
+                                False)
+        c._reader = None
+        c.complete = True
+        c.max_message_length = FakeParent.config['max_message_length']
+        self.got = []
+        self.checks = 0
+        self.violations = []
+        c._got_message = self.got_message
+        c.protocol_violation = self.violations.append
+        c.close = self.close
+        check_length = c._check_length
+        def counted_check_length(l, d):
+            self.checks += 1
+            return check_length(l, d)
+        c._check_length = counted_check_length
+        self.c = c
+        self.stream = ''.join([message(pack("!ci", Connector.HAVE, 7)),
+                               message(''),
+                               message(Connector.PIECE + 'x' * 5000),
+                               message(Connector.INTERESTED)])
+        self.expected = [Connector.HAVE + pack("!i", 7),
+                         Connector.PIECE + 'x' * 5000,
+                         Connector.INTERESTED]
+
+    def got_message(self, m):
+        # m is a view on a buffer which may be reused
+        self.got.append(str(m))
+
+    def close(self):
+        self.c.closed = True
+
+    def feed(self, chunk_size):
+        s = self.stream
+        for i in xrange(0, len(s), chunk_size):
+            self.c._frame_messages(s[i:i + chunk_size])
+
+    def test_one_chunk(self):
+        self.feed(len(self.stream))
+        self.assertEqual(self.got, self.expected)
+        self.assertEqual(self.c._rbuf, [])
+
+    def test_every_split(self):
+        for chunk_size in range(1, 20) + [1000, 4999, 5003, 5008]:
+            self.setUp()
+            self.feed(chunk_size)
+            self.assertEqual(self.got, self.expected)
+            self.assertEqual(self.c._rbuf_len, 0)
+            self.assertEqual(self.c._message_count, 3)
+
+    def test_length_checked_once(self):
+        # the PIECE arrives over 5000 one-byte chunks, but its length is
+        # only checked when its prefix arrives
+        self.feed(1)
+        self.assertEqual(self.checks, 4)
+
+    def test_split_after_prefix(self):
+        s = self.stream
+        # the whole PIECE prefix at the end of the first chunk
+        cut = len(message(pack("!ci", Connector.HAVE, 7))) + 4 + 4 + 100
+        self.c._frame_messages(s[:cut])
+        self.c._frame_messages(s[cut:])
+        self.assertEqual(self.got, self.expected)
+        self.assertEqual(self.checks, 4)
+
+    def test_too_long(self):
+        s = pack("!i", 2 ** 16 + 1) + 'x' * 20
+        self.c._frame_messages(s[:2])
+        self.c._frame_messages(s[2:])
+        self.assertEqual(len(self.violations), 1)
+        self.assert_('exceeds max' in self.violations[0])
+        self.assert_(self.c.closed)
+
+    def test_negative(self):
+        self.c._frame_messages(pack("!i", -1) + 'abc')
+        self.assertEqual(len(self.violations), 1)
+        self.assert_('negative' in self.violations[0])
+        self.assertEqual(self.got, [])
+
+
+if __name__ == '__main__':
+    main()
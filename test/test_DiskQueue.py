@@ -0,0 +1,98 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from Queue import Empty
+from unittest import TestCase, main
+
+from BitTorrent.DiskQueue import DiskQueue, PRIORITY_WEIGHTS
+from BitTorrent.DiskQueue import PRIORITY_READ, PRIORITY_WRITE
+from BitTorrent.DiskQueue import PRIORITY_BACKGROUND
+
+
+class DiskQueueTests(TestCase):
+
+    def setUp(self):
+        self.q = DiskQueue()
+
+    def put(self, item, torrent='t', filename='f', pos=0,
+            priority=PRIORITY_READ):
+        self.q.put(item, torrent=torrent, filename=filename, pos=pos,
+                   priority=priority)
+
+    def test_nonblocking_get(self):
+        self.assertRaises(Empty, self.q.get, False)
+        self.put('r')
+        self.assertEqual(self.q.get(False), 'r')
+        self.assertRaises(Empty, self.q.get, False)
+
+    def test_control_first(self):
+        self.put('r')
+        self.q.put('stop')
+        self.assertEqual(self.q.get(), 'stop')
+        self.assertEqual(self.q.get(), 'r')
+
+    def test_priority(self):
+        self.put('b', priority=PRIORITY_BACKGROUND)
+        self.put('w', priority=PRIORITY_WRITE)
+        self.put('r', priority=PRIORITY_READ)
+        self.assertEqual([self.q.get() for i in xrange(3)], ['r', 'w', 'b'])
+
+    def test_elevator(self):
+        for pos in (30, 10, 20):
+            self.put(pos, pos=pos)
+        self.assertEqual(self.q.get(), 10)
+        self.put(5, pos=5)
+        self.put(15, pos=15)
+        # carries on up from 10 before going back to 5
+        self.assertEqual([self.q.get() for i in xrange(4)], [15, 20, 30, 5])
+
+    def test_torrents_take_turns(self):
+        for pos in xrange(3):
+            self.put(('a', pos), torrent='a', pos=pos)
+            self.put(('b', pos), torrent='b', pos=pos)
+        got = [self.q.get()[0] for i in xrange(6)]
+        self.assertEqual(got, ['a', 'b', 'a', 'b', 'a', 'b'])
+
+    def test_writes_progress_under_read_load(self):
+        # reads are never short: every one served is replaced by another
+        for pos in xrange(10):
+            self.put('r', pos=pos)
+        for pos in xrange(100):
+            self.put('w', pos=pos, priority=PRIORITY_WRITE)
+            self.put('b', pos=pos, priority=PRIORITY_BACKGROUND)
+        served = {'r': 0, 'w': 0, 'b': 0}
+        cycle = sum(PRIORITY_WEIGHTS)
+        for i in xrange(10 * cycle):
+            item = self.q.get(False)
+            served[item] += 1
+            if item == 'r':
+                self.put('r', pos=i)
+        self.assertEqual(served, {'r': 10 * PRIORITY_WEIGHTS[PRIORITY_READ],
+                                  'w': 10 * PRIORITY_WEIGHTS[PRIORITY_WRITE],
+                                  'b': 10 * PRIORITY_WEIGHTS[
+                                      PRIORITY_BACKGROUND]})
+
+    def test_idle_levels_dont_hold_back_others(self):
+        # with only reads waiting, reads get every op
+        for pos in xrange(20):
+            self.put('r', pos=pos)
+        got = [self.q.get(False) for i in xrange(20)]
+        self.assertEqual(got, ['r'] * 20)
+        self.assertEqual(self.q.qsize(), 0)
+
+
+if __name__ == '__main__':
+    main()
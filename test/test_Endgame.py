@@ -0,0 +1,209 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import random
+from unittest import TestCase, main
+
+from BitTorrent.Endgame import Endgame
+
+
+class FakeConnector(object):
+
+    def __init__(self):
+        self.closed = False
+        self.uses_fast_extension = False
+        self.cancels = []
+
+    def send_cancels(self, reqs):
+        self.cancels.extend(reqs)
+
+
+class FakeDownload(object):
+
+    def __init__(self, multidownload, pieces):
+        self.multidownload = multidownload
+        self.have = [i in pieces for i in xrange(10)]
+        self.active_requests = set()
+        self.expecting_reject = set()
+        self.choked = False
+        self.connector = FakeConnector()
+        self.fixed = 0
+        multidownload.downloads.append(self)
+
+    def fix_download_endgame(self):
+        self.fixed += 1
+
+
+class FakeMultiDownload(object):
+
+    def __init__(self):
+        self.downloads = []
+
+
+def blocks(index, n):
+    return [(index, i * 16, 16) for i in xrange(n)]
+
+
+class EndgameTests(TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.tasks = []
+        self.md = FakeMultiDownload()
+
+    def add_task(self, delay, f, *args):
+        self.tasks.append((f, args))
+        return len(self.tasks)
+
+    def run_tasks(self):
+        tasks, self.tasks = self.tasks, []
+        for f, args in tasks:
+            f(*args)
+
+    def endgame(self, max_duplicates=0):
+        return Endgame(self.add_task, max_duplicates)
+
+    def request(self, e, d, reqs):
+        for req in reqs:
+            d.active_requests.add(req)
+            e.request_sent(d, req)
+
+    def test_start(self):
+        e = self.endgame()
+        a = FakeDownload(self.md, [0, 1])
+        b = FakeDownload(self.md, [1])
+        a.active_requests.update(blocks(0, 2))
+        b.active_requests.update(blocks(1, 2))
+        e.start(self.md.downloads)
+        self.assertEqual(len(e), 4)
+        self.assertEqual(sorted(e.pieces), [0, 1])
+        self.assertEqual(e.requests[(1, 0, 16)], set([b]))
+        self.assert_(e.wants_any(a.have))
+        self.failIf(e.wants_any([False] * 10))
+
+    def test_wanted_by(self):
+        e = self.endgame()
+        for req in blocks(0, 4) + blocks(1, 4):
+            e.add(req)
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0, 1])
+        # only blocks of pieces the peer has
+        self.assertEqual(sorted(e.wanted_by(a, 10)), blocks(0, 4))
+        self.request(e, a, blocks(0, 2))
+        # not those already asked of it
+        self.assertEqual(sorted(e.wanted_by(a, 10)), blocks(0, 4)[2:])
+        # least requested first
+        want = e.wanted_by(b, 6)
+        self.assertEqual(len(want), 6)
+        self.assertEqual(sorted(want),
+                         sorted(blocks(0, 4)[2:] + blocks(1, 4)))
+        self.assertEqual(len(e.wanted_by(b, 3)), 3)
+        self.assertEqual(len(e.wanted_by(b, 100)), 8)
+
+    def test_max_duplicates(self):
+        e = self.endgame(2)
+        e.add((0, 0, 16))
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0])
+        c = FakeDownload(self.md, [0])
+        self.request(e, a, [(0, 0, 16)])
+        self.request(e, b, [(0, 0, 16)])
+        self.assertEqual(e.wanted_by(c, 10), [])
+        self.assertEqual(e.stats['duplicates'], 1)
+
+    def test_received(self):
+        e = self.endgame()
+        for req in blocks(0, 2):
+            e.add(req)
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0])
+        c = FakeDownload(self.md, [0])
+        self.request(e, a, blocks(0, 2))
+        self.request(e, b, blocks(0, 1))
+        a.active_requests.discard((0, 0, 16))
+        self.assert_(e.received((0, 0, 16), a))
+        self.failIf(e.received((0, 0, 16), b))
+        # b was asked for it too, so gets a CANCEL; c wasn't told
+        self.assertEqual(b.active_requests, set())
+        self.assertEqual((a.fixed, b.fixed, c.fixed), (1, 1, 0))
+        self.run_tasks()
+        self.assertEqual(b.connector.cancels, [(0, 0, 16)])
+        self.assertEqual(a.connector.cancels, [])
+        self.assertEqual(e.pieces, {0: [(0, 16, 16)]})
+        # the last block lets everyone know
+        a.active_requests.discard((0, 16, 16))
+        self.assert_(e.received((0, 16, 16), a))
+        self.assertEqual((a.fixed, b.fixed, c.fixed), (2, 2, 1))
+        self.assertEqual(len(e), 0)
+        self.assertEqual(e.pieces, {})
+
+    def test_cancels_batched(self):
+        e = self.endgame()
+        for req in blocks(0, 3):
+            e.add(req)
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0])
+        self.request(e, a, blocks(0, 3))
+        self.request(e, b, blocks(0, 3))
+        for req in blocks(0, 2):
+            e.received(req, a)
+        self.assertEqual(len(self.tasks), 1)
+        self.run_tasks()
+        self.assertEqual(b.connector.cancels, blocks(0, 2))
+        self.assertEqual(e.get_stats(),
+                         {'cancels': 2, 'writes': 1, 'duplicates': 3,
+                          'outstanding': 1})
+
+    def test_dropped_orphan(self):
+        e = self.endgame()
+        e.add((0, 0, 16))
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0])
+        c = FakeDownload(self.md, [0])
+        self.request(e, a, [(0, 0, 16)])
+        self.request(e, b, [(0, 0, 16)])
+        # b still has it, and with no limit nothing new is free
+        e.dropped(a, [(0, 0, 16)], self.md.downloads)
+        self.assertEqual((a.fixed, b.fixed, c.fixed), (0, 0, 0))
+        e.dropped(b, [(0, 0, 16)], self.md.downloads)
+        self.assertEqual((a.fixed, b.fixed, c.fixed), (1, 0, 1))
+
+    def test_dropped_frees_duplicate(self):
+        e = self.endgame(2)
+        e.add((0, 0, 16))
+        a = FakeDownload(self.md, [0])
+        b = FakeDownload(self.md, [0])
+        c = FakeDownload(self.md, [0])
+        self.request(e, a, [(0, 0, 16)])
+        self.request(e, b, [(0, 0, 16)])
+        self.assertEqual(e.wanted_by(c, 10), [])
+        e.dropped(a, [(0, 0, 16)], self.md.downloads)
+        self.assertEqual((a.fixed, b.fixed, c.fixed), (0, 1, 1))
+        self.assertEqual(e.wanted_by(c, 10), [(0, 0, 16)])
+        # dropping what it didn't have changes nothing
+        e.dropped(a, [(0, 0, 16)], self.md.downloads)
+        self.assertEqual(c.fixed, 1)
+
+    def test_piece_failed(self):
+        e = self.endgame()
+        a = FakeDownload(self.md, [3])
+        e.piece_failed(blocks(3, 2), self.md.downloads)
+        self.assertEqual(e.pieces, {3: blocks(3, 2)})
+        self.assertEqual(a.fixed, 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BitTorrent.ExpiryQueue import ExpiryQueue
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExpiryQueueTests(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.expired = []
+        self.q = self.queue(100)
+
+    def queue(self, max_per_tick):
+        # items live 60 seconds, in 10 second buckets
+        return ExpiryQueue(60, 10, self.expire, max_per_tick, self.clock)
+
+    def expire(self, item, value):
+        self.expired.append((item, value))
+
+    def tick_at(self, t):
+        self.clock.now = t
+        self.q.tick()
+
+    def test_expire(self):
+        q = self.q
+        q.add('a', 1, 1000)
+        q.add('b', 2, 1015)
+        self.assertEqual(len(q), 2)
+        # not before lifetime has passed, and then within one bucket
+        self.tick_at(1060)
+        self.assertEqual(self.expired, [])
+        self.tick_at(1070)
+        self.assertEqual(self.expired, [('a', 1)])
+        self.tick_at(1079)
+        self.assertEqual(self.expired, [('a', 1)])
+        self.tick_at(1080)
+        self.assertEqual(self.expired, [('a', 1), ('b', 2)])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.buckets, {})
+
+    def test_move(self):
+        q = self.q
+        q.add('a', 1, 1000)
+        self.tick_at(1050)
+        q.move('a', 1, 1000, 1050)
+        self.tick_at(1100)
+        self.assertEqual(self.expired, [])
+        self.tick_at(1120)
+        self.assertEqual(self.expired, [('a', 1)])
+
+    def test_move_within_bucket(self):
+        q = self.q
+        q.add('a', 1, 1000)
+        q.move('a', 2, 1000, 1005)
+        # the same bucket, so left as it was
+        self.assertEqual(q.buckets, {100: {'a': 1}})
+
+    def test_remove(self):
+        q = self.q
+        q.add('a', 1, 1000)
+        q.add('b', 2, 1000)
+        q.remove('a', 1000)
+        q.remove('b', 1000)
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.buckets, {})
+        self.tick_at(2000)
+        self.assertEqual(self.expired, [])
+
+    def test_max_per_tick(self):
+        self.q = q = self.queue(3)
+        for i in xrange(5):
+            q.add(i, None, 1000)
+        for i in xrange(2):
+            q.add(i + 5, None, 1010)
+        self.tick_at(1085)
+        self.assertEqual(len(self.expired), 3)
+        # the first bucket was due at 1070
+        self.assertEqual(q.lag, 15)
+        self.tick_at(1086)
+        self.assertEqual(len(self.expired), 6)
+        # on to the second bucket, due at 1080
+        self.assertEqual(q.lag, 6)
+        self.tick_at(1087)
+        self.assertEqual(sorted([i for i, v in self.expired]), range(7))
+        self.assertEqual(q.lag, 0)
+        self.assertEqual(q.get_stats(),
+                         {'items': 0, 'expired': 7, 'lag': 0,
+                          'max_lag': 15})
+
+    def test_clock_back(self):
+        q = self.q
+        self.tick_at(5000)
+        # touched before the oldest bucket still looked at
+        q.add('a', 1, 1000)
+        self.tick_at(5000)
+        self.assertEqual(self.expired, [('a', 1)])
+
+    def test_idle(self):
+        q = self.q
+        self.tick_at(100000)
+        # nothing to walk through after a long idle spell
+        self.assertEqual(q.next, (100000 - 60) // 10)
+        q.add('a', 1, 100000)
+        self.tick_at(100070)
+        self.assertEqual(self.expired, [('a', 1)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The limiter against a simulated clock, with connections which always
+# have more to send.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import heapq
+from unittest import TestCase, main
+
+from BitTorrent.HTBRateLimiter import HTBRateLimiter
+
+UNITSIZE = 16384 + 13
+# bytes per second each connection's link carries
+LINK = 4 * 2 ** 20
+
+
+class Task(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.heap = []
+        self.seq = 0
+
+    def clock(self):
+        return self.now
+
+    def add_task(self, delay, func, *args):
+        t = Task(func, args)
+        self.seq += 1
+        heapq.heappush(self.heap, (self.now + delay, self.seq, t))
+        return t
+
+    def run_until(self, end):
+        while self.heap and self.heap[0][0] <= end:
+            when, seq, t = heapq.heappop(self.heap)
+            if not t.active():
+                continue
+            self.now = max(self.now, when)
+            t.called = True
+            t.func(*t.args)
+        self.now = end
+
+
+class Torrent(object):
+    # what connections group by, like a ConnectionManager
+    pass
+
+
+class NoLimiter(object):
+    # for connections with nothing left to send
+
+    def queue(self, conn):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, parent, limiter, sched):
+        self.parent = parent
+        self.limiter = limiter
+        self.sched = sched
+        self.sent = 0
+
+    def send_partial(self, n):
+        self.sent += n
+        # flushed once the link has carried it, then there's more
+        self.sched.add_task(n / float(LINK), self.limiter.queue, self)
+        return n
+
+
+class HTBRateLimiterTests(TestCase):
+
+    def setUp(self):
+        self.sched = Scheduler()
+        self.limiter = HTBRateLimiter(self.sched.add_task, self.sched.clock)
+        self.limiter.set_parameters(2 ** 20, UNITSIZE)
+        self.torrents = [Torrent(), Torrent()]
+        self.conns = {}
+        for t in self.torrents:
+            self.conns[t] = [Connection(t, self.limiter, self.sched)
+                             for i in xrange(5)]
+
+    def start(self):
+        for conns in self.conns.itervalues():
+            for c in conns:
+                self.limiter.queue(c)
+
+    def sent(self, t):
+        return sum([c.sent for c in self.conns[t]])
+
+    def rates(self, seconds):
+        """bytes per second each torrent sends over the next seconds"""
+        before = [self.sent(t) for t in self.torrents]
+        self.sched.run_until(self.sched.now + seconds)
+        return [(self.sent(t) - x) / float(seconds)
+                for t, x in zip(self.torrents, before)]
+
+    def assertNear(self, value, expected, tolerance=0.05):
+        self.assert_(abs(value - expected) <= expected * tolerance,
+                     "%r is not within %d%% of %r" %
+                     (value, tolerance * 100, expected))
+
+    def test_global_limit_shared(self):
+        self.start()
+        self.sched.run_until(1)
+        a, b = self.torrents
+        ra, rb = self.rates(10)
+        self.assertNear(ra + rb, 2 ** 20)
+        self.assertNear(ra, rb)
+
+    def test_limited_torrent_stays_at_its_limit(self):
+        a, b = self.torrents
+        self.limiter.set_group_parameters(a, 100000)
+        self.start()
+        self.sched.run_until(1)
+        ra, rb = self.rates(10)
+        self.assertNear(ra, 100000)
+        # the other torrent gets the rest
+        self.assertNear(ra + rb, 2 ** 20)
+
+    def test_change_and_remove_limit(self):
+        a, b = self.torrents
+        self.limiter.set_group_parameters(a, 100000)
+        self.start()
+        self.sched.run_until(2)
+        self.limiter.set_group_parameters(a, 200000)
+        self.sched.run_until(3)
+        self.assertNear(self.rates(10)[0], 200000)
+        self.limiter.remove_group(a)
+        self.sched.run_until(self.sched.now + 1)
+        self.assertNear(self.rates(10)[0], 2 ** 19)
+        self.assertEqual(self.limiter.group_params, {})
+
+    def test_one_connection_per_limited_torrent(self):
+        # the group's queue empties every time its connection goes off to
+        # flush, which mustn't reset its bucket
+        for limit in (0, 2 ** 20):
+            self.setUp()
+            self.limiter.set_parameters(limit, UNITSIZE)
+            a, b = self.torrents
+            self.conns[a] = self.conns[a][:1]
+            self.conns[b] = self.conns[b][:1]
+            self.limiter.set_group_parameters(a, 100000)
+            self.limiter.set_group_parameters(b, 200000)
+            self.start()
+            self.sched.run_until(1)
+            ra, rb = self.rates(10)
+            self.assertNear(ra, 100000)
+            self.assertNear(rb, 200000)
+
+    def test_idle_limited_group_kept(self):
+        a, b = self.torrents
+        self.limiter.set_group_parameters(a, 100000)
+        self.conns[b] = []
+        self.start()
+        self.sched.run_until(1)
+        # nothing more to send once flushed
+        for c in self.conns[a]:
+            c.limiter = NoLimiter()
+        self.sched.run_until(2)
+        self.assertEqual(self.limiter.groups[a].state, None)
+        self.limiter.remove_group(a)
+        self.assertEqual(self.limiter.groups, {})
+
+    def test_weight(self):
+        a, b = self.torrents
+        self.limiter.set_group_parameters(a, 0, weight=3)
+        self.start()
+        self.sched.run_until(1)
+        ra, rb = self.rates(10)
+        self.assertNear(ra, 3 * rb)
+
+
+if __name__ == '__main__':
+    main()
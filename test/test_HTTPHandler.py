@@ -0,0 +1,200 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# HTTPHandler's request parsing and keep-alive, against a connection which
+# records what is written to it.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BitTorrent.HTTPHandler import HTTPHandler, MAX_HEADER_SIZE
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.ip = '10.0.0.1'
+        self.writes = []
+        self.shut = False
+
+    def write(self, s):
+        self.writes.append(s)
+
+    def is_flushed(self):
+        return True
+
+    def shutdown(self, how):
+        self.shut = True
+
+
+def request(path, version='HTTP/1.1', headers=()):
+    lines = ['GET %s %s' % (path, version)] + list(headers)
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+class HTTPHandlerTests(TestCase):
+
+    def setUp(self):
+        self.deferred = False
+        self.pending = []
+        self.tasks = []
+        self.handler = self.make_handler()
+        self.conn = FakeConnection()
+        self.handler.connection_made(self.conn)
+
+    def make_handler(self, **kw):
+        return HTTPHandler(self.getfunc, 0, **kw)
+
+    def getfunc(self, connector, path, headers):
+        response = (200, 'OK', {'Content-Type': 'text/plain'}, path)
+        if self.deferred:
+            self.pending.append((connector, response))
+            return None
+        return response
+
+    def send(self, data):
+        self.handler.data_came_in(self.conn, data)
+
+    def responses(self):
+        """(status line, headers, body) per response written"""
+        r = []
+        for s in self.conn.writes:
+            head, body = s.split('\r\n\r\n', 1)
+            lines = head.split('\r\n')
+            headers = dict([l.split(': ', 1) for l in lines[1:]])
+            r.append((lines[0], headers, body))
+        return r
+
+    def bodies(self):
+        return [body for status, headers, body in self.responses()]
+
+    def test_pipelined(self):
+        self.send(request('/a') + request('/b') + '\r\n' + request('/c'))
+        self.assertEqual(self.bodies(), ['/a', '/b', '/c'])
+        status, headers, body = self.responses()[0]
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertEqual(headers['Content-Length'], '2')
+        self.failIf('Connection' in headers)
+        self.failIf(self.conn.shut)
+
+    def test_split_request(self):
+        data = request('/a')
+        for c in data:
+            self.send(c)
+        self.assertEqual(self.bodies(), ['/a'])
+
+    def test_http10_keep_alive(self):
+        self.send(request('/a', 'HTTP/1.0', ['Connection: keep-alive']))
+        status, headers, body = self.responses()[0]
+        self.assertEqual(status, 'HTTP/1.0 200 OK')
+        self.assertEqual(headers['Connection'], 'keep-alive')
+        self.failIf(self.conn.shut)
+        self.send(request('/b', 'HTTP/1.0'))
+        self.assertEqual(self.bodies(), ['/a', '/b'])
+        self.assertEqual(self.responses()[1][1]['Connection'], 'close')
+        self.assert_(self.conn.shut)
+
+    def test_http10(self):
+        self.send(request('/a', 'HTTP/1.0') + request('/b', 'HTTP/1.0'))
+        self.assertEqual(self.bodies(), ['/a'])
+        self.assertEqual(self.responses()[0][1]['Connection'], 'close')
+        self.assert_(self.conn.shut)
+        # nothing more is read
+        self.send(request('/c'))
+        self.assertEqual(len(self.conn.writes), 1)
+
+    def test_http11_close(self):
+        self.send(request('/a', headers=['Connection: close']) +
+                  request('/b'))
+        self.assertEqual(self.bodies(), ['/a'])
+        self.assert_(self.conn.shut)
+
+    def test_max_requests(self):
+        self.handler = self.make_handler(max_requests=2)
+        self.handler.connection_made(self.conn)
+        self.send(request('/a') + request('/b') + request('/c'))
+        self.assertEqual(self.bodies(), ['/a', '/b'])
+        self.failIf('Connection' in self.responses()[0][1])
+        self.assertEqual(self.responses()[1][1]['Connection'], 'close')
+        self.assert_(self.conn.shut)
+
+    def test_long_header(self):
+        self.send('GET /a HTTP/1.1\r\nX-Padding: ')
+        self.failIf(self.conn.shut)
+        self.send('x' * MAX_HEADER_SIZE)
+        self.assert_(self.conn.shut)
+        self.assertEqual(self.conn.writes, [])
+
+    def test_long_header_in_lines(self):
+        # many short lines add up too
+        line = 'X-Padding: ' + 'x' * 100 + '\r\n'
+        n = MAX_HEADER_SIZE // len(line)
+        self.send(request('/a', headers=[line.strip()] * (n - 1)))
+        self.assertEqual(self.bodies(), ['/a'])
+        self.send('GET /b HTTP/1.1\r\n' + line * (n + 1))
+        self.assert_(self.conn.shut)
+        self.assertEqual(self.bodies(), ['/a'])
+
+    def test_bad_request(self):
+        self.send('POST /a HTTP/1.1\r\n\r\n')
+        self.assert_(self.conn.shut)
+        self.assertEqual(self.conn.writes, [])
+
+    def test_deferred_answer(self):
+        self.deferred = True
+        self.send(request('/a') + request('/b'))
+        # /b waits until /a is answered, as does /c coming in meanwhile
+        self.assertEqual([c.path for c, r in self.pending], ['/a'])
+        self.send(request('/c'))
+        self.assertEqual(len(self.pending), 1)
+        for path in ('/a', '/b', '/c'):
+            connector, response = self.pending.pop(0)
+            self.assertEqual(connector.path, path)
+            connector.answer(response)
+        self.assertEqual(self.pending, [])
+        self.assertEqual(self.bodies(), ['/a', '/b', '/c'])
+        self.failIf(self.conn.shut)
+
+    def test_answer_after_close(self):
+        self.deferred = True
+        self.send(request('/a'))
+        connector, response = self.pending.pop(0)
+        self.handler.connection_lost(self.conn)
+        connector.answer(response)
+        self.assertEqual(self.conn.writes, [])
+
+    def test_close_idle(self):
+        self.handler = self.make_handler(add_task=self.add_task,
+                                         idle_timeout=10)
+        self.handler.connection_made(self.conn)
+        waiting = FakeConnection()
+        self.handler.connection_made(waiting)
+        self.deferred = True
+        self.handler.data_came_in(waiting, request('/a'))
+        for c in self.handler.connections.itervalues():
+            c.last_active -= 20
+        self.assertEqual(len(self.tasks), 1)
+        self.tasks.pop()()
+        self.assert_(self.conn.shut)
+        # one waiting on its answer is left alone
+        self.failIf(waiting.shut)
+        self.assertEqual(len(self.tasks), 1)
+
+    def add_task(self, delay, func, *args):
+        self.tasks.append(lambda: func(*args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import random
+from unittest import TestCase, main
+
+from BTL.bitfield import Bitfield
+from BitTorrent.PiecePicker import PieceBuckets, PiecePicker
+
+
+class BareBitfield(object):
+    """Only what cBitfield has: indexing, len, tostring and numfalse."""
+
+    def __init__(self, length, pieces):
+        self.b = Bitfield(length)
+        for i in pieces:
+            self.b[i] = 1
+        self.numfalse = self.b.numfalse
+
+    def __getitem__(self, i):
+        return self.b[i]
+
+    def __len__(self):
+        return len(self.b)
+
+    def tostring(self):
+        return self.b.tostring()
+
+
+class PieceBucketsTests(TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.pb = PieceBuckets('h', 100)
+
+    def test_add_remove(self):
+        pb = self.pb
+        pb.add(3, 0)
+        pb.add(5, 2)
+        self.assertEqual(len(pb), 2)
+        self.assert_(3 in pb)
+        self.failIf(4 in pb)
+        self.assertEqual(pb.get_position(5), 2)
+        self.assertEqual(list(pb.buckets[2]), [5])
+        self.assertEqual(len(pb.buckets), 3)
+        self.assertEqual(pb.remove(5), 2)
+        self.assertEqual(len(pb.buckets), 1)
+        self.failIf(5 in pb)
+
+    def test_positions_after_removal(self):
+        pb = self.pb
+        for i in xrange(20):
+            pb.add(i, 1)
+        for i in xrange(0, 20, 2):
+            pb.remove(i)
+        self.assertEqual(sorted(pb.buckets[1]), range(1, 20, 2))
+        for i in xrange(1, 20, 2):
+            self.assertEqual(pb.get_position(i), 1)
+            self.assertEqual(pb.buckets[1][pb._pos[i]], i)
+
+    def test_have_all(self):
+        pb = self.pb
+        pb.add(1, 0)
+        pb.add(2, 3)
+        pb.prepend_bucket()
+        self.assertEqual(pb.get_position(1), 1)
+        self.assertEqual(pb.get_position(2), 4)
+        pb.add(3, 0)
+        self.assertEqual(list(pb.buckets[0]), [3])
+        pb.popleft_bucket()
+        # 3 had no copies to lose, and stays at zero
+        self.assertEqual(pb.get_position(1), 0)
+        self.assertEqual(pb.get_position(2), 3)
+        self.assertEqual(pb.get_position(3), 0)
+
+    def _rarest_by_walk(self, haves, bans):
+        for i in xrange(1, len(self.pb.buckets)):
+            for j in self.pb.buckets[i]:
+                if haves[j] and j not in bans:
+                    return j
+        return None
+
+    def test_rarest(self):
+        pb = self.pb
+        for i in xrange(100):
+            pb.add(i, random.randrange(4))
+        # a peer with few pieces is walked by its bitfield, one with many
+        # by the buckets. both give the same pick
+        for n in (3, 10, 90):
+            for trial in xrange(20):
+                pieces = random.sample(xrange(100), n)
+                bans = set(random.sample(pieces, 1))
+                full = Bitfield(100)
+                for i in pieces:
+                    full[i] = 1
+                for haves in (BareBitfield(100, pieces), full):
+                    self.assertEqual(pb.rarest(haves, bans),
+                                     self._rarest_by_walk(haves, bans))
+
+    def test_rarest_none(self):
+        pb = self.pb
+        pb.add(1, 0)
+        pb.add(2, 1)
+        # 1 has no copies, 2 is banned
+        self.assertEqual(pb.rarest(BareBitfield(100, [1, 2]), set([2])),
+                         None)
+        self.assertEqual(pb.rarest(BareBitfield(100, []), set()), None)
+
+
+class PiecePickerTests(TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.picker = PiecePicker({'rarest_first_cutoff': 0}, 10, range(10))
+
+    def test_rarest_first(self):
+        p = self.picker
+        for i in xrange(10):
+            p.got_have(i)
+        p.got_have_all()
+        for i in xrange(9):
+            p.got_have(i)
+        haves = BareBitfield(10, range(10))
+        self.assertEqual(p.next(haves, [], set(), []), 9)
+        self.assert_(p.next(haves, [], set([9]), []) in range(9))
+
+    def test_complete(self):
+        p = self.picker
+        for i in xrange(10):
+            p.got_have(i)
+        p.complete(3)
+        haves = BareBitfield(10, [3])
+        self.assertEqual(p.next(haves, [], set(), []), None)
+
+
+if __name__ == '__main__':
+    main()
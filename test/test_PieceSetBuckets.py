@@ -0,0 +1,103 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import random
+from unittest import TestCase, main
+
+from BitTorrent.PieceSetBuckets import PieceSetBuckets, SortedPieceBuckets
+
+NUMPIECES = 50
+
+
+class PieceSetBucketsTests(TestCase):
+
+    def make(self):
+        p = PieceSetBuckets()
+        p.add_all(NUMPIECES)
+        return p
+
+    def contents(self, p):
+        return [sorted(list(bucket)) for bucket in p.buckets]
+
+    def check(self, p, copies):
+        expected = []
+        for piece, n in enumerate(copies):
+            while len(expected) <= n:
+                expected.append([])
+            expected[n].append(piece)
+            self.assertEqual(p.get_position(piece), n)
+        self.assertEqual(self.contents(p), expected)
+
+    def test_add_all(self):
+        p = self.make()
+        self.check(p, [0] * NUMPIECES)
+
+    def test_have_all(self):
+        p = self.make()
+        p.add(3, p.remove(3) + 1)
+        p.prepend_bucket()
+        copies = [1] * NUMPIECES
+        copies[3] = 2
+        self.check(p, copies)
+        p.popleft_bucket()
+        copies = [0] * NUMPIECES
+        copies[3] = 1
+        self.check(p, copies)
+
+    def test_against_counts(self):
+        random.seed(0)
+        p = self.make()
+        copies = [0] * NUMPIECES
+        seeds = 0
+        for i in xrange(2000):
+            r = random.random()
+            if r < 0.05:
+                p.prepend_bucket()
+                copies = [n + 1 for n in copies]
+                seeds += 1
+            elif r < 0.1 and seeds:
+                p.popleft_bucket()
+                copies = [n - 1 for n in copies]
+                seeds -= 1
+            else:
+                piece = random.randrange(NUMPIECES)
+                if r < 0.6:
+                    delta = 1
+                elif copies[piece] > seeds:
+                    delta = -1
+                else:
+                    continue
+                p.add(piece, p.remove(piece) + delta)
+                copies[piece] += delta
+            self.check(p, copies)
+
+
+class SortedPieceBucketsTests(PieceSetBucketsTests):
+
+    def make(self):
+        p = SortedPieceBuckets('h')
+        p.add_all(NUMPIECES)
+        return p
+
+    def test_sorted(self):
+        p = self.make()
+        for piece in (7, 3, 5):
+            p.add(piece, p.remove(piece) + 1)
+        self.assertEqual(list(p.buckets[1]), [3, 5, 7])
+
+
+if __name__ == '__main__':
+    main()
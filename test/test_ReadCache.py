@@ -0,0 +1,106 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BitTorrent.ReadCache import ReadCache
+
+
+class ReadCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = ReadCache(100)
+        self.cache.add_owner('a')
+        self.cache.add_owner('b')
+
+    def test_hit_and_miss(self):
+        c = self.cache
+        self.assertEqual(c.get('a', 0), None)
+        c.put('a', 0, 'x' * 10)
+        self.assertEqual(c.get('a', 0), 'x' * 10)
+        self.assertEqual(c.get('b', 0), None)
+        self.assertEqual(c.get_stats('a'),
+                         {'hits': 1, 'misses': 1, 'evictions': 0,
+                          'size': 10})
+
+    def test_lru_eviction(self):
+        c = self.cache
+        for i in xrange(4):
+            c.put('a', i, str(i) * 30)
+        # 0 is the least recently used; touch 1 so that 2 goes next
+        self.assertEqual(c.get('a', 0), None)
+        c.get('a', 1)
+        c.put('b', 0, 'y' * 30)
+        self.assertEqual(c.get('a', 2), None)
+        self.assertEqual(c.get('a', 1), '1' * 30)
+        self.assertEqual(c.size, 90)
+        self.assertEqual(c.get_stats('a')['evictions'], 2)
+
+    def test_owner_share(self):
+        c = ReadCache(100, 40)
+        c.add_owner('a')
+        c.add_owner('b')
+        c.put('b', 0, 'y' * 30)
+        c.put('a', 0, 'x' * 30)
+        c.put('a', 1, 'x' * 30)
+        # a is over its share, so its own oldest piece goes, not b's
+        self.assertEqual(c.get('a', 0), None)
+        self.assertEqual(c.get('b', 0), 'y' * 30)
+        self.assertEqual(c.get_stats('a')['size'], 30)
+
+    def test_too_big(self):
+        self.cache.put('a', 0, 'x' * 101)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_replace(self):
+        c = self.cache
+        c.put('a', 0, 'x' * 10)
+        c.put('a', 0, 'y' * 20)
+        self.assertEqual(c.get('a', 0), 'y' * 20)
+        self.assertEqual(c.size, 20)
+
+    def test_shrink(self):
+        c = self.cache
+        for i in xrange(3):
+            c.put('a', i, str(i) * 30)
+        c.set_max_size(50)
+        self.assertEqual(c.size, 30)
+        self.assertEqual(c.get('a', 2), '2' * 30)
+
+    def test_discard_owner(self):
+        c = self.cache
+        c.put('a', 0, 'x' * 10)
+        c.put('a', 1, 'x' * 10)
+        c.put('b', 0, 'y' * 10)
+        c.discard_owner('a')
+        self.assertEqual(c.size, 10)
+        self.assertEqual(len(c.entries), 1)
+        self.failIf('a' in c.stats)
+
+    def test_put_after_discard_owner(self):
+        # a read which was outstanding when the torrent shut down
+        c = self.cache
+        c.discard_owner('a')
+        c.put('a', 0, 'x' * 10)
+        self.assertEqual(c.get('a', 0), None)
+        self.assertEqual(c.get_stats('a'), None)
+        self.failIf('a' in c.stats)
+        self.assertEqual(c.size, 0)
+        self.assertEqual(c.entries, {})
+
+
+if __name__ == '__main__':
+    main()
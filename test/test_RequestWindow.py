@@ -0,0 +1,95 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BitTorrent.RequestWindow import RequestWindow, MIN_WINDOW, \
+     MIN_RTT_LIFETIME, GAIN
+
+CHUNK = 2 ** 14
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RequestWindowTests(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.w = RequestWindow(CHUNK, 30.0, self.clock)
+        self.w.slow_start = False
+        self.next = 0
+
+    def round_trip(self, rtt):
+        req = self.next
+        self.next += 1
+        self.w.request_sent(req, set([req]))
+        self.clock.now += rtt
+        self.w.piece_received(req, CHUNK)
+
+    def settle(self, window, rtt):
+        w = self.w
+        self.round_trip(rtt)
+        w.window = window
+        w.srtt = rtt
+        # the rate that window is right for
+        w.rate = (window - MIN_WINDOW) / GAIN * CHUNK / rtt
+        self.clock.now += MIN_RTT_LIFETIME + 1
+
+    def test_small_window_not_probed(self):
+        w = self.w
+        self.settle(5, 0.1)
+        self.round_trip(0.12)
+        self.assertEqual(w.probing, None)
+        self.assertEqual(w.window, 5)
+        self.assertEqual(w.min_rtt_time, self.clock.now)
+
+    def test_small_window_probed_when_queueing(self):
+        w = self.w
+        self.settle(5, 0.1)
+        w.srtt = 0.3
+        self.round_trip(0.3)
+        self.failIf(w.probing is None)
+
+    def test_probe_keeps_link_busy(self):
+        w = self.w
+        self.settle(100, 0.1)
+        self.round_trip(0.12)
+        self.failIf(w.probing is None)
+        self.assertEqual(w.window, int(100 / GAIN) - 1)
+        self.failUnless(w.window > MIN_WINDOW)
+        # a request sent after the drop ends the probe with its latency
+        self.round_trip(0.11)
+        self.assertEqual(w.probing, None)
+        self.assertEqual(w.window, 100)
+        self.assertAlmostEqual(w.min_rtt, 0.11)
+
+    def test_max_window(self):
+        w = self.w
+        w.set_max_window(1000)
+        w.window = 500
+        w.set_max_window(300)
+        self.assertEqual(w.window, 300)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from sha import sha
+from unittest import TestCase, main
+
+from BitTorrent.StorageWrapper import StorageWrapper, PieceHasher
+
+
+BLOCK = 4
+PIECE = 4 * BLOCK
+
+
+def make_wrapper(numpieces, budget):
+    # only the incremental hashing state; the rest needs real storage
+    sw = StorageWrapper.__new__(StorageWrapper)
+    sw.config = {'incremental_hash_buffer': budget}
+    sw.numpieces = numpieces
+    sw.piece_size = PIECE
+    sw.total_length = numpieces * PIECE
+    sw.places = range(numpieces)
+    sw._hashers = {}
+    sw._hash_buffered = 0
+    sw._hash_dropped = set()
+    return sw
+
+
+def piece_data(index):
+    return ''.join([chr(65 + (index + i) % 26) for i in xrange(PIECE)])
+
+
+def block(index, n):
+    return piece_data(index)[n * BLOCK:(n + 1) * BLOCK]
+
+
+class PieceHasherTests(TestCase):
+
+    def test_in_order(self):
+        h = PieceHasher()
+        for n in xrange(4):
+            self.assert_(h.add(n * BLOCK, block(0, n)))
+        self.assertEqual(h.digest(), sha(piece_data(0)).digest())
+        self.assertEqual(h.buffered, 0)
+
+    def test_out_of_order(self):
+        h = PieceHasher()
+        for n in (2, 1, 3):
+            h.add(n * BLOCK, block(0, n))
+        self.assertEqual(h.buffered, 3 * BLOCK)
+        h.add(0, block(0, 0))
+        self.assertEqual(h.pos, PIECE)
+        self.assertEqual(h.buffered, 0)
+        self.assertEqual(h.digest(), sha(piece_data(0)).digest())
+
+    def test_overlap(self):
+        h = PieceHasher()
+        h.add(0, block(0, 0))
+        self.failIf(h.add(0, block(0, 0)))
+
+
+class IncrementalHashTests(TestCase):
+
+    def test_digest(self):
+        sw = make_wrapper(2, PIECE)
+        for n in (3, 0, 2, 1):
+            sw._hash_block(0, n * BLOCK, block(0, n))
+        self.assertEqual(sw._pop_hasher_digest(0),
+                         sha(piece_data(0)).digest())
+        self.assertEqual(sw._hash_buffered, 0)
+
+    def test_evicted_piece_stays_dropped(self):
+        sw = make_wrapper(2, 2 * BLOCK)
+        # piece 0 buffers two blocks, piece 1 a third which goes over
+        sw._hash_block(0, 1 * BLOCK, block(0, 1))
+        sw._hash_block(0, 2 * BLOCK, block(0, 2))
+        sw._hash_block(1, 1 * BLOCK, block(1, 1))
+        self.failIf(1 in sw._hashers)
+        self.assertEqual(sw._hash_buffered, 2 * BLOCK)
+
+        # the rest of piece 1 no longer buffers anything, nor evicts
+        # piece 0 to make room for it
+        for n in (0, 2, 3):
+            sw._hash_block(1, n * BLOCK, block(1, n))
+        self.failIf(1 in sw._hashers)
+        self.assert_(0 in sw._hashers)
+        self.assertEqual(sw._hash_buffered, 2 * BLOCK)
+        self.assertEqual(sw._pop_hasher_digest(1), None)
+
+        # once piece 1 has been checked from disk it is hashed again
+        sw._hash_block(1, 0, block(1, 0))
+        self.assert_(1 in sw._hashers)
+
+        sw._hash_block(0, 0, block(0, 0))
+        sw._hash_block(0, 3 * BLOCK, block(0, 3))
+        self.assertEqual(sw._pop_hasher_digest(0),
+                         sha(piece_data(0)).digest())
+
+    def test_overlap_drops(self):
+        sw = make_wrapper(1, PIECE)
+        sw._hash_block(0, 0, block(0, 0))
+        sw._hash_block(0, 0, block(0, 0))
+        self.failIf(0 in sw._hashers)
+        sw._hash_block(0, BLOCK, block(0, 1))
+        self.failIf(0 in sw._hashers)
+        self.assertEqual(sw._pop_hasher_digest(0), None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import os
+import tempfile
+from unittest import TestCase, main
+
+from BitTorrent import Storage_base
+
+
+class PositionalIOTests(TestCase):
+
+    def setUp(self):
+        self.fd, self.path = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.unlink(self.path)
+
+    def contents(self):
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_pwritev(self):
+        chunks = ['head ', buffer('..body..', 2, 4), '', ' tail']
+        n = Storage_base.pwritev(self.fd, chunks, 3)
+        self.assertEqual(n, 14)
+        self.assertEqual(self.contents(), '\0\0\0head body tail')
+        self.assertEqual(Storage_base.pread(self.fd, 4, 8), 'body')
+
+    def test_pwritev_many_chunks(self):
+        # more chunks than go in one call
+        chunks = [chr(65 + i % 26) for i in xrange(3000)]
+        n = Storage_base.pwritev(self.fd, chunks, 0)
+        self.assertEqual(n, 3000)
+        self.assertEqual(self.contents(), ''.join(chunks))
+
+    def test_pread_past_end(self):
+        Storage_base.pwritev(self.fd, ['abc'], 0)
+        self.assertEqual(Storage_base.pread(self.fd, 10, 1), 'bc')
+
+
+if not Storage_base.has_positional_io:
+    del PositionalIOTests
+
+if __name__ == '__main__':
+    main()
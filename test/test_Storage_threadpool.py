@@ -0,0 +1,205 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The write-back buffer of Storage_threadpool.Storage, against a FilePool
+# which records the writes it is given.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BTL.defer import Deferred
+from BitTorrent.Storage_threadpool import Storage
+
+
+class FakeFilePool(object):
+
+    def __init__(self):
+        self.file_to_torrent = {}
+        self.writes = []
+        self.fail = None
+
+    def write(self, _f, filename, pos, chunks):
+        df = Deferred()
+        data = ''.join([str(c) for c in chunks])
+        if self.fail is not None:
+            df.errback(self.fail)
+            return df
+        self.writes.append((filename, pos, data))
+        df.callback(len(data))
+        return df
+
+
+class FakeTorrent(object):
+
+    def __init__(self):
+        self.failures = []
+
+    def got_exception(self, failure):
+        self.failures.append(failure)
+
+
+class WriteBufferTests(TestCase):
+
+    def setUp(self):
+        self.tasks = []
+        self.filepool = FakeFilePool()
+        self.torrent = FakeTorrent()
+        s = Storage.__new__(Storage)
+        s.config = {'write_buffer_size': 1000,
+                    'write_buffer_flush_interval': 5}
+        s.filepool = self.filepool
+        s.add_task = self.add_task
+        s._dirty_begins = []
+        s._dirty_runs = {}
+        s._dirty_size = 0
+        s._flush_scheduled = False
+        s._write_error = None
+        s._write_error_reported = False
+        # two files of 100 bytes
+        s.ranges = [(0, 100, 'a'), (100, 200, 'b')]
+        s.range_by_name = {'a': (0, 100), 'b': (100, 200)}
+        for filename in s.range_by_name:
+            self.filepool.file_to_torrent[filename] = self.torrent
+        self.storage = s
+
+    def add_task(self, delay, f, *args, **kwargs):
+        self.tasks.append((delay, f, args, kwargs))
+
+    def run_tasks(self, timers=False):
+        # timers are the delayed tasks, run only when asked for
+        while True:
+            ready = [t for t in self.tasks if timers or not t[0]]
+            if not ready:
+                return
+            self.tasks = [t for t in self.tasks if t not in ready]
+            for delay, f, args, kwargs in ready:
+                f(*args, **kwargs)
+
+    def result(self, df):
+        self.run_tasks()
+        r = []
+        df.addCallbacks(r.append, r.append)
+        return r[0]
+
+    def runs(self):
+        s = self.storage
+        return [(begin, s._dirty_runs[begin][0],
+                 ''.join(s._dirty_runs[begin][1]))
+                for begin in s._dirty_begins]
+
+    def test_separate_runs(self):
+        self.storage.write(10, 'aaaa')
+        self.storage.write(30, 'bbbb')
+        self.assertEqual(self.runs(), [(10, 14, 'aaaa'), (30, 34, 'bbbb')])
+        self.assertEqual(self.storage._dirty_size, 8)
+        self.assertEqual(self.filepool.writes, [])
+
+    def test_adjacent_runs_merge(self):
+        s = self.storage
+        s.write(14, 'bbbb')
+        s.write(10, 'aaaa')
+        s.write(18, 'cccc')
+        self.assertEqual(self.runs(), [(10, 22, 'aaaabbbbcccc')])
+        # the gap between two runs filled in joins all three
+        s.write(30, 'eeee')
+        s.write(22, 'dddddddd')
+        self.assertEqual(self.runs(), [(10, 34, 'aaaabbbbccccddddddddeeee')])
+        self.assertEqual(s._dirty_size, 24)
+
+    def test_overwrite(self):
+        s = self.storage
+        s.write(10, 'aaaaaaaaaa')
+        # inside a run
+        s.write(12, 'BB')
+        self.assertEqual(self.runs(), [(10, 20, 'aaBBaaaaaa')])
+        # over the end of one run and the start of the next
+        s.write(30, 'cccccc')
+        s.write(18, 'XXXXXXXXXXXXXX')
+        self.assertEqual(self.runs(),
+                         [(10, 36, 'aaBBaaaa' + 'X' * 14 + 'cccc')])
+        # over a whole run and beyond both its ends
+        s.write(5, 'Y' * 40)
+        self.assertEqual(self.runs(), [(5, 45, 'Y' * 40)])
+        self.assertEqual(s._dirty_size, 40)
+
+    def test_flush_range(self):
+        s = self.storage
+        s.write(10, 'aaaa')
+        s.write(50, 'bbbb')
+        self.assertEqual(self.result(s.flush(48, 4)), True)
+        self.assertEqual(self.filepool.writes, [('a', 50, 'bbbb')])
+        self.assertEqual(self.runs(), [(10, 14, 'aaaa')])
+
+    def test_flush_across_files(self):
+        s = self.storage
+        s.write(95, '0123456789')
+        self.assertEqual(self.result(s.flush()), True)
+        self.assertEqual(self.filepool.writes,
+                         [('a', 95, '01234'), ('b', 0, '56789')])
+        self.assertEqual(s._dirty_size, 0)
+
+    def test_flush_when_full(self):
+        s = self.storage
+        s.config['write_buffer_size'] = 10
+        s.write(0, 'a' * 8)
+        self.assertEqual(self.filepool.writes, [])
+        s.write(8, 'b' * 8)
+        self.run_tasks()
+        self.assertEqual(self.filepool.writes, [('a', 0, 'a' * 8 + 'b' * 8)])
+
+    def test_flush_timer(self):
+        s = self.storage
+        s.write(0, 'aaaa')
+        s.write(10, 'bbbb')
+        self.run_tasks()
+        self.assertEqual(self.filepool.writes, [])
+        self.run_tasks(timers=True)
+        self.assertEqual(self.filepool.writes,
+                         [('a', 0, 'aaaa'), ('a', 10, 'bbbb')])
+
+    def test_flush_error(self):
+        s = self.storage
+        error = IOError(28, 'No space left on device')
+        s.write(0, 'aaaa')
+        self.filepool.fail = error
+        self.failUnless(isinstance(self.result(s.flush()).value, IOError))
+        # the data is lost: later writes and flushes fail with the error
+        self.failUnless(self.result(s.write(10, 'bbbb')).value is error)
+        self.failUnless(self.result(s.flush()).value is error)
+        # the callers were told, so the torrent isn't told as well
+        self.assertEqual(self.torrent.failures, [])
+
+    def test_background_flush_error(self):
+        s = self.storage
+        error = IOError(28, 'No space left on device')
+        s.write(0, 'aaaa')
+        self.assertEqual(self.result(s.write(10, 'bbbb')), 4)
+        self.filepool.fail = error
+        self.run_tasks(timers=True)
+        self.assertEqual(len(self.torrent.failures), 1)
+        self.failUnless(self.torrent.failures[0].value is error)
+        self.failUnless(self.result(s.write(20, 'cccc')).value is error)
+        self.assertEqual(len(self.torrent.failures), 1)
+
+    def test_unbuffered(self):
+        s = self.storage
+        s.config['write_buffer_size'] = 0
+        self.assertEqual(self.result(s.write(10, 'aaaa')), 4)
+        self.assertEqual(self.filepool.writes, [('a', 10, 'aaaa')])
+        self.assertEqual(self.runs(), [])
+
+
+if __name__ == '__main__':
+    main()
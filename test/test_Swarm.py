@@ -0,0 +1,83 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from unittest import TestCase, main
+
+from BTL.bencode import bdecode
+from BitTorrent.Swarm import Peer, Swarm
+
+
+class SwarmTests(TestCase):
+
+    def setUp(self):
+        self.swarm = Swarm()
+
+    def peer(self, n, left=100):
+        peer = Peer(chr(n) * 20, '10.0.0.%d' % n, 6880 + n, left)
+        self.swarm.add(peer)
+        return peer
+
+    def test_reachable(self):
+        s = self.swarm
+        p = self.peer(1)
+        s.set_reachable(p, '10.0.0.9', p.port)
+        self.assertEqual(s.given, [{p.id: p}, {}])
+        self.assertEqual(p.encode(2), '\x0a\x00\x00\x09\x1a\xe1')
+        self.assertEqual(bdecode(p.encode(0).bencoded),
+                         {'ip': '10.0.0.9', 'port': 6881, 'peer id': p.id})
+        self.assertEqual(bdecode(p.encode(1).bencoded),
+                         {'ip': '10.0.0.9', 'port': 6881})
+
+    def test_unpackable_address(self):
+        s = self.swarm
+        p = self.peer(1)
+        s.set_reachable(p, '2001:db8::1', p.port)
+        # given out in the bencoded forms, but not compact
+        self.assertEqual(s.given, [{p.id: p}, {}])
+        self.assertEqual(p.encode(2), '')
+        self.assertEqual(bdecode(p.encode(1).bencoded),
+                         {'ip': '2001:db8::1', 'port': 6881})
+
+    def test_give(self):
+        s = self.swarm
+        p = self.peer(1, 0)
+        s.give(p, '\x0a\x00\x00\x09\x1a\xe1')
+        self.assertEqual(s.given, [{}, {p.id: p}])
+        self.assertEqual(p.out_ip, '10.0.0.9')
+
+    def test_seed_and_remove(self):
+        s = self.swarm
+        p = self.peer(1)
+        s.set_reachable(p, p.ip, p.port)
+        self.assert_(s.set_left(p, 0))
+        self.assertEqual(s.seeds, 1)
+        self.assertEqual(s.given, [{}, {p.id: p}])
+        s.remove(p.id)
+        self.assertEqual((s.seeds, s.given), (0, [{}, {}]))
+        # a response cached before leaves it out
+        self.assertEqual(p.out_ip, None)
+
+    def test_unreachable(self):
+        s = self.swarm
+        p = self.peer(1)
+        s.set_reachable(p, p.ip, p.port)
+        s.set_unreachable(p)
+        self.assertEqual(s.given, [{}, {}])
+        self.assertEqual((p.out_ip, p.addr), (None, None))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from BitTorrent import TrackerStore as ts
+from BitTorrent.Swarm import Peer, Swarm
+
+
+class FakeTask(object):
+
+    def active(self):
+        return True
+
+    def cancel(self):
+        pass
+
+
+class FakeRawServer(object):
+
+    def add_task(self, delay, f, *args):
+        return FakeTask()
+
+
+def make_peer(n, ip, given_ip=None, key=None, left=100, nat=0,
+              out_ip=None):
+    peer = Peer(chr(n) * 20, ip, 6881 + n, left, key, given_ip)
+    peer.nat = nat
+    return peer, out_ip
+
+
+def peers():
+    long_key = ''.join([chr(i % 256) for i in xrange(1000)])
+    return [
+        make_peer(1, '10.0.0.1', out_ip='10.0.0.1'),
+        make_peer(2, '10.0.0.2', given_ip='tracker-peer.example.com',
+                  key='secret'),
+        make_peer(3, '2001:db8::1', given_ip='2001:db8::2',
+                  out_ip='2001:db8::2'),
+        # inet_aton would have made this 0.0.0.1
+        make_peer(4, '10.0.0.4', given_ip='1', left=0),
+        make_peer(5, '10.0.0.5', key=long_key, left=ts.MAX_LEFT),
+        make_peer(6, '10.0.0.6', key=''),
+        # not given out while its NAT check is pending
+        make_peer(7, '10.0.0.7', nat=-1),
+        ]
+
+
+def fields(peer):
+    return (peer.id, peer.ip, peer.port, peer.left, peer.key,
+            peer.given_ip, peer.nat)
+
+
+class PeerEncodingTests(TestCase):
+
+    def test_round_trip(self):
+        for peer, out_ip in peers():
+            peer.out_ip = out_ip
+            data = 'xx' + ts.encode_peer(peer) + 'yy'
+            p, o, offset = ts.decode_peer(data, 2)
+            self.assertEqual(fields(p), fields(peer))
+            self.assertEqual(o, out_ip)
+            self.assertEqual(data[offset:], 'yy')
+
+    def test_truncated(self):
+        # the long key
+        peer, out_ip = peers()[4]
+        data = ts.encode_peer(peer)
+        self.assertRaises(ts.struct_error, ts.decode_peer, data[:-1], 0)
+
+
+class TrackerStoreTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dstate')
+        self.errors = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def store(self):
+        return ts.TrackerStore(self.path, FakeRawServer(), 10,
+                               lambda *a: self.errors.append(a))
+
+    def legacy(self, data):
+        self.fail('not a legacy state file')
+
+    def swarm(self):
+        swarm = Swarm()
+        for peer, out_ip in peers():
+            swarm.add(peer)
+            if out_ip is not None:
+                swarm.set_reachable(peer, out_ip, peer.port)
+        return swarm
+
+    def check(self, downloads):
+        self.assertEqual(downloads.keys(), ['i' * 20])
+        swarm = downloads['i' * 20]
+        self.assertEqual(len(swarm), len(peers()))
+        for peer, out_ip in peers():
+            p = swarm.get(peer.id)
+            self.assertEqual(fields(p), fields(peer))
+            self.assertEqual(p.out_ip, out_ip)
+        self.assertEqual(swarm.get('\x01' * 20).addr,
+                         '\x0a\x00\x00\x01\x1a\xe2')
+        # given out, but not in compact responses
+        self.assertEqual(swarm.get('\x03' * 20).addr, '')
+        self.assertEqual(len(swarm.given[0]) + len(swarm.given[1]), 2)
+
+    def test_journal(self):
+        s = self.store()
+        s.start()
+        for peer in self.swarm().peers.itervalues():
+            s.peer_changed('i' * 20, peer)
+        s.peer_removed('i' * 20, 'x' * 20)
+        s.completed_changed('i' * 20, 3)
+        s.close()
+        downloads, completed, state = self.store().load(self.legacy)
+        self.check(downloads)
+        self.assertEqual(completed, {'i' * 20: 3})
+
+    def test_snapshot(self):
+        s = self.store()
+        s.start()
+        s._write_snapshot(s.seq, {'i' * 20: self.swarm()}, {'i' * 20: 7},
+                          {'allowed': None})
+        s.close()
+        downloads, completed, state = self.store().load(self.legacy)
+        self.check(downloads)
+        self.assertEqual(completed, {'i' * 20: 7})
+        self.assertEqual(state, {'allowed': None})
+        self.assertEqual(self.errors, [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The UDP tracker protocol, against a tracker which keeps its peers in
+# Swarms and answers with all of them.
+
+import sys
+sys.path = ['.',] + sys.path #HACK
+
+from struct import pack, unpack
+from unittest import TestCase, main
+
+from BitTorrent import UDPTracker as udp
+from BitTorrent.Swarm import Peer, Swarm
+
+INFOHASH = 'i' * 20
+CLIENT = ('10.0.0.1', 6881)
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, flags, addr):
+        self.sent.append((addr, packet))
+
+
+class FakeTracker(object):
+
+    def __init__(self):
+        self.config = {'scrape_allowed': 'full'}
+        self.allowed = None
+        self.downloads = {}
+        self.announces = []
+
+    def not_allowed_reason(self, infohash):
+        if self.allowed is not None and infohash not in self.allowed:
+            return 'not authorized'
+        return None
+
+    def announce(self, infohash, event, ip, myid, port, left, key,
+                 given_ip, numwant):
+        self.announces.append((infohash, event, ip, myid, port, left, key,
+                               given_ip, numwant))
+        swarm = self.downloads.setdefault(infohash, Swarm())
+        if myid in swarm:
+            swarm.remove(myid)
+        peer = Peer(myid, ip, port, left, key, given_ip)
+        swarm.add(peer)
+        swarm.set_reachable(peer, given_ip or ip, port)
+        return 50
+
+    def peerlist(self, infohash, stopped, is_seed, return_type, rsize):
+        swarm = self.downloads[infohash]
+        peers = [p.encode(return_type) for p in swarm.peers.itervalues()]
+        return {'interval': 1800, 'complete': swarm.seeds,
+                'incomplete': len(swarm) - swarm.seeds,
+                'peers': ''.join(peers)}
+
+    def scrapedata(self, infohash, return_name=True):
+        swarm = self.downloads[infohash]
+        return {'complete': swarm.seeds, 'downloaded': 7,
+                'incomplete': len(swarm) - swarm.seeds}
+
+
+class UDPTrackerTests(TestCase):
+
+    def setUp(self):
+        self.now = 100000.0
+        self._time = udp.time
+        udp.time = lambda: self.now
+        self.tracker = FakeTracker()
+        self.socket = FakeSocket()
+        self.udp = udp.UDPTracker(self.tracker, self.socket)
+
+    def tearDown(self):
+        udp.time = self._time
+
+    def reply(self, addr, data):
+        self.udp.data_came_in(addr, data)
+        sent_to, packet = self.socket.sent.pop()
+        self.assertEqual(sent_to, addr)
+        self.assertEqual(self.socket.sent, [])
+        return packet
+
+    def connect(self, addr=CLIENT):
+        r = self.reply(addr, pack('>QII', udp.PROTOCOL_ID, udp.CONNECT, 5))
+        action, tid, connection_id = unpack('>IIQ', r)
+        self.assertEqual((action, tid), (udp.CONNECT, 5))
+        return connection_id
+
+    def announce_packet(self, connection_id, peerid, left=100, event=2,
+                        ip=0, port=6881, infohash=INFOHASH):
+        return pack(udp.ANNOUNCE_FORMAT, connection_id, udp.ANNOUNCE, 9,
+                    infohash, peerid, 0, left, 0, event, ip, 0xbeef, -1,
+                    port)
+
+    def announce(self, addr, peerid, **kw):
+        r = self.reply(addr, self.announce_packet(self.connect(addr), peerid,
+                                                  **kw))
+        action, tid = unpack('>II', r[:8])
+        if action == udp.ERROR:
+            return r[8:]
+        self.assertEqual((action, tid), (udp.ANNOUNCE, 9))
+        interval, leechers, seeds = unpack('>III', r[8:20])
+        peers = [r[i:i + 6] for i in xrange(20, len(r), 6)]
+        return interval, leechers, seeds, peers
+
+    def assertError(self, packet, tid, message):
+        self.assertEqual(unpack('>II', packet[:8]), (udp.ERROR, tid))
+        self.assertEqual(packet[8:], message)
+
+    def test_connect_announce_scrape(self):
+        self.assertEqual(len(self.announce_packet(0, 'a' * 20)),
+                         udp.ANNOUNCE_SIZE)
+        interval, leechers, seeds, peers = self.announce(CLIENT, 'a' * 20)
+        self.assertEqual((interval, leechers, seeds), (1800, 1, 0))
+        self.assertEqual(self.tracker.announces,
+                         [(INFOHASH, 'started', '10.0.0.1', 'a' * 20, 6881,
+                           100, '0000beef', None, None)])
+        # the compact peer list
+        self.assertEqual(peers, ['\x0a\x00\x00\x01\x1a\xe1'])
+        other = ('10.0.0.2', 7000)
+        interval, leechers, seeds, peers = self.announce(other, 'b' * 20,
+                                                         left=0, port=7000)
+        self.assertEqual((leechers, seeds), (1, 1))
+        self.assertEqual(sorted(peers), ['\x0a\x00\x00\x01\x1a\xe1',
+                                         '\x0a\x00\x00\x02\x1b\x58'])
+
+        r = self.reply(CLIENT, pack('>QII', self.connect(), udp.SCRAPE, 11) +
+                       INFOHASH + 'u' * 20)
+        self.assertEqual(unpack('>IIIIIIII', r),
+                         (udp.SCRAPE, 11, 1, 7, 1, 0, 0, 0))
+
+    def test_scrape_not_allowed(self):
+        self.tracker.config['scrape_allowed'] = 'none'
+        r = self.reply(CLIENT, pack('>QII', self.connect(), udp.SCRAPE, 11) +
+                       INFOHASH)
+        self.assertEqual(unpack('>II', r[:8]), (udp.ERROR, 11))
+
+    def test_invalid_connection_id(self):
+        connection_id = self.connect()
+        r = self.reply(CLIENT, self.announce_packet(connection_id + 1,
+                                                    'a' * 20))
+        self.assertError(r, 9, 'invalid connection id')
+        # given to another address
+        r = self.reply(('10.0.0.2', 6881),
+                       self.announce_packet(connection_id, 'a' * 20))
+        self.assertError(r, 9, 'invalid connection id')
+        self.assertEqual(self.tracker.announces, [])
+
+    def test_expired_connection_id(self):
+        connection_id = self.connect()
+        # good for the period it was given in and the next
+        self.now += udp.CONNECTION_ID_PERIOD
+        r = self.reply(CLIENT, self.announce_packet(connection_id, 'a' * 20))
+        self.assertEqual(unpack('>I', r[:4]), (udp.ANNOUNCE,))
+        self.now += udp.CONNECTION_ID_PERIOD
+        r = self.reply(CLIENT, self.announce_packet(connection_id, 'a' * 20))
+        self.assertError(r, 9, 'invalid connection id')
+
+    def test_connect_needs_protocol_id(self):
+        self.udp.data_came_in(CLIENT, pack('>QII', 1, udp.CONNECT, 5))
+        self.udp.data_came_in(CLIENT, 'short')
+        self.assertEqual(self.socket.sent, [])
+
+    def test_short_announce(self):
+        packet = self.announce_packet(self.connect(), 'a' * 20)
+        r = self.reply(CLIENT, packet[:-1])
+        self.assertError(r, 9, 'announce too short')
+        self.assertEqual(self.tracker.announces, [])
+
+    def test_disallowed_infohash(self):
+        self.tracker.allowed = {INFOHASH: {}}
+        self.assertEqual(self.announce(CLIENT, 'a' * 20, infohash='x' * 20),
+                         'not authorized')
+        self.assertEqual(self.tracker.announces, [])
+        self.assertEqual(len(self.announce(CLIENT, 'a' * 20)), 4)
+
+    def test_invalid_event(self):
+        self.assertEqual(self.announce(CLIENT, 'a' * 20, event=7),
+                         'invalid event')
+
+    def test_ip_override(self):
+        ip = unpack('>I', '\x0a\x00\x00\x09')[0]
+        interval, leechers, seeds, peers = self.announce(CLIENT, 'a' * 20,
+                                                         ip=ip)
+        self.assertEqual(self.tracker.announces[0][2], '10.0.0.1')
+        self.assertEqual(self.tracker.announces[0][7], '10.0.0.9')
+        self.assertEqual(peers, ['\x0a\x00\x00\x09\x1a\xe1'])
+
+    def test_unknown_action(self):
+        r = self.reply(CLIENT, pack('>QII', self.connect(), 9, 11))
+        self.assertError(r, 11, 'unknown action')
+
+
+if __name__ == '__main__':
+    main()